@@ -16,6 +16,7 @@ import numpy as np
 import pandas as pd
 from pandas.core.groupby import DataFrameGroupBy
 
+from tools.columnar import columnarize_payload
 from tools.process import MAPPINGS, DATA_DIR, ROOT_ID, ROOT_DIR, save_json, write_text
 from tools.ephys_units import get_ephys_feature_unit
 from server import new_uuid, create_bucket_metadata, create_bucket, create_features, get_bucket
@@ -361,7 +362,7 @@ def remove_leaves(tree, check):
             remove_leaves(item, check)
 
 
-def create_ephys_features(patch=False, dry_run=False):
+def create_ephys_features(patch=False, dry_run=False, columnar=False):
     alias = 'ephys'
     short_desc = 'Ephys atlas'
     tree = None
@@ -385,12 +386,14 @@ def create_ephys_features(patch=False, dry_run=False):
             sorted(iter_fset_features('ephys'), key=itemgetter(0)), itemgetter(0)):
         print(f'/api/buckets/{alias}/{fname}')
         json_data = {'mappings': {mapping: d for _, mapping, d in mappings}}
+        if columnar:
+            columnarize_payload(json_data)
         if not dry_run:
             unit = get_feature_unit(alias, fname)
             print(create_features(bucket_uuid, fname, json_data, unit=unit, patch=patch))
 
 
-def create_bwm_features(patch=False, dry_run=False):
+def create_bwm_features(patch=False, dry_run=False, columnar=False):
     alias = 'bwm'
     short_desc = 'Brain wide map'
     sets = BWM_FSETS
@@ -420,6 +423,8 @@ def create_bwm_features(patch=False, dry_run=False):
             if not dry_run:
                 feature_data = {'mappings': {
                     mapping: d for _, mapping, d in mappings}}
+                if columnar:
+                    columnarize_payload(feature_data)
                 unit = get_feature_unit(alias, fname)
                 print(create_features(bucket_uuid,
                       fname, feature_data, unit=unit, patch=patch))
@@ -46,9 +46,18 @@
  * @typedef {Object.<string, FeatureStatisticValues>} FeatureStatisticsById
  */
 
+/**
+ * @typedef {Object} FeatureMappingColumns
+ * @property {Array<number | string>} ids
+ * @property {Object.<string, Array<number | null>>} values
+ * @property {string[]} histogram_keys
+ * @property {number[][]} histogram
+ */
+
 /**
  * @typedef {Object} FeatureMappingData
  * @property {FeatureStatisticsById} data
+ * @property {FeatureMappingColumns} [columns]
  * @property {Object.<string, {min: number, max: number}>} statistics
  */
 
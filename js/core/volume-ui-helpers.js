@@ -25,3 +25,27 @@ export function getVolumeSliceIndex(sliderValue, downsample, sliceCount) {
     }
     return Math.min(sliceCount - 1, Math.max(0, Math.floor(sliderValue / (2.5 * downsample))));
 }
+
+export function getVolumeSliceRequest(axis, sliderValue, slices, mapping) {
+    // The native slice displayed along a view axis, in a volume stored slice by slice.
+    const rawAxis = mapping.axisToRaw[axis];
+    const index = getVolumeSliceIndex(sliderValue, mapping.downsample[axis] || 1, mapping.axisSizes[axis]);
+    return { rawAxis, index, href: `${slices}/${rawAxis}/${index}.npy` };
+}
+
+export function makeVolumeSliceSession(axis, slice, mapping) {
+    // A session drawing a single native slice as the volume with one voxel along its axis,
+    // which keeps the memory layout of the 2D array. Draw it at slice index 0.
+    const rawAxis = mapping.axisToRaw[axis];
+    const axisSizes = { ...mapping.axisSizes, [axis]: 1 };
+    return {
+        shape: [0, 1, 2].map((raw) => axisSizes[mapping.rawToAxis[raw]]),
+        volume: slice.data,
+        fortran_order: slice.fortran_order,
+        bounds: slice.bounds,
+        rawToAxis: mapping.rawToAxis,
+        axisSizes,
+        downsample: mapping.downsample,
+        rawAxis,
+    };
+}
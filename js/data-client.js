@@ -18,6 +18,10 @@ class DataClient {
         return downloadJSON(this.urls.features(bucket, fname), refresh, { signal });
     }
 
+    volumesUrl(bucket, fname) {
+        return this.urls.volumes(bucket, fname);
+    }
+
     fetchFeatureText(bucket, fname, options) {
         const refresh = options ? options.refresh : false;
         const signal = options ? options.signal : undefined;
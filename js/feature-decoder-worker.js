@@ -78,8 +78,8 @@ function loadNPY(buf) {
         throw new Error('unknown numeric dtype');
     }
 
-    const startIndex = buf.length - 8;
-    const bounds = new Float32Array(buf.buffer, startIndex);
+    // The bounds are copied, as their offset is not 4-byte aligned for all the data sizes.
+    const bounds = new Float32Array(buf.slice(buf.length - 8).buffer);
 
     return {
         shape: info.shape,
@@ -96,11 +96,44 @@ function loadCompressedBase64(base64) {
     return loadNPY(npydata);
 }
 
-function decodeVolumes(featureData) {
-    for (const name in featureData.volumes) {
-        const vol = featureData.volumes[name].volume;
-        featureData.volumes[name].volume = loadCompressedBase64(vol);
+function isVolumeReference(vol) {
+    return vol != null && typeof vol === 'object' && typeof vol.href === 'string';
+}
+
+async function loadVolumeReference(ref, volumesUrl) {
+    // Sidecar NPY served by /api/buckets/<bucket>/<fname>/volumes/<name>.npy, the browser
+    // takes care of the gzip Content-Encoding.
+    const response = await fetch(`${volumesUrl}/${ref.href}`);
+    if (!response.ok) {
+        throw new Error(`could not load volume ${ref.href}`);
     }
+    return loadNPY(new Uint8Array(await response.arrayBuffer()));
+}
+
+async function decodeVolumes(featureData, volumesUrl) {
+    await Promise.all(Object.keys(featureData.volumes || {}).map(async (name) => {
+        const entry = featureData.volumes[name];
+        const vol = entry.volume;
+        if (!isVolumeReference(vol)) {
+            entry.volume = loadCompressedBase64(vol);
+            return;
+        }
+        // With a mip pyramid (finest level first), only the coarsest level is loaded here,
+        // the finer ones are listed from coarse to fine in `refinements`. When the volume is
+        // also stored slice by slice, the native level is not listed: the volume view fetches
+        // the native slices it displays instead, see `slices`.
+        const levels = vol.levels || [];
+        if (levels.length > 0) {
+            entry.refinements = levels.slice(0, -1).map((level) => level.href).reverse();
+            if (vol.slices && vol.shape) {
+                entry.slices = { href: vol.slices, shape: vol.shape };
+            }
+            else {
+                entry.refinements.push(vol.href);
+            }
+        }
+        entry.volume = await loadVolumeReference(levels.length > 0 ? levels[levels.length - 1] : vol, volumesUrl);
+    }));
 
     if ("xyz" in featureData) {
         featureData.xyz = loadCompressedBase64(featureData.xyz);
@@ -115,17 +148,17 @@ function decodeVolumes(featureData) {
     return featureData;
 }
 
-self.onmessage = (event) => {
-    const { id, featureData, featureResponseText } = event.data;
+self.onmessage = async (event) => {
+    const { id, featureData, featureResponseText, volumesUrl } = event.data;
 
     try {
         let decoded = null;
         if (featureResponseText != null) {
             const featureResponse = JSON.parse(featureResponseText);
-            decoded = decodeVolumes(featureResponse.feature_data);
+            decoded = await decodeVolumes(featureResponse.feature_data, volumesUrl);
         }
         else {
-            decoded = decodeVolumes(featureData);
+            decoded = await decodeVolumes(featureData, volumesUrl);
         }
         self.postMessage({ id, featureData: decoded });
     }
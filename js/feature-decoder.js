@@ -1,4 +1,6 @@
-export { decodeFeaturePayload, decodeFeatureResponseText };
+export { decodeFeaturePayload, decodeFeatureResponseText, loadVolumeReference };
+
+import { expandColumnarMappings } from "./feature-payload.js";
 
 let volumeDecoderWorkerPromise = null;
 let nextDecodeRequestId = 1;
@@ -106,8 +108,8 @@ function loadNPY(buf) {
         throw new Error('unknown numeric dtype');
     }
 
-    const startIndex = buf.length - 8;
-    const bounds = new Float32Array(buf.buffer, startIndex);
+    // The bounds are copied, as their offset is not 4-byte aligned for all the data sizes.
+    const bounds = new Float32Array(buf.slice(buf.length - 8).buffer);
 
     return {
         shape: info.shape,
@@ -124,11 +126,42 @@ function loadCompressedBase64(base64) {
     return loadNPY(npydata);
 }
 
-function decodeVolumes(featureData) {
-    for (const name in featureData.volumes) {
-        const vol = featureData.volumes[name].volume;
-        featureData.volumes[name].volume = loadCompressedBase64(vol);
+function isVolumeReference(vol) {
+    return vol != null && typeof vol === 'object' && typeof vol.href === 'string';
+}
+
+async function loadVolumeReference(ref, volumesUrl) {
+    const response = await fetch(`${volumesUrl}/${ref.href}`);
+    if (!response.ok) {
+        throw new Error(`could not load volume ${ref.href}`);
     }
+    return loadNPY(new Uint8Array(await response.arrayBuffer()));
+}
+
+async function decodeVolumes(featureData, volumesUrl) {
+    await Promise.all(Object.keys(featureData.volumes || {}).map(async (name) => {
+        const entry = featureData.volumes[name];
+        const vol = entry.volume;
+        if (!isVolumeReference(vol)) {
+            entry.volume = loadCompressedBase64(vol);
+            return;
+        }
+        // With a mip pyramid (finest level first), only the coarsest level is loaded here,
+        // the finer ones are listed from coarse to fine in `refinements`. When the volume is
+        // also stored slice by slice, the native level is not listed: the volume view fetches
+        // the native slices it displays instead, see `slices`.
+        const levels = vol.levels || [];
+        if (levels.length > 0) {
+            entry.refinements = levels.slice(0, -1).map((level) => level.href).reverse();
+            if (vol.slices && vol.shape) {
+                entry.slices = { href: vol.slices, shape: vol.shape };
+            }
+            else {
+                entry.refinements.push(vol.href);
+            }
+        }
+        entry.volume = await loadVolumeReference(levels.length > 0 ? levels[levels.length - 1] : vol, volumesUrl);
+    }));
 
     if ("xyz" in featureData) {
         featureData.xyz = loadCompressedBase64(featureData.xyz);
@@ -141,10 +174,10 @@ function decodeVolumes(featureData) {
     }
 }
 
-async function decodeVolumesInWorker(featureData) {
+async function decodeVolumesInWorker(featureData, volumesUrl) {
     const worker = await getVolumeDecoderWorker();
     if (!worker) {
-        decodeVolumes(featureData);
+        await decodeVolumes(featureData, volumesUrl);
         return featureData;
     }
 
@@ -167,19 +200,19 @@ async function decodeVolumesInWorker(featureData) {
         };
 
         worker.addEventListener('message', onMessage);
-        worker.postMessage({ id, featureData });
-    }).catch((error) => {
+        worker.postMessage({ id, featureData, volumesUrl });
+    }).catch(async (error) => {
         console.warn('volume decode worker failed, falling back to main thread', error);
-        decodeVolumes(featureData);
+        await decodeVolumes(featureData, volumesUrl);
         return featureData;
     });
 }
 
-async function decodeFeatureResponseTextInWorker(featureResponseText) {
+async function decodeFeatureResponseTextInWorker(featureResponseText, volumesUrl) {
     const worker = await getVolumeDecoderWorker();
     if (!worker) {
         const featureResponse = JSON.parse(featureResponseText);
-        decodeVolumes(featureResponse.feature_data);
+        await decodeVolumes(featureResponse.feature_data, volumesUrl);
         return featureResponse.feature_data;
     }
 
@@ -202,11 +235,11 @@ async function decodeFeatureResponseTextInWorker(featureResponseText) {
         };
 
         worker.addEventListener('message', onMessage);
-        worker.postMessage({ id, featureResponseText });
-    }).catch((error) => {
+        worker.postMessage({ id, featureResponseText, volumesUrl });
+    }).catch(async (error) => {
         console.warn('volume parse/decode worker failed, falling back to main thread', error);
         const featureResponse = JSON.parse(featureResponseText);
-        decodeVolumes(featureResponse.feature_data);
+        await decodeVolumes(featureResponse.feature_data, volumesUrl);
         return featureResponse.feature_data;
     });
 }
@@ -229,7 +262,7 @@ function cleanupNonVolumeMappings(featureData) {
     }
 }
 
-async function decodeFeaturePayload(featureResponse) {
+async function decodeFeaturePayload(featureResponse, volumesUrl) {
     if (!featureResponse) {
         return null;
     }
@@ -240,17 +273,19 @@ async function decodeFeaturePayload(featureResponse) {
     }
 
     if ("volumes" in featureData) {
-        return decodeVolumesInWorker(featureData);
+        return decodeVolumesInWorker(featureData, volumesUrl);
     }
 
+    expandColumnarMappings(featureData);
     cleanupNonVolumeMappings(featureData);
     return featureData;
 }
 
-async function decodeFeatureResponseText(featureResponseText) {
+async function decodeFeatureResponseText(featureResponseText, volumesUrl) {
     if (!featureResponseText) {
         return null;
     }
 
-    return decodeFeatureResponseTextInWorker(featureResponseText);
+    return expandColumnarMappings(
+        await decodeFeatureResponseTextInWorker(featureResponseText, volumesUrl));
 }
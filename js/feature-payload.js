@@ -60,3 +60,51 @@ export function getFeatureVolumeData(payload) {
 
     return payload;
 }
+
+/**
+ * Expand mappings stored in the columnar layout written by tools/columnar.py
+ * (`{ids, values, histogram_keys, histogram}`) into the per-region `data` dicts used
+ * by the rest of the app. Zero histogram bins are omitted as in the default layout.
+ *
+ * @param {FeaturePayload | null | undefined} payload
+ * @returns {FeaturePayload | null | undefined}
+ */
+export function expandColumnarMappings(payload) {
+    if (!payload?.mappings) {
+        return payload;
+    }
+
+    for (const mapping in payload.mappings) {
+        const mappingData = payload.mappings[mapping];
+        const columns = mappingData?.columns;
+        if (!columns || mappingData.data) {
+            continue;
+        }
+
+        const ids = columns.ids || [];
+        const values = columns.values || {};
+        const stats = Object.keys(values);
+        const histogramKeys = columns.histogram_keys || [];
+        const histogram = columns.histogram || [];
+        const data = {};
+        for (let i = 0; i < ids.length; i++) {
+            const row = {};
+            for (const stat of stats) {
+                row[stat] = values[stat][i];
+            }
+            const bins = histogram[i];
+            if (bins) {
+                for (let j = 0; j < histogramKeys.length; j++) {
+                    if (bins[j]) {
+                        row[histogramKeys[j]] = bins[j];
+                    }
+                }
+            }
+            data[ids[i]] = row;
+        }
+
+        mappingData.data = data;
+        delete mappingData.columns;
+    }
+    return payload;
+}
@@ -165,9 +165,12 @@ class FeatureStore {
             this.splash.add(1);
         }
 
+        // Volumes stored as sidecar binaries are referenced from the feature JSON and fetched
+        // from this URL during decoding.
+        const volumesUrl = bucket == "local" ? null : this.dataClient.volumesUrl(bucket, fname);
         const featureData = usedRawVolumeText
-            ? await decodeFeatureResponseText(featureText)
-            : await decodeFeaturePayload(response);
+            ? await decodeFeatureResponseText(featureText, volumesUrl)
+            : await decodeFeaturePayload(response, volumesUrl);
         if (featureData && "volumes" in featureData && !isPrefetch) {
             this.splash.add(1);
         }
@@ -4,6 +4,7 @@ import { BASE_URL } from "./constants.js";
 import { DataClient } from "./data-client.js";
 import { AtlasStaticStore } from "./atlas-static-store.js";
 import { FeatureStore } from "./feature-store.js";
+import { loadVolumeReference } from "./feature-decoder.js";
 import { PrefetchController } from "./prefetch-controller.js";
 import { memoize } from "./utils.js";
 import { buildRegionColors } from "./core/color-helpers.js";
@@ -22,6 +23,7 @@ const URLS = {
     'slices': (name) => `/data/json/slices_${name}.json`,
     'bucket': (bucket) => `${BASE_URL}/api/buckets/${bucket}`,
     'features': (bucket, fname) => `${BASE_URL}/api/buckets/${bucket}/${fname}`,
+    'volumes': (bucket, fname) => `${BASE_URL}/api/buckets/${bucket}/${fname}/volumes`,
 }
 
 class Model {
@@ -223,6 +225,16 @@ class Model {
         return getFeatureVolumeData(this.getFeaturePayload(bucket, fname));
     }
 
+    loadFeatureVolumeLevel(bucket, fname, href) {
+        console.assert(bucket);
+        return loadVolumeReference({ href }, this.dataClient.volumesUrl(bucket, fname));
+    }
+
+    loadFeatureVolumeSlice(bucket, fname, href) {
+        console.assert(bucket);
+        return loadVolumeReference({ href }, this.dataClient.volumesUrl(bucket, fname));
+    }
+
     /* Colors                                                                                    */
     /*********************************************************************************************/
 
@@ -2,9 +2,14 @@ export { Volume };
 
 import { clearStyle } from "./utils.js";
 import { getRequiredElement, getRequiredSheet } from "./core/dom.js";
-import { VOLUME_AXES } from "./constants.js";
-import { hexColorToRgb } from "./core/volume-helpers.js";
-import { buildVolumeVisibilityRules, getVolumeSliderMax } from "./core/volume-ui-helpers.js";
+import { VOLUME_AXES, VOLUME_SIZE } from "./constants.js";
+import { computeAxisMapping, hexColorToRgb } from "./core/volume-helpers.js";
+import {
+    buildVolumeVisibilityRules,
+    getVolumeSliceRequest,
+    getVolumeSliderMax,
+    makeVolumeSliceSession,
+} from "./core/volume-ui-helpers.js";
 import { EVENTS } from "./core/events.js";
 import { VolumeSession } from "./volume-session.js";
 import { VolumeCanvasRenderer } from "./volume-canvas-renderer.js";
@@ -41,6 +46,9 @@ class Volume {
             }
         }
         this.session.volumeArrays = {};
+        // Native slices of the active volume when it is stored slice by slice, see drawSlice().
+        this.slices = null;
+        this.nativeSlices = {};
 
         this.renderer = new VolumeCanvasRenderer({
             canvases: this.canvases,
@@ -71,6 +79,8 @@ class Volume {
 
     setupDispatcher() {
         this.dispatcher.on(EVENTS.FEATURE, async (ev) => {
+            this.slices = null;
+            this.nativeSlices = {};
             if (!ev.isVolume) {
                 this.hideVolume();
                 this.session.reset();
@@ -92,12 +102,23 @@ class Volume {
                 if (preferred) {
                     this.session.activeVolumeName = preferred;
                     this.setSessionArray(this.session.volumeArrays[preferred], preferred);
+                    const slices = volume.volumes[preferred].slices;
+                    if (slices) {
+                        this.slices = {
+                            href: slices.href,
+                            mapping: computeAxisMapping(slices.shape, VOLUME_SIZE, VOLUME_AXES),
+                        };
+                    }
                 }
                 else {
                     this.setSessionArray(null);
                 }
 
                 this.draw();
+
+                if (preferred) {
+                    this.refineVolume(state.bucket, state.fname, volume.volumes[preferred], preferred);
+                }
             }
         });
 
@@ -124,6 +145,37 @@ class Volume {
         });
     }
 
+    async refineVolume(bucket, fname, entry, volumeName) {
+        // Volumes with a mip pyramid are first drawn at their coarsest level. The finer
+        // levels are requested at once, and each one replaces the volume drawn if it is
+        // finer and the feature is still shown.
+        const refinements = entry.refinements || [];
+        entry.refinements = [];
+        await Promise.all(refinements.map(async (href, i) => {
+            const rank = i + 1;
+            let arr = null;
+            try {
+                arr = await this.model.loadFeatureVolumeLevel(bucket, fname, href);
+            }
+            catch (error) {
+                console.warn(`could not load volume level ${href}`, error);
+                return;
+            }
+            if (rank <= (entry.rank || 0)) {
+                return;
+            }
+            entry.volume = arr;
+            entry.rank = rank;
+            const state = this.state;
+            if (state.isVolume && state.bucket == bucket && state.fname == fname &&
+                this.session.activeVolumeName == volumeName) {
+                this.session.volumeArrays[volumeName] = arr;
+                this.setSessionArray(arr, volumeName);
+                this.draw();
+            }
+        }));
+    }
+
     setCmap() {
         const colors = this.model.getColormap(this.state.cmap);
         this.colors = [];
@@ -151,11 +203,43 @@ class Volume {
     }
 
     drawSlice(axis, idx) {
-        this.renderer.drawSlice(axis, idx, {
-            state: this.state,
-            session: this.session,
-            colors: this.colors,
-        });
+        // A volume stored slice by slice is drawn from its native slice once it is loaded,
+        // and from the mip level of the session until then.
+        const options = { state: this.state, session: this.session, colors: this.colors };
+        if (this.slices && this.session.shape != null) {
+            const { href } = getVolumeSliceRequest(axis, idx, this.slices.href, this.slices.mapping);
+            const slice = this.nativeSlices[axis];
+            if (slice && slice.href == href && slice.session) {
+                this.renderer.drawSlice(axis, 0, { ...options, session: slice.session });
+                return;
+            }
+            this.loadNativeSlice(axis, href);
+        }
+        this.renderer.drawSlice(axis, idx, options);
+    }
+
+    async loadNativeSlice(axis, href) {
+        if (this.nativeSlices[axis]?.href == href) {
+            return;
+        }
+        const { bucket, fname } = this.state;
+        const slices = this.slices;
+        const request = { href, session: null };
+        this.nativeSlices[axis] = request;
+        let arr = null;
+        try {
+            arr = await this.model.loadFeatureVolumeSlice(bucket, fname, href);
+        }
+        catch (error) {
+            console.warn(`could not load volume slice ${href}`, error);
+            return;
+        }
+        // The slice is dropped if another slice or feature was shown in the meantime.
+        if (this.nativeSlices[axis] !== request || this.slices !== slices) {
+            return;
+        }
+        request.session = makeVolumeSliceSession(axis, arr, slices.mapping);
+        this.drawSlice(axis, this.state[axis]);
     }
 
     setSessionArray(arr, volumeName = null) {
@@ -185,6 +269,12 @@ class Volume {
     }
 
     draw() {
-        this.renderer.draw(this.state, this.session, this.colors);
+        if (!this.slices) {
+            this.renderer.draw(this.state, this.session, this.colors);
+            return;
+        }
+        for (const axis of VOLUME_AXES) {
+            this.drawSlice(axis, this.state[axis]);
+        }
     }
 };
@@ -1,8 +1,20 @@
 import argparse
+import cProfile
+import hashlib
+import importlib.metadata
 import json
+import multiprocessing
+import pstats
 import random
 import sys
 import uuid
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
 from datetime import datetime
 from pathlib import Path
 
@@ -10,6 +22,7 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 from iblatlas.regions import BrainRegions
+from joblib import effective_n_jobs
 from tqdm.auto import tqdm
 
 # Allow importing ephysatlas from the adjacent ibleatools checkout when this
@@ -27,21 +40,63 @@ from ephysatlas.features import voltage_features_set
 from iblbrainviewer import api
 from one.api import ONE
 
+from tools.aggregates import (
+    N_BINS,
+    RANGE_QUANTILE,
+    SKETCH_SIZE,
+    RangeCache,
+    RegionAccumulator,
+    compute_ranges,
+    get_histogram_groupby,
+    get_statistics,
+)
+from tools.atlas_index import atlas_ids_to_index, load_atlas_index_table
+from tools.cluster_dataset import (
+    iter_cluster_dataset,
+    list_cluster_partitions,
+    read_cluster_dataset,
+    write_cluster_partition,
+)
+from tools.columnar import columnarize_payload
+from tools.profiling import GenerationProfiler
 from tools.ephys_units import (
     get_ephys_cluster_feature_unit,
     get_ephys_feature_unit,
 )
+from tools.feature_files import (
+    FEATURES_JSON_SEPARATORS,
+    compact_features_file,
+    write_compressed_siblings,
+    write_json_atomic,
+)
+from tools.volumes import MIP_LEVELS, externalize_volumes
 
 
-N_BINS = 50
 HISTOGRAM_QUANTILE = 0.001
-RANGE_QUANTILE = 0.02
 DEFAULT_PROJECT = "ibl_neuropixel_brainwide_01"
 DEFAULT_AGG_PROJECT = "ea_active"
 DEFAULT_AGG_LEVEL = "agg_full"
 ROOT_DIR = Path(__file__).resolve().parent
 FEATURES_DIR = ROOT_DIR / "data/features"
+ATLAS_INDEX_CACHE_PATH = ROOT_DIR / "data/cache/atlas_index.npz"
+RANGE_CACHE_PATH = ROOT_DIR / "data/cache/ranges.json"
+GENERATION_MANIFEST_FNAME = "_generation.json"
+PROFILE_REPORT_FNAME = "_profile.json"
+PROFILE_DIRNAME = "_profile"
+PROFILE_TOP_FEATURES = 5
+GENERATOR_SOURCES = (
+    Path(__file__).resolve(),
+    ROOT_DIR / "tools/aggregates.py",
+    ROOT_DIR / "tools/columnar.py",
+    ROOT_DIR / "tools/ephys_units.py",
+)
 CLUSTER_CACHE_DIRNAME = "clusters_full"
+CLUSTER_DATASET_DIRNAME = "clusters_dataset"
+CLUSTER_LOAD_FAILURES_FNAME = "cluster_load_failures.json"
+CLUSTER_LOAD_CHECKPOINT_FNAME = "cluster_load_checkpoint.json"
+CLUSTER_CHECKPOINT_INTERVAL = 50  # pids
+CLUSTER_IO_THREADS = 8
+STREAM_CHUNK_ROWS = 200_000
 CLUSTER_FEATURES = (
     "amp_max",
     "amp_min",
@@ -107,7 +162,7 @@ def get_feature_unit(fname, bucket_alias="ephys"):
 
 def save_json(d, filename):
     with open(filename, "w") as f:
-        json.dump(d, f, indent=1, sort_keys=True)
+        json.dump(d, f, separators=(",", ":"), sort_keys=True)
 
 
 def log_step(message):
@@ -145,6 +200,20 @@ def new_uuid():
     return str(uuid.UUID(int=random.getrandbits(128)))[:18]
 
 
+_atlas_index_table = None
+
+
+def atlas_ids_to_idx(atlas_ids):
+    # The lookup table is built from BrainRegions once and cached on disk, so that the
+    # atlas does not need to be loaded again for the next buckets and runs.
+    global _atlas_index_table
+    if _atlas_index_table is None:
+        _atlas_index_table = load_atlas_index_table(
+            ATLAS_INDEX_CACHE_PATH, importlib.metadata.version("iblatlas"), BrainRegions
+        )
+    return atlas_ids_to_index(_atlas_index_table, atlas_ids)
+
+
 def lateralize_features(df):
     for c in df.columns:
         if c.startswith("atlas_id"):
@@ -152,79 +221,6 @@ def lateralize_features(df):
     return df
 
 
-def get_histogram_groupby(df, n_bins=N_BINS):
-    out = {}
-    feature_names = df.obj.select_dtypes(include=[np.number]).columns
-    bin_edges = {}
-    for fname in feature_names:
-        values = df.obj[fname].dropna()
-        if values.empty:
-            bin_edges[fname] = np.linspace(0, 1, n_bins + 1)
-            continue
-        vmin, vmax = compute_range(values)
-        bin_edges[fname] = np.histogram_bin_edges(values, range=(vmin, vmax), bins=n_bins)
-
-    group_hist_data = {bin_idx: {} for bin_idx in range(n_bins)}
-    for group_name, group_df in df:
-        for col in feature_names:
-            counts, _ = np.histogram(group_df[col].dropna(), bins=bin_edges[col])
-            for bin_idx in range(n_bins):
-                if group_name not in group_hist_data[bin_idx]:
-                    group_hist_data[bin_idx][group_name] = {}
-                group_hist_data[bin_idx][group_name][col] = counts[bin_idx]
-
-    for bin_idx in range(n_bins):
-        v = pd.DataFrame.from_dict(group_hist_data[bin_idx], orient="index").astype(np.int32)
-        out[f"h_{bin_idx:03}"] = v
-
-    return out, bin_edges
-
-
-def get_uncertainty(df):
-    q5 = df.quantile(0.05)
-    q95 = df.quantile(0.95)
-    median = df.median()
-    mean = df.mean()
-
-    ci_width = q95 - q5
-    uncertainty = (median - mean) / ci_width
-    uncertainty[np.isnan(uncertainty)] = 0
-    return uncertainty
-
-
-def get_aggregates(df):
-    out = {
-        "mean": df.mean(numeric_only=True),
-        "median": df.median(numeric_only=True),
-        "std": df.std(ddof=0, numeric_only=True),
-        "min": df.min(),
-        "max": df.max(),
-        "count": df.count().astype(np.int32),
-    }
-    out["uncertainty"] = get_uncertainty(df)
-    hist, bin_edges = get_histogram_groupby(df, n_bins=N_BINS)
-    out.update(hist)
-    return out, bin_edges
-
-
-def compute_range(values, q=RANGE_QUANTILE):
-    values = pd.Series(values).replace([np.inf, -np.inf], np.nan).dropna()
-    if values.empty:
-        return 0.0, 1.0
-
-    vmin = float(values.quantile(q))
-    vmax = float(values.quantile(1 - q))
-
-    if not np.isfinite(vmin) or not np.isfinite(vmax) or vmin >= vmax:
-        vmin = float(values.min())
-        vmax = float(values.max())
-
-    if not np.isfinite(vmin) or not np.isfinite(vmax) or vmin >= vmax:
-        vmax = vmin + 1e-12
-
-    return vmin, vmax
-
-
 def clean(payload):
     if not isinstance(payload, dict):
         return payload
@@ -242,15 +238,39 @@ def clean(payload):
     return cleaned
 
 
+def clean_region_values(region_values):
+    """Return clean(region_values) for the flat {stat: value} dict of a region.
+
+    Scalars, which are nearly all the values of a region, are handled inline instead of
+    through a recursive clean() call per value.
+    """
+    cleaned = {}
+    for key, value in region_values.items():
+        if isinstance(value, float):
+            if value == 0 and isinstance(key, str) and key.startswith("h_"):
+                continue
+            if value.is_integer():
+                value = int(value)
+        elif isinstance(value, (dict, list, np.ndarray)):
+            cleaned.update(clean({key: value}))
+            continue
+        elif value == 0 and isinstance(key, str) and key.startswith("h_"):
+            continue
+        cleaned[key] = value
+    return cleaned
+
+
 def _safe_stats_from_mapping_data(data, stat_name):
-    values = [
-        row.get(stat_name)
-        for row in data.values()
-        if isinstance(row, dict) and row.get(stat_name) is not None
-    ]
-    if not values:
+    arr = np.fromiter(
+        (
+            row[stat_name]
+            for row in data.values()
+            if isinstance(row, dict) and row.get(stat_name) is not None
+        ),
+        dtype=float,
+    )
+    if not arr.size:
         return {"min": None, "max": None, "mean": None, "median": None, "std": None}
-    arr = np.asarray(values, dtype=float)
     return clean(
         {
             "min": float(arr.min()),
@@ -262,21 +282,56 @@ def _safe_stats_from_mapping_data(data, stat_name):
     )
 
 
+def add_weighted_payload_histogram(payload, values, weights, vmin, vmax, n_bins=N_BINS):
+    """Weighted counterpart of api.add_payload_histogram(), for the values of a RegionAccumulator.
+
+    Each value stands for weight values of the feature: they are counted with their weights
+    rather than repeated, so that the histogram takes memory bounded by the accumulator
+    state. Only the fields read by the frontend are written: vmin, vmax, counts and
+    total_count.
+    """
+    finite = np.isfinite(values)
+    values, weights = values[finite], weights[finite]
+    counts, _ = np.histogram(values, bins=n_bins, range=(vmin, vmax), weights=weights)
+    payload["feature_data"]["histogram"] = {
+        "vmin": float(vmin),
+        "vmax": float(vmax),
+        "counts": counts.astype(np.int64).tolist(),
+        "total_count": int(weights.sum()),
+    }
+
+
 def normalize_payload(payload):
-    payload = clean(payload)
+    """Return the cleaned payload, without the empty regions of its mappings.
+
+    The region data of the mappings holds nearly all the values of a payload: it is set
+    aside while clean() walks the rest of the payload, then cleaned and filtered in a
+    single pass over the regions.
+    """
     mappings = payload.get("feature_data", {}).get("mappings", {})
+    region_data = {name: mapping_payload.get("data", {}) for name, mapping_payload in mappings.items()}
     for mapping_payload in mappings.values():
-        data = mapping_payload.get("data", {})
+        if "data" in mapping_payload:
+            mapping_payload["data"] = {}
+    try:
+        cleaned = clean(payload)
+    finally:
+        for name, mapping_payload in mappings.items():
+            if "data" in mapping_payload:
+                mapping_payload["data"] = region_data[name]
+
+    for name, mapping_payload in cleaned.get("feature_data", {}).get("mappings", {}).items():
         filtered = {}
-        for region_id, region_values in data.items():
+        for region_id, region_values in region_data[name].items():
             if not isinstance(region_values, dict):
-                filtered[region_id] = region_values
+                filtered.update(clean({region_id: region_values}))
                 continue
+            region_values = clean_region_values(region_values)
             if region_values.get("uncertainty") is None:
                 region_values["uncertainty"] = 0
-            count = region_values.get("count")
-            numeric_stats = [region_values.get(k) for k in ("min", "max", "mean", "median", "std")]
-            if count == 0 and all(v is None for v in numeric_stats):
+            if region_values.get("count") == 0 and all(
+                region_values.get(k) is None for k in ("min", "max", "mean", "median", "std")
+            ):
                 continue
             filtered[region_id] = region_values
         mapping_payload["data"] = filtered
@@ -285,7 +340,29 @@ def normalize_payload(payload):
         for stat_name, stat_obj in list(statistics.items()):
             if isinstance(stat_obj, dict) and any(v is None for v in stat_obj.values()):
                 statistics[stat_name] = _safe_stats_from_mapping_data(filtered, stat_name)
-    return payload
+    return cleaned
+
+
+def json_default(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def save_feature_payload(output_dir, fname, payload):
+    """Write a normalized payload in the compact on-disk format, with its compressed siblings.
+
+    The payload is serialized once, instead of being written by api.save_payload() and then
+    read back and rewritten by compact_features_file().
+    """
+    path = Path(output_dir) / f"{fname}.json"
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(payload, f, separators=FEATURES_JSON_SEPARATORS, default=json_default)
+    tmp_path.replace(path)
+    write_compressed_siblings(path, best=True)
 
 
 def ensure_bucket(alias, short_desc):
@@ -314,7 +391,6 @@ def ensure_bucket(alias, short_desc):
 
 
 def prepare_region_dataframe(df, feature_names):
-    br = BrainRegions()
     df = df.copy()
     missing = [col for col in ("atlas_id", "acronym") if col not in df.columns]
     if missing:
@@ -330,12 +406,99 @@ def prepare_region_dataframe(df, feature_names):
     df["atlas_id"] = pd.to_numeric(df["atlas_id"], errors="coerce")
     df = df.dropna(subset=["atlas_id"])
     df["atlas_id"] = df["atlas_id"].astype(np.int32)
-    df["atlas_idx"] = np.array([_[0] for _ in br.id2index(df.atlas_id)[1]], dtype=np.int32)
+    df["atlas_idx"] = atlas_ids_to_idx(df["atlas_id"].to_numpy())
     df = lateralize_features(df)
     df = df[~df["acronym"].isin(["void", "root"])].copy()
     return df, available_features
 
 
+def get_code_fingerprint():
+    # Sources that shape the feature payloads: changing any of them regenerates all features.
+    h = hashlib.sha1()
+    for path in GENERATOR_SOURCES + (Path(api.__file__),):
+        h.update(Path(path).read_bytes())
+    return h.hexdigest()
+
+
+def get_feature_fingerprint(df, fname, params):
+    h = hashlib.sha1()
+    h.update(json.dumps({**params, "fname": fname}, sort_keys=True).encode())
+    if isinstance(df, RegionAccumulator):
+        # The accumulator hashes the values of each column and their atlas_idx as they stream by.
+        h.update(df.fingerprint([fname, "atlas_id"]).encode())
+    else:
+        h.update(pd.util.hash_pandas_object(df[[fname, "atlas_id", "atlas_idx"]], index=False).values.tobytes())
+    return h.hexdigest()
+
+
+def load_generation_manifest(path):
+    """Return the {fname: fingerprint} of the features written by a previous run."""
+    if not path.exists():
+        return {}
+    try:
+        return json.loads(path.read_text())
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+# Aggregates shared with the feature writer processes, see write_region_bucket().
+_region_bucket_context = None
+
+
+def write_region_feature(fname):
+    """Write the payload of a feature, and return the profiler records of its stages."""
+    ctx = _region_bucket_context
+    rows = ctx["rows"]
+    key = ctx["key"]
+    output_dir = ctx["output_dir"]
+    df_extra_values = ctx["df_extra_values"]
+    profiler = GenerationProfiler()
+    profile = cProfile.Profile() if ctx["profile_dir"] else None
+
+    def remap(stat, vs):
+        agg_kind = "sum" if stat in ("count",) or stat.startswith("h_") else "mean"
+        return api.make_features(ctx["atlas_ids"], vs, hemisphere=ctx["hemisphere"], agg=agg_kind)
+
+    if profile is not None:
+        profile.enable()
+    try:
+        vmin, vmax = ctx["ranges"][fname]
+
+        with profiler.stage("remap", fname):
+            data = remap(key, ctx["df_values"][fname])
+            extra_values = {
+                stat: remap(stat, df_extra_values[stat][fname].values)
+                for stat in df_extra_values.keys()
+            }
+
+        with profiler.stage("payload", fname):
+            payload = api.make_features_payload(
+                fname,
+                data,
+                short_desc=f"{ctx['short_desc_prefix']}: {fname}",
+                key=key,
+                extra_values=extra_values,
+            )
+            payload["unit"] = get_feature_unit(fname, bucket_alias=ctx["bucket_alias"])
+            if isinstance(rows, RegionAccumulator):
+                add_weighted_payload_histogram(payload, *rows.weighted_values(fname), vmin, vmax)
+            else:
+                api.add_payload_histogram(payload, rows[fname], vmin, vmax)
+
+        with profiler.stage("normalize", fname):
+            payload = normalize_payload(payload)
+            if ctx["columnar"]:
+                columnarize_payload(payload)
+
+        with profiler.stage("serialize", fname):
+            save_feature_payload(output_dir, fname, payload)
+    finally:
+        if profile is not None:
+            profile.disable()
+            profile.dump_stats(ctx["profile_dir"] / f"{fname}.pstats")
+    return profiler.records
+
+
 def make_region_bucket_from_df(
     df,
     feature_names,
@@ -344,72 +507,292 @@ def make_region_bucket_from_df(
     short_desc_prefix="Ephys atlas feature",
     key="mean",
     n_jobs=1,
+    columnar=False,
+    force=False,
+    profiler=None,
+    profile=False,
 ):
-    hemisphere = "left"
+    profiler = GenerationProfiler() if profiler is None else profiler
     log_step(f"Preparing dataframe for bucket `{bucket_alias}`")
-    df, feature_names = prepare_region_dataframe(df, feature_names)
+    with profiler.stage("prepare"):
+        df, feature_names = prepare_region_dataframe(df, feature_names)
+    return write_region_bucket(
+        df,
+        feature_names,
+        output_dir,
+        bucket_alias=bucket_alias,
+        short_desc_prefix=short_desc_prefix,
+        key=key,
+        n_jobs=n_jobs,
+        columnar=columnar,
+        force=force,
+        profiler=profiler,
+        profile=profile,
+    )
+
+
+def make_region_bucket_from_chunks(
+    chunks,
+    feature_names,
+    output_dir,
+    bucket_alias="ephys",
+    short_desc_prefix="Ephys atlas feature",
+    key="mean",
+    n_jobs=1,
+    columnar=False,
+    force=False,
+    profiler=None,
+    profile=False,
+    range_sketch=None,
+):
+    """Streaming counterpart of make_region_bucket_from_df(), for tables larger than memory.
+
+    chunks is an iterable of dataframes, e.g. parquet record batches or per-pid tables. Each
+    chunk is prepared on its own and added to a RegionAccumulator, whose per-region state
+    does not grow with the rows. Counts, means, standard deviations, minima and maxima are
+    the same as with make_region_bucket_from_df(); medians, uncertainties and histograms
+    are exact for the regions of at most REGION_SKETCH_SIZE rows, and approximate beyond.
+
+    The histogram ranges come from quantile sketches of range_sketch values per level
+    (SKETCH_SIZE by default), updated chunk by chunk.
+    """
+    profiler = GenerationProfiler() if profiler is None else profiler
+    log_step(f"Streaming row chunks for bucket `{bucket_alias}`")
+    rows = None
+    chunks = iter(tqdm(chunks, desc=f"{bucket_alias}: chunks", unit="chunk"))
+    while True:
+        with profiler.stage("read"):
+            chunk = next(chunks, None)
+        if chunk is None:
+            break
+        with profiler.stage("prepare"):
+            chunk, available = prepare_region_dataframe(chunk, feature_names)
+            if rows is None:
+                feature_names = available
+                rows = RegionAccumulator(feature_names + ["atlas_id"], sketch_size=range_sketch or SKETCH_SIZE)
+            rows.update(chunk)
+    if rows is None:
+        raise ValueError("No rows to aggregate")
+    return write_region_bucket(
+        rows,
+        feature_names,
+        output_dir,
+        bucket_alias=bucket_alias,
+        short_desc_prefix=short_desc_prefix,
+        key=key,
+        n_jobs=n_jobs,
+        columnar=columnar,
+        force=force,
+        profiler=profiler,
+        profile=profile,
+    )
+
+
+def save_generation_profile(profiler, output_dir, profile_dir=None):
+    """Write the profiler report next to the bucket features and log its summary.
+
+    Only the cProfile stats of the PROFILE_TOP_FEATURES slowest features are kept.
+    """
+    report_path = Path(output_dir) / PROFILE_REPORT_FNAME
+    profiler.save(report_path)
+    log_step(f"Generation profile written to {report_path}\n{profiler.summary(PROFILE_TOP_FEATURES)}")
+    if profile_dir is None:
+        return
+    slowest = profiler.slowest_features(PROFILE_TOP_FEATURES)
+    for path in profile_dir.glob("*.pstats"):
+        if path.stem not in slowest:
+            path.unlink()
+    for fname in slowest[:1]:
+        log_step(f"cProfile of the slowest feature `{fname}` (all stats in {profile_dir})")
+        pstats.Stats(str(profile_dir / f"{fname}.pstats")).sort_stats("cumulative").print_stats(15)
+
+
+def write_region_bucket(
+    rows,
+    feature_names,
+    output_dir,
+    bucket_alias="ephys",
+    short_desc_prefix="Ephys atlas feature",
+    key="mean",
+    n_jobs=1,
+    columnar=False,
+    force=False,
+    profiler=None,
+    profile=False,
+):
+    """Aggregate the prepared rows per region and write one payload per feature.
+
+    rows is a dataframe from prepare_region_dataframe(), or a RegionAccumulator of
+    prepared chunks. The stage timings are added to profiler and written to
+    PROFILE_REPORT_FNAME in output_dir. With profile, each feature is also run under
+    cProfile, see save_generation_profile().
+    """
+    global _region_bucket_context
+    profiler = GenerationProfiler() if profiler is None else profiler
+    profile_dir = None
+    if profile:
+        profile_dir = Path(output_dir) / PROFILE_DIRNAME
+        profile_dir.mkdir(exist_ok=True)
+        for path in profile_dir.glob("*.pstats"):
+            path.unlink()
+    hemisphere = "left"
+    n_regions = rows.n_groups if isinstance(rows, RegionAccumulator) else rows["atlas_idx"].nunique()
     log_step(
-        f"Prepared {len(df):,} rows across {df['atlas_idx'].nunique():,} atlas regions; "
-        f"{len(feature_names)} features to write"
+        f"Prepared {len(rows):,} rows across {n_regions:,} atlas regions; "
+        f"{len(feature_names)} features"
     )
     print("Feature names:", ", ".join(feature_names), flush=True)
 
+    # Only regenerate the features whose inputs, parameters or generator code changed.
+    log_step("Fingerprinting feature inputs")
+    manifest_path = Path(output_dir) / GENERATION_MANIFEST_FNAME
+    manifest = load_generation_manifest(manifest_path)
+    params = {
+        "code": get_code_fingerprint(),
+        "n_bins": N_BINS,
+        "range_quantile": RANGE_QUANTILE,
+        "key": key,
+        "hemisphere": hemisphere,
+        "bucket_alias": bucket_alias,
+        "short_desc_prefix": short_desc_prefix,
+        "columnar": columnar,
+    }
+    sketch_size = rows.sketch_size if isinstance(rows, RegionAccumulator) else None
+    if sketch_size:
+        params["range_sketch"] = sketch_size
+        params["region_sketch"] = rows.region_sketch_size
+    with profiler.stage("fingerprint"):
+        fingerprints = {fname: get_feature_fingerprint(rows, fname, params) for fname in feature_names}
+    unchanged = [
+        fname for fname in feature_names
+        if not force
+        and manifest.get(fname) == fingerprints[fname]
+        and (Path(output_dir) / f"{fname}.json").exists()
+    ]
+    feature_names = [fname for fname in feature_names if fname not in unchanged]
+    log_step(f"{len(feature_names)} features to write, {len(unchanged)} up to date")
+    if not feature_names:
+        save_generation_profile(profiler, output_dir, profile_dir)
+        return rows
+
+    # The ranges of the features are computed once, for both the regional histograms and
+    # the payload histograms. Exact ranges are cached across runs by column contents.
+    log_step("Computing feature ranges" + (f" from quantile sketches (k={sketch_size})" if sketch_size else ""))
+    with profiler.stage("ranges"):
+        range_cache = RangeCache(RANGE_CACHE_PATH)
+        if isinstance(rows, RegionAccumulator):
+            ranges = rows.ranges(feature_names, cache=range_cache)
+        else:
+            ranges = compute_ranges({fname: rows[fname] for fname in feature_names}, cache=range_cache)
+        range_cache.save()
+
     log_step("Computing grouped regional aggregates")
-    df_grouped = df[feature_names + ["atlas_id", "atlas_idx"]].groupby("atlas_idx")
-    agg, _ = get_aggregates(df_grouped)
+    if isinstance(rows, RegionAccumulator):
+        with profiler.stage("aggregates"):
+            agg = rows.statistics(feature_names + ["atlas_id"])
+        with profiler.stage("histograms"):
+            hist, _ = rows.histograms(feature_names + ["atlas_id"], ranges=ranges)
+    else:
+        df_grouped = rows[feature_names + ["atlas_id", "atlas_idx"]].groupby("atlas_idx")
+        with profiler.stage("aggregates"):
+            agg = get_statistics(df_grouped)
+        with profiler.stage("histograms"):
+            hist, _ = get_histogram_groupby(df_grouped, ranges=ranges)
+    agg.update(hist)
     df_values = agg[key]
     atlas_ids = df_values["atlas_id"]
     agg.pop(key)
     df_extra_values = agg
 
-    def remap(stat, vs):
-        agg_kind = "sum" if stat in ("count",) or stat.startswith("h_") else "mean"
-        return api.make_features(atlas_ids, vs, hemisphere=hemisphere, agg=agg_kind)
-
-    def process_fname(fname):
-        values = df_values[fname]
-        vmin, vmax = compute_range(df[fname])
+    _region_bucket_context = {
+        "rows": rows,
+        "df_values": df_values,
+        "df_extra_values": df_extra_values,
+        "atlas_ids": atlas_ids,
+        "ranges": ranges,
+        "hemisphere": hemisphere,
+        "output_dir": output_dir,
+        "bucket_alias": bucket_alias,
+        "short_desc_prefix": short_desc_prefix,
+        "key": key,
+        "columnar": columnar,
+        "profile_dir": profile_dir,
+    }
+    n_workers = min(effective_n_jobs(n_jobs), len(feature_names))
+    if n_workers > 1 and "fork" not in multiprocessing.get_all_start_methods():
+        log_step(f"Process forking is not available; writing features with n_jobs=1 (requested n_jobs={n_jobs})")
+        n_workers = 1
+
+    log_step(f"Writing {len(feature_names)} feature payloads to {output_dir} ({n_workers} workers)")
+    progress = tqdm(total=len(feature_names), desc=f"{bucket_alias}: features", unit="feature")
+    try:
+        if n_workers <= 1:
+            for fname in feature_names:
+                profiler.extend(write_region_feature(fname))
+                manifest[fname] = fingerprints[fname]
+                write_json_atomic(manifest_path, manifest, compact=True)
+                progress.update()
+        else:
+            # Forked workers inherit the aggregates through _region_bucket_context, and
+            # each writes whole feature files, so the output does not depend on n_jobs.
+            mp_context = multiprocessing.get_context("fork")
+            with ProcessPoolExecutor(max_workers=n_workers, mp_context=mp_context) as pool:
+                futures = {pool.submit(write_region_feature, fname): fname for fname in feature_names}
+                for future in as_completed(futures):
+                    profiler.extend(future.result())
+                    fname = futures[future]
+                    manifest[fname] = fingerprints[fname]
+                    write_json_atomic(manifest_path, manifest, compact=True)
+                    progress.set_postfix_str(fname)
+                    progress.update()
+    finally:
+        progress.close()
+        _region_bucket_context = None
+    log_step(
+        f"Finished writing feature payloads for `{bucket_alias}`: rebuilt {len(feature_names)} "
+        f"({', '.join(feature_names)}), skipped {len(unchanged)} unchanged"
+    )
+    save_generation_profile(profiler, output_dir, profile_dir)
+    return rows
 
-        data = remap(key, values)
-        extra_values = {
-            stat: remap(stat, df_extra_values[stat][fname].values)
-            for stat in df_extra_values.keys()
-        }
 
-        payload = api.make_features_payload(
-            fname,
-            data,
-            short_desc=f"{short_desc_prefix}: {fname}",
-            key=key,
-            extra_values=extra_values,
-        )
-        payload["unit"] = get_feature_unit(fname, bucket_alias=bucket_alias)
-        api.add_payload_histogram(payload, df[fname], vmin, vmax)
-        payload = normalize_payload(payload)
-        api.save_payload(output_dir, fname, payload)
-
-    if n_jobs != 1:
-        log_step(
-            f"Progress reporting is most reliable in sequential mode; writing features with n_jobs=1 "
-            f"(requested n_jobs={n_jobs})"
-        )
-    log_step(f"Writing {len(feature_names)} feature payloads to {output_dir}")
-    for fname in tqdm(feature_names, desc=f"{bucket_alias}: features", unit="feature"):
-        process_fname(fname)
-    log_step(f"Finished writing feature payloads for `{bucket_alias}`")
-    return df
+def iter_row_chunks(df, chunk_rows=STREAM_CHUNK_ROWS):
+    for start in range(0, len(df), chunk_rows):
+        yield df.iloc[start:start + chunk_rows]
 
 
-def make_ephys_data(local_data_path, output_dir=None, short_desc=None, key="mean", n_jobs=1):
-    df_voltage = read_features_from_disk(local_data_path)
-    return make_region_bucket_from_df(
-        df_voltage,
-        voltage_features_set(),
+def make_ephys_data(
+    local_data_path,
+    output_dir=None,
+    short_desc=None,
+    key="mean",
+    n_jobs=1,
+    columnar=False,
+    force=False,
+    streaming=False,
+    profile=False,
+    range_sketch=None,
+):
+    profiler = GenerationProfiler()
+    kwargs = dict(
         output_dir=output_dir,
         bucket_alias="ephys",
         short_desc_prefix=short_desc or "Ephys atlas feature",
         key=key,
         n_jobs=n_jobs,
+        columnar=columnar,
+        force=force,
+        profiler=profiler,
+        profile=profile,
+    )
+    with profiler.stage("read"):
+        df_voltage = read_features_from_disk(local_data_path)
+    if not streaming:
+        return make_region_bucket_from_df(df_voltage, voltage_features_set(), **kwargs)
+    # read_features_from_disk() returns the whole table, so streaming does not bound the input
+    # memory of this bucket: it only bounds the aggregation state, and copies a slice at a time.
+    return make_region_bucket_from_chunks(
+        iter_row_chunks(df_voltage), voltage_features_set(), range_sketch=range_sketch, **kwargs
     )
 
 
@@ -418,98 +801,237 @@ def get_project_pids(one, project=DEFAULT_PROJECT, tracing=True):
     return pids
 
 
-def load_clusters_dataframe(
+def load_cluster_checkpoint(path, spike_sorter, recompute_metrics):
+    """Return the {pid: status} of an interrupted load_clusters_dataframe() run with the same settings."""
+    if not path.exists():
+        return {}
+    try:
+        checkpoint = json.loads(path.read_text())
+    except (OSError, json.JSONDecodeError):
+        return {}
+    if checkpoint.get("spike_sorter") != spike_sorter or checkpoint.get("recompute_metrics") != recompute_metrics:
+        return {}
+    return checkpoint.get("pids", {})
+
+
+def save_cluster_checkpoint(path, statuses, spike_sorter, recompute_metrics):
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    save_json(
+        {"spike_sorter": spike_sorter, "recompute_metrics": recompute_metrics, "pids": statuses},
+        tmp_path,
+    )
+    tmp_path.replace(path)
+
+
+def read_pid_clusters(pid):
+    # Per-pid clusters.pqt tables of older caches are moved into the dataset.
+    ctx = _cluster_loader_context
+    df = pd.read_parquet(ctx["cache_root"] / pid / "clusters.pqt")
+    write_cluster_partition(ctx["dataset_dir"], pid, df)
+    return "cached", len(df)
+
+
+def compute_pid_clusters(pid):
+    """Merge the spike sorting clusters of a pid and add them to the cluster dataset.
+
+    Return ("computed", n_rows), or ("skipped", reason) if the pid has no usable clusters.
+    """
+    ctx = _cluster_loader_context
+    probe_cache_dir = ctx["cache_root"] / pid
+    probe_cache_dir.mkdir(parents=True, exist_ok=True)
+
+    ssl = SpikeSortingLoader(pid=pid, one=ctx["one"])
+    spikes, clusters, channels = ssl.load_spike_sorting(spike_sorter=ctx["spike_sorter"])
+    if not clusters or not channels:
+        return "skipped", "missing clusters or channels"
+    merged = ssl.merge_clusters(
+        spikes,
+        clusters,
+        channels,
+        cache_dir=probe_cache_dir,
+        compute_metrics=ctx["recompute_metrics"],
+    )
+    if merged is None:
+        return "skipped", "no merged clusters"
+    df = pd.DataFrame(merged)
+    write_cluster_partition(ctx["dataset_dir"], pid, df)
+    return "computed", len(df)
+
+
+def iter_bounded(executor, fn, items, max_pending):
+    """Yield (item, future) for fn(item) as they complete, with at most max_pending tasks in flight."""
+    items = iter(items)
+    pending = {}
+
+    def submit_next():
+        for item in items:
+            pending[executor.submit(fn, item)] = item
+            return
+
+    for _ in range(max_pending):
+        submit_next()
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            item = pending.pop(future)
+            submit_next()
+            yield item, future
+
+
+# State shared with the cluster loader threads and processes, see load_clusters_dataframe().
+_cluster_loader_context = None
+
+
+def update_cluster_dataset(
     one,
     pids,
     cache_root,
     recompute_metrics=False,
     spike_sorter="iblsorter",
+    n_jobs=1,
 ):
+    """Add the missing pids to the cluster dataset, and return (dataset_dir, loaded pids)."""
+    global _cluster_loader_context
     cache_root = Path(cache_root)
     cache_root.mkdir(parents=True, exist_ok=True)
-    dfs = []
+    dataset_dir = cache_root / CLUSTER_DATASET_DIRNAME
+    failure_file = cache_root / CLUSTER_LOAD_FAILURES_FNAME
+    checkpoint_file = cache_root / CLUSTER_LOAD_CHECKPOINT_FNAME
+    loaded = set()
+    n_rows = 0
     stats = {"cached": 0, "computed": 0, "skipped": 0, "failed": 0}
     failures = []
 
-    log_step(f"Loading cluster data for {len(pids):,} insertions into cache {cache_root}")
-    pbar = tqdm(pids, desc="ephys_clusters: pids", unit="pid")
-    for pid in pbar:
+    # Resume an interrupted run: pids already merged in that run are read back from the dataset
+    # even with recompute_metrics, and skipped pids are not retried. Failed pids are retried.
+    statuses = load_cluster_checkpoint(checkpoint_file, spike_sorter, recompute_metrics)
+    statuses = {pid: status for pid, status in statuses.items() if status in ("computed", "skipped")}
+    if statuses:
+        log_step(f"Resuming from {checkpoint_file}: {len(statuses):,} pids already processed")
+
+    partitions = list_cluster_partitions(dataset_dir)
+    to_read, to_compute = [], []
+    for pid in pids:
+        status = statuses.get(pid)
+        reuse = not recompute_metrics or status == "computed"
+        if status == "skipped":
+            stats["skipped"] += 1
+        elif pid in partitions and reuse:
+            stats["cached"] += 1
+            loaded.add(pid)
+        elif (cache_root / pid / "clusters.pqt").exists() and reuse:
+            to_read.append(pid)
+        else:
+            to_compute.append(pid)
+
+    n_workers = min(effective_n_jobs(n_jobs), max(len(to_compute), 1))
+    if n_workers > 1 and "fork" not in multiprocessing.get_all_start_methods():
+        n_workers = 1
+    log_step(
+        f"Loading cluster data for {len(pids):,} insertions into cache {cache_root} "
+        f"({stats['cached']:,} in dataset, {len(to_read):,} per-pid tables to import, "
+        f"{len(to_compute):,} to compute with {n_workers} workers)"
+    )
+    _cluster_loader_context = {
+        "one": one,
+        "cache_root": cache_root,
+        "dataset_dir": dataset_dir,
+        "spike_sorter": spike_sorter,
+        "recompute_metrics": recompute_metrics,
+    }
+    pbar = tqdm(
+        total=len(pids), initial=stats["skipped"] + stats["cached"], desc="ephys_clusters: pids", unit="pid"
+    )
+
+    unsaved = 0
+
+    def handle(pid, future):
+        nonlocal n_rows, unsaved
         try:
-            probe_cache_dir = cache_root / pid
-            probe_cache_dir.mkdir(parents=True, exist_ok=True)
-            cache_file = probe_cache_dir / "clusters.pqt"
-
-            if cache_file.exists() and not recompute_metrics:
-                df = pd.read_parquet(cache_file)
-                stats["cached"] += 1
-                source = "cached"
-            else:
-                ssl = SpikeSortingLoader(pid=pid, one=one)
-                spikes, clusters, channels = ssl.load_spike_sorting(spike_sorter=spike_sorter)
-                if not clusters or not channels:
-                    stats["skipped"] += 1
-                    pbar.write(f"Skipping {pid}: missing clusters or channels")
-                    continue
-                merged = ssl.merge_clusters(
-                    spikes,
-                    clusters,
-                    channels,
-                    cache_dir=probe_cache_dir,
-                    compute_metrics=recompute_metrics,
-                )
-                if merged is None:
-                    stats["skipped"] += 1
-                    pbar.write(f"Skipping {pid}: no merged clusters")
-                    continue
-                df = pd.DataFrame(merged)
-                if not cache_file.exists():
-                    df.to_parquet(cache_file)
-                stats["computed"] += 1
-                source = "computed"
-
-            if "pid" not in df.columns:
-                df["pid"] = pid
-            dfs.append(df)
-            pbar.set_postfix(
-                rows=f"{sum(len(d) for d in dfs):,}",
-                cached=stats["cached"],
-                computed=stats["computed"],
-                failed=stats["failed"],
-                source=source,
-            )
-        except KeyboardInterrupt:
-            raise
+            source, result = future.result()
         except Exception as e:
+            source = "error"
             stats["failed"] += 1
-            failure = {
-                "pid": pid,
-                "error_type": type(e).__name__,
-                "error": str(e),
-            }
-            failures.append(failure)
+            failures.append({"pid": pid, "error_type": type(e).__name__, "error": str(e)})
             pbar.write(f"Failed {pid}: {type(e).__name__}: {e}")
-            failure_file = cache_root / "cluster_load_failures.json"
             save_json(failures, failure_file)
-            pbar.set_postfix(
-                rows=f"{sum(len(d) for d in dfs):,}",
-                cached=stats["cached"],
-                computed=stats["computed"],
-                failed=stats["failed"],
-                source="error",
-            )
-            continue
-
-    if not dfs:
+        else:
+            stats[source] += 1
+            if source == "skipped":
+                pbar.write(f"Skipping {pid}: {result}")
+                statuses[pid] = "skipped"
+                unsaved += 1
+            else:
+                loaded.add(pid)
+                n_rows += result
+                if source == "computed":
+                    statuses[pid] = "computed"
+                    unsaved += 1
+        pbar.update()
+        pbar.set_postfix(
+            rows=f"{n_rows:,}",
+            cached=stats["cached"],
+            computed=stats["computed"],
+            failed=stats["failed"],
+            source=source,
+        )
+        if unsaved >= CLUSTER_CHECKPOINT_INTERVAL:
+            save_cluster_checkpoint(checkpoint_file, statuses, spike_sorter, recompute_metrics)
+            unsaved = 0
+
+    try:
+        # Per-pid tables are imported by threads, merging runs in forked processes.
+        with ThreadPoolExecutor(max_workers=CLUSTER_IO_THREADS) as executor:
+            for pid, future in iter_bounded(executor, read_pid_clusters, to_read, 2 * CLUSTER_IO_THREADS):
+                handle(pid, future)
+        if n_workers > 1:
+            executor = ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("fork"))
+        else:
+            executor = ThreadPoolExecutor(max_workers=1)
+        with executor:
+            for pid, future in iter_bounded(executor, compute_pid_clusters, to_compute, 2 * n_workers):
+                handle(pid, future)
+    except BaseException:
+        save_cluster_checkpoint(checkpoint_file, statuses, spike_sorter, recompute_metrics)
+        raise
+    finally:
+        pbar.close()
+        _cluster_loader_context = None
+
+    if not loaded:
+        save_cluster_checkpoint(checkpoint_file, statuses, spike_sorter, recompute_metrics)
         raise RuntimeError("No cluster dataframes could be loaded")
     if failures:
-        failure_file = cache_root / "cluster_load_failures.json"
-        save_json(failures, failure_file)
+        # Keep the checkpoint so that the next run only retries the failed pids.
+        save_cluster_checkpoint(checkpoint_file, statuses, spike_sorter, recompute_metrics)
         log_step(f"Recorded {len(failures)} PID failures in {failure_file}")
+    elif checkpoint_file.exists():
+        checkpoint_file.unlink()
     log_step(
-        f"Loaded {len(dfs):,} pid tables ({stats['cached']} cached, {stats['computed']} computed, "
-        f"{stats['skipped']} skipped, {stats['failed']} failed)"
+        f"Loading {len(loaded):,} pid tables from {dataset_dir} ({stats['cached']} cached, "
+        f"{stats['computed']} computed, {stats['skipped']} skipped, {stats['failed']} failed)"
+    )
+    return dataset_dir, loaded
+
+
+def load_clusters_dataframe(
+    one,
+    pids,
+    cache_root,
+    recompute_metrics=False,
+    spike_sorter="iblsorter",
+    n_jobs=1,
+    columns=None,
+):
+    dataset_dir, loaded = update_cluster_dataset(
+        one,
+        pids,
+        cache_root,
+        recompute_metrics=recompute_metrics,
+        spike_sorter=spike_sorter,
+        n_jobs=n_jobs,
     )
-    return pd.concat(dfs, ignore_index=True)
+    return read_cluster_dataset(dataset_dir, loaded, columns=columns)
 
 
 def make_ephys_clusters_data(
@@ -522,21 +1044,54 @@ def make_ephys_clusters_data(
     spike_sorter="iblsorter",
     key="mean",
     n_jobs=1,
+    columnar=False,
+    force=False,
+    streaming=False,
+    profile=False,
+    range_sketch=None,
 ):
+    profiler = GenerationProfiler()
     log_step(f"Enumerating atlas insertions for project `{project}`")
-    pids = get_project_pids(one, project=project, tracing=tracing)
+    with profiler.stage("pids"):
+        pids = get_project_pids(one, project=project, tracing=tracing)
     log_step(f"Found {len(pids):,} insertions")
-    df_clusters = load_clusters_dataframe(
-        one=one,
-        pids=pids,
-        cache_root=cache_root,
-        recompute_metrics=recompute_metrics,
-        spike_sorter=spike_sorter,
-    )
-
     keep = ["pid", "atlas_id", "acronym", *CLUSTER_FEATURES]
+    if streaming:
+        # The dataset is aggregated one record batch at a time, each holding a single pid.
+        with profiler.stage("load"):
+            dataset_dir, loaded = update_cluster_dataset(
+                one,
+                pids,
+                cache_root,
+                recompute_metrics=recompute_metrics,
+                spike_sorter=spike_sorter,
+                n_jobs=n_jobs,
+            )
+        return make_region_bucket_from_chunks(
+            iter_cluster_dataset(dataset_dir, loaded, columns=keep),
+            CLUSTER_FEATURES,
+            output_dir=output_dir,
+            bucket_alias="ephys_clusters",
+            short_desc_prefix="Ephys cluster feature",
+            key=key,
+            n_jobs=n_jobs,
+            columnar=columnar,
+            force=force,
+            profiler=profiler,
+            profile=profile,
+            range_sketch=range_sketch,
+        )
+    with profiler.stage("load"):
+        df_clusters = load_clusters_dataframe(
+            one=one,
+            pids=pids,
+            cache_root=cache_root,
+            recompute_metrics=recompute_metrics,
+            spike_sorter=spike_sorter,
+            n_jobs=n_jobs,
+            columns=keep,
+        )
     available = [col for col in keep if col in df_clusters.columns]
-    df_clusters = df_clusters[available].copy()
     log_step(
         f"Cluster dataframe ready: {len(df_clusters):,} rows, {df_clusters['pid'].nunique():,} pids, "
         f"{len(available) - 3} feature columns"
@@ -549,19 +1104,20 @@ def make_ephys_clusters_data(
         short_desc_prefix="Ephys cluster feature",
         key=key,
         n_jobs=n_jobs,
+        columnar=columnar,
+        force=force,
+        profiler=profiler,
+        profile=profile,
     )
 
 
 def plot_distributions(pqt_path, channels_path):
     df_voltage = pd.read_parquet(pqt_path)
 
-    br = BrainRegions()
     df_channels = pd.read_parquet(channels_path)
 
     df_voltage["atlas_id"] = df_channels["atlas_id"].astype(np.int32)
-    df_voltage["atlas_idx"] = np.array(
-        [_[0] for _ in br.id2index(df_voltage.atlas_id)[1]], dtype=np.int32
-    )
+    df_voltage["atlas_idx"] = atlas_ids_to_idx(df_voltage["atlas_id"].to_numpy())
     df_voltage = lateralize_features(df_voltage)
 
     for fname in ("alpha_std",):
@@ -572,7 +1128,7 @@ def plot_distributions(pqt_path, channels_path):
         plt.show()
 
 
-def make_volumes(mean_path, std_path, output_dir):
+def make_volumes(mean_path, std_path, output_dir, binary_volumes=False, mip_levels=MIP_LEVELS, slices=False):
     up = api.FeatureUploader()
     means = np.load(mean_path, mmap_mode="r")
     stds = np.load(std_path, mmap_mode="r")
@@ -582,7 +1138,16 @@ def make_volumes(mean_path, std_path, output_dir):
         mean = means[..., i]
         std = stds[..., i]
         data = {"mean": mean, "std": std}
-        up.local_volume(f"yanliang_volume_{i:04d}", data, output_dir=output_dir)
+        fname = f"yanliang_volume_{i:04d}"
+        if binary_volumes:
+            # Volumes as sidecar .npy.gz files next to a JSON holding references only, with
+            # their downsampled levels and optionally their slices.
+            payload = api.make_volume_payload(fname, data)
+            externalize_volumes(payload, output_dir, fname, data, mip_levels, slices)
+            api.save_payload(output_dir, fname, payload)
+        else:
+            up.local_volume(fname, data, output_dir=output_dir)
+        compact_features_file(Path(output_dir) / f"{fname}.json")
 
 
 def parse_args():
@@ -619,7 +1184,37 @@ def parse_args():
     parser.add_argument("--spike-sorter", default="iblsorter")
     parser.add_argument("--recompute-metrics", action="store_true")
     parser.add_argument("--no-tracing", action="store_true")
-    return parser.parse_args()
+    parser.add_argument(
+        "--columnar",
+        action="store_true",
+        help="Write the per-region data as columns (region ids, one array per statistic, histogram matrix)",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Rewrite all features, even those whose inputs did not change since the last run",
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="Aggregate the input table chunk by chunk instead of loading it in memory at once",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help=f"Run each feature under cProfile and keep the stats of the slowest ones in <bucket>/{PROFILE_DIRNAME}",
+    )
+    parser.add_argument(
+        "--range-sketch",
+        type=int,
+        metavar="K",
+        help=f"With --streaming, size of the quantile sketches of the histogram ranges, in values per level "
+        f"(default: {SKETCH_SIZE})",
+    )
+    args = parser.parse_args()
+    if args.range_sketch and not args.streaming:
+        parser.error("--range-sketch requires --streaming")
+    return args
 
 
 def main():
@@ -632,7 +1227,17 @@ def main():
         local_data_path = cache_root / args.agg_project / args.label / args.agg_level
         if not local_data_path.exists():
             raise FileNotFoundError(f"Channel-level ephys cache not found: {local_data_path}")
-        make_ephys_data(local_data_path, output_dir=output_dir, key=args.key, n_jobs=args.n_jobs)
+        make_ephys_data(
+            local_data_path,
+            output_dir=output_dir,
+            key=args.key,
+            n_jobs=args.n_jobs,
+            columnar=args.columnar,
+            force=args.force,
+            streaming=args.streaming,
+            profile=args.profile,
+            range_sketch=args.range_sketch,
+        )
         log_step(f"`ephys` generation complete: {output_dir}")
         return
 
@@ -650,6 +1255,11 @@ def main():
         spike_sorter=args.spike_sorter,
         key=args.key,
         n_jobs=args.n_jobs,
+        columnar=args.columnar,
+        force=args.force,
+        streaming=args.streaming,
+        profile=args.profile,
+        range_sketch=args.range_sketch,
     )
     log_step(f"`ephys_clusters` generation complete: {output_dir}")
 
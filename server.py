@@ -5,8 +5,10 @@
 # Imports
 # -------------------------------------------------------------------------------------------------
 
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
+import atexit
+import gzip
 import itertools
 import json
 import os
@@ -16,12 +18,24 @@ import shutil
 import ssl
 import sys
 import tempfile
+import threading
+import time
 import unittest
 import uuid
 
-from flask import Flask, Response, request, send_file
+from flask import Flask, Response, jsonify, request, send_file
 from flask_cors import CORS
 
+from tools.feature_files import (
+    COMPRESSED_SUFFIXES,
+    compact_features_file,
+    get_compressed_sibling_path,
+    is_compact_features_file,
+    remove_compressed_siblings,
+    save_features,
+    write_json_atomic,
+)
+
 
 # -------------------------------------------------------------------------------------------------
 # Global variables
@@ -34,6 +48,19 @@ ROOT_DIR = Path(__file__).resolve().parent
 FEATURES_DIR = ROOT_DIR / 'data/features'
 FEATURES_FILE_REGEX = re.compile(r'^\d{8}-\S+\.json$')
 DELETE_AFTER_DAYS = 180
+ACCESS_LOG_FNAME = '_access.log'
+ACCESS_LOG_FLUSH_INTERVAL = 300  # seconds
+MANIFEST_FNAME = '_manifest.json'
+VOLUMES_DIR_SUFFIX = '.volumes'
+# Downsampled levels of a sidecar volume <name>.npy.gz are stored as <name>.mip<level>.npy.gz.
+VOLUME_MIP_SUFFIX = '.mip'
+# Slice files <name>.slices hold every slice of a sidecar volume along each axis, each one an
+# independently gzip-compressed NPY file (see tools/volumes.py).
+VOLUME_SLICES_SUFFIX = '.slices'
+VOLUME_SLICES_HEADER_SIZE = 8
+FILE_CHUNK_SIZE = 64 * 1024  # bytes
+NATIVE_BUCKET_PREFIXES = ('ephys_', 'bwm_')
+NATIVE_CACHE_MAX_AGE = 24 * 3600  # seconds
 BUCKET_UUID_LENGTH = 18
 GLOBAL_KEY_PATH = Path('~/.ibl/globalkey').expanduser()
 NATIVE_FNAMES = (
@@ -93,6 +120,11 @@ def delete_old_files(dir_path=FEATURES_DIR):
 def delete_old_subfolders(FEATURES_DIR, dry_run=True):
     one_year_ago = datetime.now() - timedelta(days=365)
 
+    # Bucket reads are recorded in the access log, not in _bucket.json.
+    flush_access_log(FEATURES_DIR)
+    access_log = load_access_log(FEATURES_DIR)
+
+    old_subdirs = []
     for subdir in FEATURES_DIR.iterdir():
         if 'bwm_' in str(subdir) or 'ephys_' in str(subdir):
             continue
@@ -103,19 +135,35 @@ def delete_old_subfolders(FEATURES_DIR, dry_run=True):
                 with open(json_file, 'r') as file:
                     data = json.load(file)
                 last_access_date = datetime.fromisoformat(data.get('last_access_date', ''))
+                if subdir.name in access_log:
+                    last_access_date = max(last_access_date, access_log[subdir.name])
 
                 if last_access_date < one_year_ago:
                     print(f"Deleting {subdir} last accessed on {last_access_date}")
+                    old_subdirs.append(subdir)
                     # Delete the subfolder
                     if not dry_run:
                         subdir.rmdir()
+    return old_subdirs
 
 
-def save_features(path, json_data):
-    assert path
-    assert json_data
-    with open(path, 'w') as f:
-        json.dump(json_data, f, indent=1)
+def iter_gunzip(path, chunk_size=FILE_CHUNK_SIZE):
+    """Yield the decompressed contents of a gzip file chunk by chunk."""
+    with gzip.open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            yield chunk
+
+
+def read_volume_slice(path, axis, index):
+    """Return the gzip-compressed NPY bytes of a slice of a volume slice file, or None."""
+    with open(path, 'rb') as f:
+        header_size = int.from_bytes(f.read(VOLUME_SLICES_HEADER_SIZE), 'little')
+        offsets = json.loads(f.read(header_size))['offsets']
+        if not 0 <= axis < len(offsets) or not 0 <= index < len(offsets[axis]) - 1:
+            return None
+        start, stop = offsets[axis][index], offsets[axis][index + 1]
+        f.seek(VOLUME_SLICES_HEADER_SIZE + header_size + start)
+        return f.read(stop - start)
 
 
 # -------------------------------------------------------------------------------------------------
@@ -127,6 +175,131 @@ def multiple_file_types(patterns):
         FEATURES_DIR.glob(pattern) for pattern in patterns)
 
 
+# Lookup priorities in the bucket index, lower wins.
+INDEX_EXACT = 0     # directory named exactly as the key
+INDEX_METADATA = 1  # `<alias>_<uuid>` directory whose _bucket.json has the key as uuid or alias
+INDEX_LEGACY = 2    # `<key>_*` or `*_<key>` directory, whatever its metadata says
+
+# In-memory index {key: {(priority, dirname)}} of the entries of FEATURES_DIR, revalidated
+# against the mtime of FEATURES_DIR so that buckets created by external scripts are picked up.
+_bucket_index = {'root': None, 'mtime': None, 'keys': {}, 'names': {}}
+# Guards the index against request threads reading it while another one updates it.
+_bucket_index_lock = threading.RLock()
+
+
+def _name_keys(name):
+    """Return the identifiers a `<uuid>_*` or `*_<uuid>` glob would match on this name."""
+    keys = set()
+    for i, c in enumerate(name):
+        if c == '_':
+            keys.add(name[:i])
+            keys.add(name[i + 1:])
+    keys.discard('')
+    return keys
+
+
+def _index_entries(path):
+    """Return the (key, priority) pairs under which a FEATURES_DIR entry is indexed."""
+    name = path.name
+    entries = {(name, INDEX_EXACT)}
+    if not path.is_dir():
+        return entries
+
+    keys = _name_keys(name)
+    entries.update((key, INDEX_LEGACY) for key in keys)
+
+    metadata_path = path / '_bucket.json'
+    if metadata_path.exists():
+        try:
+            with open(metadata_path, 'r') as f:
+                metadata = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            metadata = {}
+        for field in ('uuid', 'alias'):
+            key = metadata.get(field) if isinstance(metadata, dict) else None
+            if key in keys:
+                entries.add((key, INDEX_METADATA))
+    return entries
+
+
+def _features_dir_mtime():
+    try:
+        return FEATURES_DIR.stat().st_mtime_ns
+    except OSError:
+        return None
+
+
+def _unindex(index, name):
+    keys = index['keys']
+    for key, priority in index['names'].pop(name, ()):
+        candidates = keys.get(key)
+        if candidates is None:
+            continue
+        candidates.discard((priority, name))
+        if not candidates:
+            del keys[key]
+
+
+def _index(index, path):
+    _unindex(index, path.name)
+    entries = _index_entries(path)
+    index['names'][path.name] = entries
+    for key, priority in entries:
+        index['keys'].setdefault(key, set()).add((priority, path.name))
+
+
+def build_bucket_index():
+    """Scan FEATURES_DIR and rebuild the bucket index from scratch."""
+    # Build into fresh dictionaries and swap them in at the end, so that concurrent
+    # lookups never see a half-built index.
+    with _bucket_index_lock:
+        index = {'root': FEATURES_DIR, 'mtime': _features_dir_mtime(), 'keys': {}, 'names': {}}
+        if FEATURES_DIR.is_dir():
+            for path in FEATURES_DIR.iterdir():
+                _index(index, path)
+        _bucket_index.update(index)
+        return _bucket_index
+
+
+def get_bucket_index():
+    """Return the bucket index, rebuilding it if FEATURES_DIR was modified since."""
+    with _bucket_index_lock:
+        if (_bucket_index['root'] != FEATURES_DIR or
+                _bucket_index['mtime'] != _features_dir_mtime()):
+            build_bucket_index()
+        return _bucket_index
+
+
+def _update_bucket_index(update, mtime_before):
+    # mtime_before is the FEATURES_DIR mtime before the server modified it, or None if
+    # FEATURES_DIR itself was not modified. The in-place update only marks the index as
+    # fresh if it was fresh before: otherwise another process changed FEATURES_DIR in
+    # the meantime, and the index is rebuilt to pick that change up as well.
+    with _bucket_index_lock:
+        if _bucket_index['root'] != FEATURES_DIR:
+            build_bucket_index()
+        elif mtime_before is not None and _bucket_index['mtime'] != mtime_before:
+            build_bucket_index()
+        else:
+            update(_bucket_index)
+            if mtime_before is not None:
+                _bucket_index['mtime'] = _features_dir_mtime()
+
+
+def index_bucket(path, mtime_before=None):
+    """Add or refresh a single bucket directory in the index, after the server modified it.
+
+    mtime_before is the FEATURES_DIR mtime before the bucket directory was created, see
+    `_update_bucket_index()`.
+    """
+    _update_bucket_index(lambda index: _index(index, Path(path)), mtime_before)
+
+
+def unindex_bucket(path, mtime_before=None):
+    """Remove a single bucket directory from the index, after the server deleted it."""
+    _update_bucket_index(lambda index: _unindex(index, Path(path).name), mtime_before)
+
+
 def get_bucket_path(uuid):
     """Return the bucket directory matching an exact UUID or alias.
 
@@ -135,35 +308,22 @@ def get_bucket_path(uuid):
     can share prefixes (for example ``ephys`` and ``ephys_clusters``), so every
     candidate's metadata must be checked for an exact ``uuid`` or ``alias``
     match before falling back to legacy path-name matching.
+
+    Resolution goes through the in-memory bucket index (see ``get_bucket_index()``)
+    rather than globbing FEATURES_DIR and parsing every candidate's metadata.
     """
     if not uuid:
         return None
 
-    exact_path = FEATURES_DIR / uuid
-    if exact_path.exists():
-        return exact_path
-
-    patterns = (f'{uuid}_*', f'*_{uuid}')
-    candidates = sorted(
-        (path for path in multiple_file_types(patterns) if path.is_dir()),
-        key=lambda path: path.name,
-    )
-
-    for path in candidates:
-        metadata_path = path / '_bucket.json'
-        if not metadata_path.exists():
-            continue
-        try:
-            with open(metadata_path, 'r') as f:
-                metadata = json.load(f)
-        except (OSError, json.JSONDecodeError):
-            continue
-        if metadata.get('uuid') == uuid or metadata.get('alias') == uuid:
-            return path
+    with _bucket_index_lock:
+        candidates = get_bucket_index()['keys'].get(uuid)
+        if not candidates:
+            return None
 
-    # Legacy fallback for buckets without metadata. Keep this deterministic, but
-    # only after metadata exact-match resolution to avoid prefix collisions.
-    return candidates[0] if candidates else None
+        # Lowest priority first, then directory name to keep the legacy fallback
+        # deterministic.
+        _, name = min(candidates)
+    return FEATURES_DIR / name
 
 
 def get_bucket_metadata_path(uuid):
@@ -182,6 +342,8 @@ def save_bucket_metadata(uuid, metadata):
         return
     with open(path, 'w') as f:
         json.dump(metadata, f, indent=1)
+    # The uuid/alias may have changed: refresh the index entry of this bucket.
+    index_bucket(path.parent)
 
 
 def load_bucket_metadata(uuid):
@@ -240,6 +402,205 @@ def list_buckets():
     return list(info['buckets'].keys())
 
 
+# -------------------------------------------------------------------------------------------------
+# Access log
+# -------------------------------------------------------------------------------------------------
+
+# Feature reads only record the bucket access in memory: {bucket path: last access date}.
+# The pending accesses are periodically appended to FEATURES_DIR/_access.log, one
+# `<date>\t<dirname>` line per accessed bucket, so that serving a feature never rewrites
+# _bucket.json. Appends are atomic, so several server processes can share the log.
+# The flusher thread is started by the first recorded access, so that it also runs when the
+# app is served by a WSGI server rather than by `python server.py`.
+_access_lock = threading.Lock()
+_pending_accesses = {}
+_access_log_flusher = None
+
+
+def record_bucket_access(bucket_path):
+    with _access_lock:
+        _pending_accesses[Path(bucket_path)] = now()
+    if _access_log_flusher is None:
+        start_access_log_flusher()
+
+
+def flush_access_log(features_dir=None):
+    features_dir = Path(features_dir or FEATURES_DIR)
+    # Only the accesses to the buckets of this directory are flushed, the others stay pending
+    # until their own directory is flushed.
+    with _access_lock:
+        pending = {
+            path: _pending_accesses.pop(path)
+            for path in list(_pending_accesses) if path.parent == features_dir}
+    # Buckets that were deleted since their access are not logged.
+    pending = {path.name: date for path, date in pending.items() if path.is_dir()}
+    if not pending:
+        return 0
+    lines = ''.join(f'{date}\t{name}\n' for name, date in sorted(pending.items()))
+    with open(features_dir / ACCESS_LOG_FNAME, 'a') as f:
+        f.write(lines)
+    return len(pending)
+
+
+def load_access_log(features_dir=None):
+    """Return {bucket dirname: last access datetime} from the access log."""
+    features_dir = features_dir or FEATURES_DIR
+    path = features_dir / ACCESS_LOG_FNAME
+    if not path.exists():
+        return {}
+    out = {}
+    with open(path, 'r') as f:
+        for line in f:
+            date, _, name = line.rstrip('\n').partition('\t')
+            if not name:
+                continue
+            try:
+                date = datetime.fromisoformat(date)
+            except ValueError:
+                continue
+            if name not in out or date > out[name]:
+                out[name] = date
+    return out
+
+
+def start_access_log_flusher(interval=ACCESS_LOG_FLUSH_INTERVAL):
+    """Start the thread flushing the access log every interval seconds, once per process."""
+    global _access_log_flusher
+    with _access_lock:
+        if _access_log_flusher is not None:
+            return _access_log_flusher
+
+        def _loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    flush_access_log()
+                except OSError as e:
+                    print(f"Unable to flush the access log: {e}")
+
+        _access_log_flusher = threading.Thread(target=_loop, name='access-log-flusher', daemon=True)
+        _access_log_flusher.start()
+        atexit.register(flush_access_log)
+        return _access_log_flusher
+
+
+# -------------------------------------------------------------------------------------------------
+# Bucket manifest
+# -------------------------------------------------------------------------------------------------
+
+# Each bucket directory has a _manifest.json sidecar with the listing metadata of its features:
+# {"features": {fname: {"short_desc": ..., "unit": ...}}, "mtimes": {fname: mtime_ns}}
+# The mtimes let get_bucket() detect feature files written directly by the generation
+# scripts and only re-parse those.
+
+def read_feature_metadata(features_path):
+    with open(features_path, 'r') as f:
+        metadata = json.load(f)
+    return {
+        'short_desc': metadata.get('short_desc', '') or '',
+        'unit': metadata.get('unit', None),
+    }
+
+
+def iter_feature_files(bucket_path):
+    """Yield (fname, mtime_ns) for the feature files of a bucket."""
+    with os.scandir(bucket_path) as it:
+        for entry in it:
+            if entry.name.startswith('_') or not entry.name.endswith('.json'):
+                continue
+            yield entry.name[:-len('.json')], entry.stat().st_mtime_ns
+
+
+def load_bucket_manifest(bucket_path):
+    path = bucket_path / MANIFEST_FNAME
+    if not path.exists():
+        return {'features': {}, 'mtimes': {}}
+    try:
+        with open(path, 'r') as f:
+            manifest = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {'features': {}, 'mtimes': {}}
+    manifest.setdefault('features', {})
+    manifest.setdefault('mtimes', {})
+    return manifest
+
+
+def save_bucket_manifest(bucket_path, manifest):
+    write_json_atomic(bucket_path / MANIFEST_FNAME, manifest)
+
+
+def get_bucket_manifest(bucket_path):
+    """Return {fname: feature metadata}, refreshing the manifest entries of modified files."""
+    manifest = load_bucket_manifest(bucket_path)
+    features, mtimes = manifest['features'], manifest['mtimes']
+
+    files = dict(iter_feature_files(bucket_path))
+    modified = False
+    for fname in set(features) - set(files):
+        features.pop(fname, None)
+        mtimes.pop(fname, None)
+        modified = True
+    for fname, mtime in files.items():
+        if fname in features and mtimes.get(fname) == mtime:
+            continue
+        try:
+            features[fname] = read_feature_metadata(bucket_path / f'{fname}.json')
+        except (OSError, json.JSONDecodeError):
+            continue
+        mtimes[fname] = mtime
+        modified = True
+
+    if modified:
+        save_bucket_manifest(bucket_path, manifest)
+    return {fname: features[fname] for fname in sorted(features)}
+
+
+def update_bucket_manifest(bucket_path, fname, metadata=None):
+    """Set (or remove if metadata is None) the manifest entry of a feature."""
+    manifest = load_bucket_manifest(bucket_path)
+    if metadata is None:
+        manifest['features'].pop(fname, None)
+        manifest['mtimes'].pop(fname, None)
+    else:
+        manifest['features'][fname] = metadata
+        manifest['mtimes'][fname] = (bucket_path / f'{fname}.json').stat().st_mtime_ns
+    save_bucket_manifest(bucket_path, manifest)
+
+
+def rebuild_bucket_manifest(bucket_path):
+    manifest_path = bucket_path / MANIFEST_FNAME
+    if manifest_path.exists():
+        manifest_path.unlink()
+    return get_bucket_manifest(bucket_path)
+
+
+def rebuild_manifests(features_dir=None):
+    features_dir = features_dir or FEATURES_DIR
+    for bucket_path in sorted(features_dir.iterdir()):
+        if not bucket_path.is_dir():
+            continue
+        features = rebuild_bucket_manifest(bucket_path)
+        print(f"Rebuilt manifest of {bucket_path.name} ({len(features)} features)")
+
+
+def migrate_features(features_dir=None):
+    """Convert all feature files to the compact on-disk format, in place."""
+    features_dir = features_dir or FEATURES_DIR
+    n_migrated = 0
+    for bucket_path in sorted(features_dir.iterdir()):
+        if not bucket_path.is_dir():
+            continue
+        migrated = [
+            fname for fname, _ in list(iter_feature_files(bucket_path))
+            if compact_features_file(bucket_path / f'{fname}.json')]
+        # Refresh the manifest mtimes of the rewritten files.
+        get_bucket_manifest(bucket_path)
+        if migrated:
+            print(f"Migrated {len(migrated)} feature files of {bucket_path.name}")
+        n_migrated += len(migrated)
+    return n_migrated
+
+
 # -------------------------------------------------------------------------------------------------
 # Authorization
 # -------------------------------------------------------------------------------------------------
@@ -298,6 +659,67 @@ def authorize_global_key(key):
     return normalize_token(key) == normalize_token(read_global_key())
 
 
+# -------------------------------------------------------------------------------------------------
+# HTTP caching
+# -------------------------------------------------------------------------------------------------
+
+def is_native_bucket(bucket_path):
+    return bucket_path.name.startswith(NATIVE_BUCKET_PREFIXES)
+
+
+def get_cache_control(bucket_path):
+    # Native buckets only change between deployments, user buckets may be patched at any
+    # time and must always be revalidated (which is cheap thanks to the validators).
+    if is_native_bucket(bucket_path):
+        return f'public, max-age={NATIVE_CACHE_MAX_AGE}'
+    return 'no-cache'
+
+
+def file_etag(stat):
+    """Strong ETag derived from the file mtime and size, without reading the file."""
+    return f'{stat.st_mtime_ns:x}-{stat.st_size:x}'
+
+
+def is_not_modified(etag, mtime):
+    """Whether the request conditional headers match the validators of the resource."""
+    # If-None-Match takes precedence over If-Modified-Since (RFC 9110).
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since:
+        return int(mtime) <= request.if_modified_since.timestamp()
+    return False
+
+
+def set_cache_headers(response, bucket_path, etag=None, mtime=None):
+    response.headers['Cache-Control'] = get_cache_control(bucket_path)
+    if etag:
+        response.set_etag(etag)
+    if mtime is not None:
+        response.last_modified = datetime.fromtimestamp(int(mtime), tz=timezone.utc)
+    return response
+
+
+def not_modified_response(bucket_path, etag, mtime):
+    return set_cache_headers(Response(status=304), bucket_path, etag, mtime)
+
+
+def negotiate_compressed_sibling(path, stat):
+    """Return (encoding, path) of the preferred precompressed sibling the client accepts."""
+    for encoding, suffix in COMPRESSED_SUFFIXES:
+        if encoding not in request.accept_encodings:
+            continue
+        sibling_path = get_compressed_sibling_path(path, suffix)
+        try:
+            sibling_stat = sibling_path.stat()
+        except FileNotFoundError:
+            continue
+        # Skip siblings older than the file, e.g. if a script rewrote the JSON only.
+        if sibling_stat.st_mtime_ns < stat.st_mtime_ns:
+            continue
+        return encoding, sibling_path
+    return None, path
+
+
 # -------------------------------------------------------------------------------------------------
 # Error handlers
 # -------------------------------------------------------------------------------------------------
@@ -323,15 +745,7 @@ def get_feature_metadata(uuid, fname):
     if not features_path.exists():
         return f'Feature {fname} does not exist in bucket {uuid}, you need to create it first.', 404
 
-    # Open the JSON file.
-    with open(features_path, 'r') as f:
-        print(features_path)
-        metadata = json.load(f)
-
-    return {
-        'short_desc': metadata.get('short_desc', '') or '',
-        'unit': metadata.get('unit', None),
-    }
+    return read_feature_metadata(features_path)
 
 
 # def return_volume(uuid, fname):
@@ -354,15 +768,11 @@ def get_bucket(uuid):
     if not bucket_path or not bucket_path.exists():
         return f'Bucket {uuid} does not exist, you need to create it first.', 404
 
-    # Retrieve the list of JSON files in the bucket directory.
-    fnames = bucket_path.glob('*.json')
-    fnames = sorted(_.stem for _ in fnames if not _.stem.startswith('_'))
-
     # Retrieve the bucket metadata.
     metadata = load_bucket_metadata(uuid)
 
-    # Retrieve the feature metadata for all features.
-    features = {fname: get_feature_metadata(uuid, fname) for fname in fnames}
+    # Retrieve the feature metadata for all features from the bucket manifest.
+    features = get_bucket_manifest(bucket_path)
 
     return {'features': features, 'metadata': metadata}
 
@@ -383,7 +793,9 @@ def create_bucket(uuid, metadata, alias=None, patch=False):
     bucket_dir = FEATURES_DIR / f'{alias or ""}{"_" if alias else ""}{uuid}'
     if not patch:
         assert not bucket_dir.exists()
+        mtime_before = _features_dir_mtime()
         bucket_dir.mkdir(parents=True, exist_ok=True)
+        index_bucket(bucket_dir, mtime_before)
 
     # Save the metadata (including the token).
     save_bucket_metadata(uuid, metadata)
@@ -397,11 +809,13 @@ def delete_bucket(uuid):
 
     # Assert that the bucket with this name exists on the server
     bucket_path = get_bucket_path(uuid)
-    if not bucket_path.exists():
+    if not bucket_path or not bucket_path.exists():
         return f'Bucket {uuid} does not exist on the server.', 404
 
     try:
+        mtime_before = _features_dir_mtime()
         shutil.rmtree(bucket_path)
+        unindex_bucket(bucket_path, mtime_before)
         return f'Bucket {uuid} successfully deleted.', 200
     except Exception as e:
         return f"Unable to delete bucket {uuid}", 500
@@ -444,6 +858,7 @@ def create_features(uuid, fname, feature_data, short_desc=None, unit=None, patch
         'unit': unit,
     }
     save_features(features_path, data)
+    update_bucket_manifest(bucket_path, fname, {'short_desc': short_desc or '', 'unit': unit})
 
     return f'Features {fname} successfully {"created" if not patch else "patched"} in bucket {uuid}.', 200
 
@@ -466,6 +881,11 @@ def delete_features(uuid, fname):
     assert features_path.exists()
     try:
         os.remove(features_path)
+        remove_compressed_siblings(features_path)
+        volumes_dir = bucket_path / f'{fname}{VOLUMES_DIR_SUFFIX}'
+        if volumes_dir.exists():
+            shutil.rmtree(volumes_dir)
+        update_bucket_manifest(bucket_path, fname, None)
         return f"Successfully deleted {features_path}", 200
     except Exception as e:
         return f"Unable to delete {features_path}", 500
@@ -517,13 +937,21 @@ def api_delete_bucket(uuid):
 @app.route('/api/buckets/<uuid>', methods=['GET'])
 def api_get_bucket(uuid):
     out = get_bucket(uuid)
+    if isinstance(out, tuple):
+        return out
 
     # NOTE: remove the token from the metadata dictionary.
     if 'metadata' in out:
         if 'token' in out['metadata']:
             del out['metadata']['token']
 
-    return out
+    # The listing is small now that it comes from the manifest: validate it with a hash of
+    # the response body.
+    bucket_path = get_bucket_path(uuid)
+    response = jsonify(out)
+    response.add_etag()
+    set_cache_headers(response, bucket_path)
+    return response.make_conditional(request)
 
 
 # -------------------------------------------------------------------------------------------------
@@ -587,29 +1015,150 @@ def api_get_features(uuid, fname):
     if not bucket_path or not bucket_path.exists():
         return f'Bucket {uuid} does not exist, you need to create it first.', 404
 
-    # Update the last_access_date field.
-    meta = update_bucket_metadata(uuid)
+    # Record the access, flushed to the access log later on.
+    record_bucket_access(bucket_path)
 
     # Retrieve the features path.
     features_path = bucket_path / f'{fname}.json'
-    if not features_path.exists():
+    try:
+        stat = features_path.stat()
+    except FileNotFoundError:
         return f'Feature {fname} does not exist in bucket {uuid}, you need to create it first.', 404
 
-    # Return the contents of the features file.
-    assert features_path.exists()
-    with open(features_path, 'r') as f:
-        text = f.read()
+    # Pick the precompressed sibling matching the Accept-Encoding request header, if any.
+    # Each representation needs its own ETag.
+    encoding, path = negotiate_compressed_sibling(features_path, stat)
+    etag = file_etag(stat)
+    if encoding:
+        etag = f'{etag}-{encoding}'
 
-    # HTTP headers
-    headers = {'Content-Type': 'application/json'}
+    # Answer conditional requests from the file validators, without opening the file.
+    if is_not_modified(etag, stat.st_mtime):
+        response = not_modified_response(bucket_path, etag, stat.st_mtime)
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
 
     # Special HTTP header if we want to download the JSON file instead of displaying it.
     download = request.args.get('download', '') or ''
     if download.isdigit():
         download = int(download)
-    if download:
-        headers['Content-Disposition'] = f'attachment; filename={uuid}-{fname}.json'
-    return Response(text, headers=headers)
+
+    # Stream the (possibly compressed) features file from disk in chunks, so that memory
+    # usage does not depend on the payload size. Range and If-Range requests are handled
+    # by send_file against our ETag, so interrupted downloads can be resumed.
+    response = send_file(
+        path, mimetype='application/json', as_attachment=bool(download),
+        download_name=f'{uuid}-{fname}.json', conditional=True, etag=etag,
+        last_modified=int(stat.st_mtime))
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    return set_cache_headers(response, bucket_path, etag, stat.st_mtime)
+
+
+# -------------------------------------------------------------------------------------------------
+# REST endpoint: retrieve a sidecar volume of a feature as a raw NPY file
+# GET /api/buckets/<uuid>/<fname>/volumes/<name>.npy[?level=<level>]
+# -------------------------------------------------------------------------------------------------
+
+@app.route('/api/buckets/<uuid>/<fname>/volumes/<name>.npy', methods=['GET'])
+def api_get_volume(uuid, fname, name):
+
+    # Retrieve the bucket path.
+    bucket_path = get_bucket_path(uuid)
+    if not bucket_path or not bucket_path.exists():
+        return f'Bucket {uuid} does not exist, you need to create it first.', 404
+
+    # Level 0 is the native resolution, level n is downsampled 2**n times along each axis.
+    level = request.args.get('level', 0, type=int)
+    if level < 0:
+        return f'Invalid volume level {level}.', 400
+
+    # Volumes are stored gzip-compressed by the generation scripts (see tools/volumes.py),
+    # or possibly as plain NPY files.
+    volumes_dir = bucket_path / f'{fname}{VOLUMES_DIR_SUFFIX}'
+    stem = f'{name}{VOLUME_MIP_SUFFIX}{level}' if level else name
+    gz_path = volumes_dir / f'{stem}.npy.gz'
+    npy_path = volumes_dir / f'{stem}.npy'
+    path = gz_path if gz_path.exists() else npy_path
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return f'Volume {name} (level {level}) of feature {fname} does not exist in bucket {uuid}.', 404
+
+    record_bucket_access(bucket_path)
+
+    # The gzip bytes and the inflated ones are different representations, with their own ETag.
+    gzipped = path == gz_path and 'gzip' in request.accept_encodings
+    etag = file_etag(stat)
+    if gzipped:
+        etag = f'{etag}-gzip'
+
+    # Answer conditional requests from the file validators, without reading the volume.
+    if is_not_modified(etag, stat.st_mtime):
+        response = not_modified_response(bucket_path, etag, stat.st_mtime)
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
+
+    mimetype = 'application/octet-stream'
+    if path == npy_path or gzipped:
+        # Send the file as is, compressed or not, and let the client inflate it.
+        response = send_file(
+            path, mimetype=mimetype, conditional=True, etag=etag, last_modified=int(stat.st_mtime))
+        if gzipped:
+            response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(iter_gunzip(gz_path), mimetype=mimetype)
+    response.headers['Vary'] = 'Accept-Encoding'
+    return set_cache_headers(response, bucket_path, etag, stat.st_mtime)
+
+
+# -------------------------------------------------------------------------------------------------
+# REST endpoint: retrieve one slice of a sidecar volume as a raw 2D NPY file
+# GET /api/buckets/<uuid>/<fname>/volumes/<name>/slices/<axis>/<index>.npy
+# -------------------------------------------------------------------------------------------------
+
+@app.route('/api/buckets/<uuid>/<fname>/volumes/<name>/slices/<int:axis>/<int:index>.npy', methods=['GET'])
+def api_get_volume_slice(uuid, fname, name, axis, index):
+
+    # Retrieve the bucket path.
+    bucket_path = get_bucket_path(uuid)
+    if not bucket_path or not bucket_path.exists():
+        return f'Bucket {uuid} does not exist, you need to create it first.', 404
+
+    slices_path = bucket_path / f'{fname}{VOLUMES_DIR_SUFFIX}' / f'{name}{VOLUME_SLICES_SUFFIX}'
+    try:
+        stat = slices_path.stat()
+    except FileNotFoundError:
+        return f'Volume {name} of feature {fname} has no slices in bucket {uuid}.', 404
+
+    record_bucket_access(bucket_path)
+
+    # The slices are stored gzip-compressed, the bytes are sent as is when the client accepts it.
+    # Each slice and representation needs its own ETag.
+    gzipped = 'gzip' in request.accept_encodings
+    etag = f'{file_etag(stat)}-{axis}-{index}'
+    if gzipped:
+        etag = f'{etag}-gzip'
+
+    # Answer conditional requests from the file validators, without reading the slice.
+    if is_not_modified(etag, stat.st_mtime):
+        response = not_modified_response(bucket_path, etag, stat.st_mtime)
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
+
+    data = read_volume_slice(slices_path, axis, index)
+    if data is None:
+        return f'Slice {index} along axis {axis} of volume {name} does not exist.', 404
+
+    mimetype = 'application/octet-stream'
+    if gzipped:
+        response = Response(data, mimetype=mimetype)
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(gzip.decompress(data), mimetype=mimetype)
+    response.headers['Vary'] = 'Accept-Encoding'
+    return set_cache_headers(response, bucket_path, etag, stat.st_mtime)
 
 
 # -------------------------------------------------------------------------------------------------
@@ -668,6 +1217,9 @@ class TestApp(unittest.TestCase):
     def ok(self, response):
         self.assertEqual(response.status_code, 200)
 
+    def ok_tuple(self, out):
+        self.assertEqual(out[1], 200)
+
     def test_get_bucket_path_disambiguates_alias_prefixes(self):
         global FEATURES_DIR
         original_features_dir = FEATURES_DIR
@@ -695,6 +1247,431 @@ class TestApp(unittest.TestCase):
         finally:
             FEATURES_DIR = original_features_dir
 
+    def test_bucket_index_revalidation(self):
+        global FEATURES_DIR
+        original_features_dir = FEATURES_DIR
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                FEATURES_DIR = Path(tmpdir)
+                self.assertIsNone(get_bucket_path('cccccccccccccccccc'))
+
+                # A bucket created behind the server's back is picked up through the
+                # FEATURES_DIR mtime.
+                external_dir = FEATURES_DIR / 'external_cccccccccccccccccc'
+                external_dir.mkdir()
+                (external_dir / '_bucket.json').write_text(json.dumps({
+                    'uuid': 'cccccccccccccccccc',
+                    'alias': 'external',
+                }))
+                os.utime(FEATURES_DIR, ns=(0, 0))
+                self.assertEqual(get_bucket_path('external'), external_dir)
+                self.assertEqual(get_bucket_path('cccccccccccccccccc'), external_dir)
+
+                # Buckets created and deleted by the server update the index in place.
+                metadata = create_bucket_metadata('dddddddddddddddddd', alias='mine')
+                self.ok_tuple(create_bucket('dddddddddddddddddd', metadata, alias='mine'))
+                mine_dir = FEATURES_DIR / 'mine_dddddddddddddddddd'
+                self.assertEqual(get_bucket_path('mine'), mine_dir)
+                self.assertEqual(get_bucket_path('dddddddddddddddddd'), mine_dir)
+
+                self.ok_tuple(delete_bucket('mine'))
+                self.assertIsNone(get_bucket_path('mine'))
+                self.assertIsNone(get_bucket_path('dddddddddddddddddd'))
+                self.assertEqual(get_bucket_path('external'), external_dir)
+
+                # A directory created by another process just before the server modifies
+                # FEATURES_DIR is not hidden by the in-place update of the index.
+                other_dir = FEATURES_DIR / 'eeeeeeeeeeeeeeeeee'
+                other_dir.mkdir()
+                os.utime(FEATURES_DIR, ns=(1, 1))
+                mtime_before = _features_dir_mtime()
+                own_dir = FEATURES_DIR / 'ffffffffffffffffff'
+                own_dir.mkdir()
+                index_bucket(own_dir, mtime_before)
+                self.assertEqual(get_bucket_path('ffffffffffffffffff'), own_dir)
+                self.assertEqual(get_bucket_path('eeeeeeeeeeeeeeeeee'), other_dir)
+        finally:
+            FEATURES_DIR = original_features_dir
+
+    def test_access_log(self):
+        global FEATURES_DIR
+        original_features_dir = FEATURES_DIR
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                FEATURES_DIR = Path(tmpdir)
+                _pending_accesses.clear()
+
+                old_date = (datetime.now() - timedelta(days=400)).isoformat()
+                for name in ('read', 'unread'):
+                    bucket_dir = FEATURES_DIR / f'{name}_eeeeeeeeeeeeeeeeee'
+                    bucket_dir.mkdir()
+                    (bucket_dir / '_bucket.json').write_text(json.dumps({
+                        'uuid': 'eeeeeeeeeeeeeeeeee',
+                        'alias': name,
+                        'last_access_date': old_date,
+                    }))
+                    (bucket_dir / 'fet.json').write_text(json.dumps({
+                        'feature_data': {'mappings': {}},
+                    }))
+                metadata_path = FEATURES_DIR / 'read_eeeeeeeeeeeeeeeeee' / '_bucket.json'
+                metadata_before = metadata_path.read_text()
+
+                # Reading a feature does not write the bucket metadata, and starts the
+                # flusher thread, also when the app is not run by `python server.py`.
+                self.ok(self.client.get('/api/buckets/read/fet'))
+                self.assertEqual(metadata_path.read_text(), metadata_before)
+                self.assertEqual(load_access_log(), {})
+                self.assertTrue(_access_log_flusher.is_alive())
+
+                # The access is flushed to the log, which feeds the cleanup.
+                self.assertEqual(flush_access_log(), 1)
+                self.assertEqual(list(load_access_log()), ['read_eeeeeeeeeeeeeeeeee'])
+                self.assertEqual(
+                    delete_old_subfolders(FEATURES_DIR),
+                    [FEATURES_DIR / 'unread_eeeeeeeeeeeeeeeeee'])
+        finally:
+            FEATURES_DIR = original_features_dir
+
+    def test_access_log_directories(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            _pending_accesses.clear()
+            dirs = [Path(tmpdir) / 'a', Path(tmpdir) / 'b']
+            for features_dir in dirs:
+                (features_dir / 'bucket_ffffffffffffffffff').mkdir(parents=True)
+                record_bucket_access(features_dir / 'bucket_ffffffffffffffffff')
+
+            # Flushing a directory keeps the accesses to the buckets of the other one pending.
+            self.assertEqual(flush_access_log(dirs[0]), 1)
+            self.assertEqual(list(load_access_log(dirs[0])), ['bucket_ffffffffffffffffff'])
+            self.assertEqual(load_access_log(dirs[1]), {})
+            self.assertEqual(flush_access_log(dirs[1]), 1)
+            self.assertEqual(list(load_access_log(dirs[1])), ['bucket_ffffffffffffffffff'])
+            self.assertEqual(flush_access_log(dirs[0]), 0)
+
+    def test_bucket_manifest(self):
+        global FEATURES_DIR
+        original_features_dir = FEATURES_DIR
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                FEATURES_DIR = Path(tmpdir)
+                metadata = create_bucket_metadata('ffffffffffffffffff', alias='man')
+                self.ok_tuple(create_bucket('ffffffffffffffffff', metadata, alias='man'))
+                bucket_path = get_bucket_path('man')
+
+                self.ok_tuple(create_features(
+                    'man', 'fet1', {'mappings': {}}, short_desc='first', unit='Hz'))
+                manifest = load_bucket_manifest(bucket_path)
+                self.assertEqual(
+                    manifest['features'], {'fet1': {'short_desc': 'first', 'unit': 'Hz'}})
+
+                # Feature files written behind the server's back are picked up.
+                fet2_path = bucket_path / 'fet2.json'
+                fet2_path.write_text(json.dumps(
+                    {'feature_data': {'mappings': {}}, 'short_desc': 'second'}))
+                self.assertEqual(get_bucket('man')['features'], {
+                    'fet1': {'short_desc': 'first', 'unit': 'Hz'},
+                    'fet2': {'short_desc': 'second', 'unit': None},
+                })
+                fet2_path.write_text(json.dumps(
+                    {'feature_data': {'mappings': {}}, 'short_desc': 'modified'}))
+                os.utime(fet2_path, ns=(0, 0))
+                self.assertEqual(
+                    get_bucket('man')['features']['fet2']['short_desc'], 'modified')
+
+                # The listing only reads the manifest when it is up to date.
+                manifest = load_bucket_manifest(bucket_path)
+                manifest['features']['fet1']['short_desc'] = 'from manifest'
+                save_bucket_manifest(bucket_path, manifest)
+                self.assertEqual(
+                    get_bucket('man')['features']['fet1']['short_desc'], 'from manifest')
+                rebuild_bucket_manifest(bucket_path)
+                self.assertEqual(get_bucket('man')['features']['fet1']['short_desc'], 'first')
+
+                self.ok_tuple(delete_features('man', 'fet1'))
+                self.assertEqual(list(load_bucket_manifest(bucket_path)['features']), ['fet2'])
+        finally:
+            FEATURES_DIR = original_features_dir
+
+    def test_sidecar_volumes(self):
+        global FEATURES_DIR
+        original_features_dir = FEATURES_DIR
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                FEATURES_DIR = Path(tmpdir)
+                metadata = create_bucket_metadata('gggggggggggggggggg', alias='vol')
+                self.ok_tuple(create_bucket('gggggggggggggggggg', metadata, alias='vol'))
+                bucket_path = get_bucket_path('vol')
+
+                feature_data = {'volumes': {'mean': {'volume': {'href': 'mean.npy'}}}}
+                (bucket_path / 'fet.json').write_text(json.dumps({'feature_data': feature_data}))
+                npy = b'\x93NUMPY fake npy bytes'
+                volumes_dir = bucket_path / f'fet{VOLUMES_DIR_SUFFIX}'
+                volumes_dir.mkdir()
+                (volumes_dir / 'mean.npy.gz').write_bytes(gzip.compress(npy))
+
+                url = '/api/buckets/vol/fet/volumes/mean.npy'
+                response = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+                self.ok(response)
+                self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+                self.assertEqual(gzip.decompress(response.get_data()), npy)
+                response.close()
+
+                response = self.client.get(url, headers={'Accept-Encoding': 'identity'})
+                self.ok(response)
+                self.assertNotIn('Content-Encoding', response.headers)
+                self.assertEqual(response.get_data(), npy)
+
+                # Conditional requests, with an ETag per representation.
+                identity_etag = response.headers['ETag']
+                last_modified = response.headers['Last-Modified']
+                response = self.client.get(
+                    url, headers={'Accept-Encoding': 'identity', 'If-None-Match': identity_etag})
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response.get_data(), b'')
+                self.assertEqual(response.headers['ETag'], identity_etag)
+                response = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+                gzip_etag = response.headers['ETag']
+                response.close()
+                self.assertNotEqual(gzip_etag, identity_etag)
+                response = self.client.get(url, headers={'Accept-Encoding': 'gzip', 'If-None-Match': gzip_etag})
+                self.assertEqual(response.status_code, 304)
+                response = self.client.get(
+                    url, headers={'Accept-Encoding': 'gzip', 'If-None-Match': identity_etag})
+                self.ok(response)
+                response.close()
+                response = self.client.get(url, headers={'If-Modified-Since': last_modified})
+                self.assertEqual(response.status_code, 304)
+
+                self.assertEqual(
+                    self.client.get('/api/buckets/vol/fet/volumes/std.npy').status_code, 404)
+
+                # Downsampled levels.
+                (volumes_dir / 'mean.mip1.npy.gz').write_bytes(gzip.compress(npy[:8]))
+                response = self.client.get(f'{url}?level=1', headers={'Accept-Encoding': 'identity'})
+                self.ok(response)
+                self.assertEqual(response.get_data(), npy[:8])
+                self.assertEqual(self.client.get(f'{url}?level=0').status_code, 200)
+                self.assertEqual(self.client.get(f'{url}?level=2').status_code, 404)
+                self.assertEqual(self.client.get(f'{url}?level=-1').status_code, 400)
+
+                # Slices, stored as independently compressed members after a JSON header.
+                slices = [[b'axis0 slice0', b'axis0 slice1'], [b'axis1 slice0'], [b'axis2 slice0']]
+                members = [[gzip.compress(data) for data in axis_slices] for axis_slices in slices]
+                offsets, size = [], 0
+                for axis_members in members:
+                    axis_offsets = [size]
+                    for member in axis_members:
+                        size += len(member)
+                        axis_offsets.append(size)
+                    offsets.append(axis_offsets)
+                header = json.dumps({'shape': [2, 1, 1], 'offsets': offsets}).encode()
+                (volumes_dir / f'mean{VOLUME_SLICES_SUFFIX}').write_bytes(
+                    len(header).to_bytes(VOLUME_SLICES_HEADER_SIZE, 'little') + header +
+                    b''.join(itertools.chain.from_iterable(members)))
+                slice_url = '/api/buckets/vol/fet/volumes/mean/slices'
+                response = self.client.get(f'{slice_url}/0/1.npy', headers={'Accept-Encoding': 'gzip'})
+                self.ok(response)
+                self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+                self.assertEqual(gzip.decompress(response.get_data()), b'axis0 slice1')
+                etag = response.headers['ETag']
+                self.assertIn('Last-Modified', response.headers)
+                response = self.client.get(
+                    f'{slice_url}/0/1.npy', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response.headers['ETag'], etag)
+                response = self.client.get(
+                    f'{slice_url}/0/0.npy', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+                self.ok(response)
+                self.assertNotEqual(response.headers['ETag'], etag)
+                response = self.client.get(f'{slice_url}/2/0.npy', headers={'Accept-Encoding': 'identity'})
+                self.ok(response)
+                self.assertEqual(response.get_data(), b'axis2 slice0')
+                self.assertNotIn('-gzip', response.headers['ETag'])
+                self.assertEqual(self.client.get(f'{slice_url}/1/1.npy').status_code, 404)
+                self.assertEqual(self.client.get(f'{slice_url}/3/0.npy').status_code, 404)
+                self.assertEqual(
+                    self.client.get('/api/buckets/vol/fet/volumes/std/slices/0/0.npy').status_code, 404)
+
+                # Deleting the feature deletes its sidecar volumes.
+                self.ok_tuple(delete_features('vol', 'fet'))
+                self.assertFalse(volumes_dir.exists())
+        finally:
+            FEATURES_DIR = original_features_dir
+
+    def test_http_caching(self):
+        global FEATURES_DIR
+        original_features_dir = FEATURES_DIR
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                FEATURES_DIR = Path(tmpdir)
+                for alias, bucket_uuid in (('user', 'hhhhhhhhhhhhhhhhhh'),
+                                           ('ephys', 'iiiiiiiiiiiiiiiiii')):
+                    metadata = create_bucket_metadata(bucket_uuid, alias=alias)
+                    self.ok_tuple(create_bucket(bucket_uuid, metadata, alias=alias))
+                    self.ok_tuple(create_features(alias, 'fet', {'mappings': {}}))
+
+                # Feature validators.
+                response = self.client.get('/api/buckets/user/fet')
+                self.ok(response)
+                etag = response.headers['ETag']
+                last_modified = response.headers['Last-Modified']
+                self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+
+                response = self.client.get(
+                    '/api/buckets/user/fet', headers={'If-None-Match': etag})
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response.get_data(), b'')
+                self.assertEqual(response.headers['ETag'], etag)
+                response = self.client.get(
+                    '/api/buckets/user/fet', headers={'If-Modified-Since': last_modified})
+                self.assertEqual(response.status_code, 304)
+                response = self.client.get(
+                    '/api/buckets/user/fet', headers={'If-None-Match': '"other"'})
+                self.ok(response)
+
+                # Native buckets can be cached without revalidation.
+                response = self.client.get('/api/buckets/ephys/fet')
+                self.assertEqual(
+                    response.headers['Cache-Control'], f'public, max-age={NATIVE_CACHE_MAX_AGE}')
+
+                # Bucket listing validators.
+                response = self.client.get('/api/buckets/user')
+                self.ok(response)
+                etag = response.headers['ETag']
+                response = self.client.get('/api/buckets/user', headers={'If-None-Match': etag})
+                self.assertEqual(response.status_code, 304)
+                self.ok_tuple(create_features('user', 'fet2', {'mappings': {}}))
+                response = self.client.get('/api/buckets/user', headers={'If-None-Match': etag})
+                self.ok(response)
+                self.assertIn('fet2', response.json['features'])
+        finally:
+            FEATURES_DIR = original_features_dir
+
+    def test_compressed_features(self):
+        global FEATURES_DIR
+        original_features_dir = FEATURES_DIR
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                FEATURES_DIR = Path(tmpdir)
+                metadata = create_bucket_metadata('jjjjjjjjjjjjjjjjjj', alias='gz')
+                self.ok_tuple(create_bucket('jjjjjjjjjjjjjjjjjj', metadata, alias='gz'))
+                feature_data = {'mappings': {'beryl': {'data': {'1': {'mean': 42}}}}}
+                self.ok_tuple(create_features('gz', 'fet', feature_data))
+                features_path = get_bucket_path('gz') / 'fet.json'
+                gz_path = get_compressed_sibling_path(features_path, '.gz')
+                self.assertTrue(gz_path.exists())
+
+                url = '/api/buckets/gz/fet'
+                response = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+                self.ok(response)
+                self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+                self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+                self.assertEqual(gzip.decompress(response.get_data()), features_path.read_bytes())
+                gzip_etag = response.headers['ETag']
+                response.close()
+
+                response = self.client.get(url)
+                self.ok(response)
+                self.assertNotIn('Content-Encoding', response.headers)
+                self.assertNotEqual(response.headers['ETag'], gzip_etag)
+                self.assertEqual(response.json['feature_data'], feature_data)
+                response.close()
+
+                # A sibling older than the JSON file is ignored.
+                os.utime(gz_path, ns=(0, 0))
+                response = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+                self.assertNotIn('Content-Encoding', response.headers)
+                response.close()
+
+                self.ok_tuple(delete_features('gz', 'fet'))
+                self.assertFalse(gz_path.exists())
+        finally:
+            FEATURES_DIR = original_features_dir
+
+    def test_migrate_features(self):
+        global FEATURES_DIR
+        original_features_dir = FEATURES_DIR
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                FEATURES_DIR = Path(tmpdir)
+                metadata = create_bucket_metadata('llllllllllllllllll', alias='mig')
+                self.ok_tuple(create_bucket('llllllllllllllllll', metadata, alias='mig'))
+                feature_data = {'mappings': {'beryl': {'data': {'1': {'mean': 42}}}}}
+                self.ok_tuple(create_features('mig', 'new', feature_data))
+                bucket_path = get_bucket_path('mig')
+                self.assertTrue(is_compact_features_file(bucket_path / 'new.json'))
+
+                # A feature file in the legacy indented format is still served as is.
+                old_path = bucket_path / 'old.json'
+                with open(old_path, 'w') as f:
+                    json.dump({'feature_data': feature_data, 'short_desc': 'old'}, f, indent=1)
+                self.assertFalse(is_compact_features_file(old_path))
+                response = self.client.get('/api/buckets/mig/old')
+                self.assertEqual(response.json['feature_data'], feature_data)
+                response.close()
+
+                self.assertEqual(migrate_features(), 1)
+                self.assertTrue(is_compact_features_file(old_path))
+                self.assertNotIn(b'\n', old_path.read_bytes())
+                self.assertTrue(get_compressed_sibling_path(old_path, '.gz').exists())
+                manifest = load_bucket_manifest(bucket_path)
+                self.assertEqual(manifest['mtimes']['old'], old_path.stat().st_mtime_ns)
+                self.assertEqual(manifest['features']['old']['short_desc'], 'old')
+                response = self.client.get('/api/buckets/mig/old')
+                self.assertEqual(response.json['feature_data'], feature_data)
+                response.close()
+
+                # Migrating twice is a no-op, and does not recompress the siblings.
+                siblings = [
+                    get_compressed_sibling_path(bucket_path / f'{fname}.json', suffix)
+                    for fname in ('new', 'old') for _, suffix in COMPRESSED_SUFFIXES]
+                siblings = [path for path in siblings if path.exists()]
+                mtimes = [path.stat().st_mtime_ns for path in siblings]
+                self.assertEqual(migrate_features(), 0)
+                self.assertEqual([path.stat().st_mtime_ns for path in siblings], mtimes)
+
+                # A missing sibling is written again.
+                get_compressed_sibling_path(old_path, '.gz').unlink()
+                self.assertEqual(migrate_features(), 0)
+                self.assertTrue(get_compressed_sibling_path(old_path, '.gz').exists())
+        finally:
+            FEATURES_DIR = original_features_dir
+
+    def test_range_requests(self):
+        global FEATURES_DIR
+        original_features_dir = FEATURES_DIR
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                FEATURES_DIR = Path(tmpdir)
+                metadata = create_bucket_metadata('kkkkkkkkkkkkkkkkkk', alias='range')
+                self.ok_tuple(create_bucket('kkkkkkkkkkkkkkkkkk', metadata, alias='range'))
+                self.ok_tuple(create_features('range', 'fet', {'mappings': {'beryl': {}}}))
+                contents = (get_bucket_path('range') / 'fet.json').read_bytes()
+
+                url = '/api/buckets/range/fet?download=1'
+                response = self.client.get(url)
+                self.ok(response)
+                self.assertEqual(response.headers['Accept-Ranges'], 'bytes')
+                self.assertIn('attachment', response.headers['Content-Disposition'])
+                etag = response.headers['ETag']
+                response.close()
+
+                # Resume a download.
+                response = self.client.get(
+                    url, headers={'Range': 'bytes=10-', 'If-Range': etag})
+                self.assertEqual(response.status_code, 206)
+                self.assertEqual(response.get_data(), contents[10:])
+                response.close()
+
+                # The full file is sent again if it changed in the meantime.
+                response = self.client.get(
+                    url, headers={'Range': 'bytes=10-', 'If-Range': '"stale"'})
+                self.ok(response)
+                self.assertEqual(response.get_data(), contents)
+                response.close()
+        finally:
+            FEATURES_DIR = original_features_dir
+
     def test_server(self):
         # Ensure the directory does not exist before running the tests.
         path = FEATURES_DIR / 'myuuid'
@@ -839,8 +1816,18 @@ if __name__ == '__main__':
         test_runner = unittest.TextTestRunner(verbosity=3, failfast=True)
         test_runner.run(test_suite)
 
+    # Rebuild the feature manifests of all buckets
+    elif sys.argv[-1] == 'rebuild-manifests':
+        rebuild_manifests()
+
+    # Rewrite all feature files in the compact on-disk format
+    elif sys.argv[-1] == 'migrate-features':
+        migrate_features()
+
     # Run server
     else:
+        build_bucket_index()
+        start_access_log_flusher()
         context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
         context.load_cert_chain('localhost.pem', 'localhost-key.pem')
         app.run(ssl_context=context, debug=True)
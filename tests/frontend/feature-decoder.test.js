@@ -0,0 +1,86 @@
+import test from 'node:test';
+import assert from 'node:assert/strict';
+
+const { decodeFeaturePayload } = await import('../../js/feature-decoder.js');
+
+function makeNpy(shape, values, bounds) {
+    // NPY v1.0 file of uint8 values followed by float32 bounds, as written by tools/volumes.py.
+    let header = `{'descr': '|u1', 'fortran_order': False, 'shape': (${shape.join(', ')}), }`;
+    header = header.padEnd(64 - 10 - 1) + '\n';
+    const bytes = new Uint8Array(10 + header.length + values.length + 8);
+    bytes.set([0x93, ...Array.from('NUMPY', (c) => c.charCodeAt(0)), 1, 0, header.length, 0]);
+    bytes.set(Array.from(header, (c) => c.charCodeAt(0)), 10);
+    bytes.set(values, 10 + header.length);
+    bytes.set(new Uint8Array(new Float32Array(bounds).buffer), 10 + header.length + values.length);
+    return bytes;
+}
+
+test('decodeFeaturePayload loads the coarsest mip level and lists the finer ones', async () => {
+    const files = {
+        '/volumes/mean.npy': makeNpy([2, 2, 2], [1, 2, 3, 4, 5, 6, 7, 8], [0, 1]),
+        '/volumes/mean.npy?level=1': makeNpy([1, 1, 1], [4], [0, 1]),
+    };
+    const fetched = [];
+    const originalFetch = globalThis.fetch;
+    globalThis.fetch = async (url) => {
+        fetched.push(url);
+        return { ok: true, arrayBuffer: async () => files[url].buffer };
+    };
+
+    try {
+        const featureData = await decodeFeaturePayload({
+            feature_data: {
+                volumes: {
+                    mean: { volume: { href: 'mean.npy', levels: [{ href: 'mean.npy?level=1', shape: [1, 1, 1] }] } },
+                    std: { volume: { href: 'mean.npy' } },
+                },
+            },
+        }, '/volumes');
+
+        const mean = featureData.volumes.mean;
+        assert.deepEqual(mean.volume.shape, [1, 1, 1]);
+        assert.deepEqual(Array.from(mean.volume.data.slice(0, 1)), [4]);
+        assert.deepEqual(mean.refinements, ['mean.npy']);
+        assert.deepEqual(featureData.volumes.std.volume.shape, [2, 2, 2]);
+        assert.equal(featureData.volumes.std.refinements, undefined);
+        assert.deepEqual(fetched.sort(), ['/volumes/mean.npy', '/volumes/mean.npy?level=1']);
+    }
+    finally {
+        globalThis.fetch = originalFetch;
+    }
+});
+
+test('decodeFeaturePayload does not list the native level of a volume stored slice by slice', async () => {
+    const files = { '/volumes/mean.npy?level=1': makeNpy([1, 1, 1], [4], [0, 1]) };
+    const fetched = [];
+    const originalFetch = globalThis.fetch;
+    globalThis.fetch = async (url) => {
+        fetched.push(url);
+        return { ok: true, arrayBuffer: async () => files[url].buffer };
+    };
+
+    try {
+        const featureData = await decodeFeaturePayload({
+            feature_data: {
+                volumes: {
+                    mean: {
+                        volume: {
+                            href: 'mean.npy',
+                            levels: [{ href: 'mean.npy?level=1', shape: [1, 1, 1] }],
+                            slices: 'mean/slices',
+                            shape: [2, 2, 2],
+                        },
+                    },
+                },
+            },
+        }, '/volumes');
+
+        const mean = featureData.volumes.mean;
+        assert.deepEqual(mean.refinements, []);
+        assert.deepEqual(mean.slices, { href: 'mean/slices', shape: [2, 2, 2] });
+        assert.deepEqual(fetched, ['/volumes/mean.npy?level=1']);
+    }
+    finally {
+        globalThis.fetch = originalFetch;
+    }
+});
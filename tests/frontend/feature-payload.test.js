@@ -2,6 +2,7 @@ import test from 'node:test';
 import assert from 'node:assert/strict';
 
 import {
+    expandColumnarMappings,
     getFeatureCmap,
     getFeatureHistogram,
     getFeatureMappingData,
@@ -50,3 +51,30 @@ test('getFeatureVolumeData returns payload without mutating it', () => {
     assert.equal(Object.hasOwn(payload.volumes, 'is_volume'), false);
     assert.equal(getFeatureVolumeData({}), null);
 });
+
+test('expandColumnarMappings rebuilds per-region data from columns', () => {
+    const payload = {
+        mappings: {
+            allen: {
+                columns: {
+                    ids: [10, 20],
+                    values: { mean: [1.5, null], count: [3, 0] },
+                    histogram_keys: ['h_000', 'h_001'],
+                    histogram: [[2, 0], [0, 1]],
+                },
+                statistics: { mean: { min: 1.5, max: 1.5 } },
+            },
+            beryl: { data: { 10: { mean: 1 } } },
+        },
+    };
+
+    assert.equal(expandColumnarMappings(payload), payload);
+    assert.deepEqual(payload.mappings.allen.data, {
+        10: { mean: 1.5, count: 3, h_000: 2 },
+        20: { mean: null, count: 0, h_001: 1 },
+    });
+    assert.equal(Object.hasOwn(payload.mappings.allen, 'columns'), false);
+    assert.deepEqual(payload.mappings.beryl.data, { 10: { mean: 1 } });
+    assert.deepEqual(getFeatureMappings(payload), ['allen']);
+    assert.equal(expandColumnarMappings(null), null);
+});
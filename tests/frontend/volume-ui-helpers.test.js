@@ -1,7 +1,14 @@
 import test from 'node:test';
 import assert from 'node:assert/strict';
 
-import { buildVolumeVisibilityRules, getVolumeSliderMax, getVolumeSliceIndex } from '../../js/core/volume-ui-helpers.js';
+import {
+    buildVolumeVisibilityRules,
+    getVolumeSliceIndex,
+    getVolumeSliceRequest,
+    getVolumeSliderMax,
+    makeVolumeSliceSession,
+} from '../../js/core/volume-ui-helpers.js';
+import { computeAxisMapping, indexFromAxisCoords } from '../../js/core/volume-helpers.js';
 
 test('buildVolumeVisibilityRules returns overlay rules for visible volume mode', () => {
     assert.deepEqual(buildVolumeVisibilityRules(true), [
@@ -34,3 +41,35 @@ test('getVolumeSliceIndex clamps and converts slider values to slice indices', (
     assert.equal(getVolumeSliceIndex(50, 2, 20), 10);
     assert.equal(getVolumeSliceIndex(50, 1, 0), 0);
 });
+
+test('getVolumeSliceRequest returns the native slice of a view axis in the stored array', () => {
+    const mapping = computeAxisMapping([456, 528, 320], { coronal: 528, horizontal: 320, sagittal: 456 });
+    assert.deepEqual(getVolumeSliceRequest('coronal', 100, 'mean/slices', mapping), {
+        rawAxis: 1,
+        index: 40,
+        href: 'mean/slices/1/40.npy',
+    });
+    assert.equal(getVolumeSliceRequest('sagittal', 1e6, 'mean/slices', mapping).href, 'mean/slices/0/455.npy');
+});
+
+test('makeVolumeSliceSession indexes a slice as the volume it was taken from', () => {
+    const axes = ['coronal', 'horizontal', 'sagittal'];
+    const shape = [4, 3, 2];
+    const mapping = computeAxisMapping(shape, { coronal: 4, horizontal: 2, sagittal: 3 });
+    const volume = Uint8Array.from({ length: 24 }, (_, i) => i);
+    const rawAxis = mapping.axisToRaw.sagittal;
+    assert.equal(rawAxis, 1);
+    // Slice 2 along the stored axis 1, in C order, as np.take(volume, 2, axis=1).
+    const data = Uint8Array.from({ length: 8 }, (_, i) => volume[Math.floor(i / 2) * 6 + 2 * 2 + (i % 2)]);
+    const session = makeVolumeSliceSession('sagittal', { data, fortran_order: false, bounds: [0, 1] }, mapping);
+    assert.deepEqual(session.shape, [4, 1, 2]);
+    assert.equal(session.rawAxis, 1);
+    for (let c = 0; c < 4; c++) {
+        for (let h = 0; h < 2; h++) {
+            const coords = { coronal: c, horizontal: h };
+            const full = indexFromAxisCoords(axes.map((axis) => coords[axis] ?? 2), mapping.rawToAxis, shape, false, axes);
+            const sliced = indexFromAxisCoords(axes.map((axis) => coords[axis] ?? 0), session.rawToAxis, session.shape, false, axes);
+            assert.equal(session.volume[sliced], volume[full]);
+        }
+    }
+});
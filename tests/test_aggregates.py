@@ -0,0 +1,217 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from tools.aggregates import (
+    QuantileSketch,
+    RangeCache,
+    RegionAccumulator,
+    compute_range,
+    compute_ranges,
+    get_aggregates,
+    get_histogram_groupby,
+)
+
+
+def reference_range(values, q=0.02):
+    # Former pandas implementation of compute_range().
+    values = pd.Series(values).replace([np.inf, -np.inf], np.nan).dropna()
+    if values.empty:
+        return 0.0, 1.0
+    vmin, vmax = (float(v) for v in values.quantile([q, 1 - q]))
+    if not np.isfinite(vmin) or not np.isfinite(vmax) or vmin >= vmax:
+        vmin = float(values.min())
+        vmax = float(values.max())
+    if not np.isfinite(vmin) or not np.isfinite(vmax) or vmin >= vmax:
+        vmax = vmin + 1e-12
+    return vmin, vmax
+
+
+def reference_histogram_groupby(df, n_bins):
+    # Former per-group implementation of get_histogram_groupby(), based on np.histogram().
+    feature_names = df.obj.select_dtypes(include=[np.number]).columns
+    bin_edges = {}
+    for fname in feature_names:
+        values = df.obj[fname].dropna()
+        if values.empty:
+            bin_edges[fname] = np.linspace(0, 1, n_bins + 1)
+            continue
+        vmin, vmax = compute_range(values)
+        bin_edges[fname] = np.histogram_bin_edges(values, range=(vmin, vmax), bins=n_bins)
+
+    group_hist_data = {bin_idx: {} for bin_idx in range(n_bins)}
+    for group_name, group_df in df:
+        for col in feature_names:
+            counts, _ = np.histogram(group_df[col].dropna(), bins=bin_edges[col])
+            for bin_idx in range(n_bins):
+                group_hist_data[bin_idx].setdefault(group_name, {})[col] = counts[bin_idx]
+
+    return {
+        f"h_{bin_idx:03}": pd.DataFrame.from_dict(
+            group_hist_data[bin_idx], orient="index").astype(np.int32)
+        for bin_idx in range(n_bins)
+    }, bin_edges
+
+
+def reference_aggregates(df):
+    # Former implementation of get_aggregates(), with one groupby pass per statistic.
+    out = {
+        "mean": df.mean(numeric_only=True),
+        "median": df.median(numeric_only=True),
+        "std": df.std(ddof=0, numeric_only=True),
+        "min": df.min(),
+        "max": df.max(),
+        "count": df.count().astype(np.int32),
+    }
+    q5 = df.quantile(0.05)
+    q95 = df.quantile(0.95)
+    uncertainty = (df.median() - df.mean()) / (q95 - q5)
+    uncertainty[np.isnan(uncertainty)] = 0
+    out["uncertainty"] = uncertainty
+    return out
+
+
+class TestAggregates(unittest.TestCase):
+    def make_grouped(self, n=5000):
+        rng = np.random.default_rng(0)
+        df = pd.DataFrame({
+            "normal": rng.normal(size=n),
+            "exponential": rng.exponential(size=n),
+            "rounded": np.round(rng.normal(size=n), 1),
+            "constant": np.ones(n),
+            "atlas_id": -rng.integers(1, 1000, n).astype(np.int32),
+            "atlas_idx": rng.integers(0, 100, n).astype(np.int32),
+        })
+        df.loc[rng.random(n) < 0.1, "normal"] = np.nan
+        df.loc[rng.random(n) < 0.01, "exponential"] = np.inf
+        df.loc[df["atlas_idx"] == 3, "rounded"] = np.nan
+        return df.groupby("atlas_idx")
+
+    def test_histogram_groupby_matches_reference(self):
+        df = self.make_grouped()
+        for n_bins in (1, 7, 50):
+            expected, expected_edges = reference_histogram_groupby(df, n_bins)
+            out, bin_edges = get_histogram_groupby(df, n_bins=n_bins)
+            self.assertEqual(list(out), list(expected))
+            for key in expected:
+                pd.testing.assert_frame_equal(out[key], expected[key])
+            for fname in expected_edges:
+                np.testing.assert_array_equal(bin_edges[fname], expected_edges[fname])
+
+    def test_aggregates_match_reference(self):
+        df = self.make_grouped()
+        out, _ = get_aggregates(df)
+        for stat, expected in reference_aggregates(df).items():
+            pd.testing.assert_frame_equal(out[stat], expected, rtol=1e-9, obj=stat)
+        expected_hist, _ = get_histogram_groupby(df)
+        for key, expected in expected_hist.items():
+            pd.testing.assert_frame_equal(out[key], expected)
+
+    def test_accumulator_matches_aggregates(self):
+        df = self.make_grouped()
+        expected, expected_edges = get_aggregates(df)
+        columns = ["normal", "exponential", "rounded", "constant", "atlas_id"]
+        chunks = [df.obj.iloc[i:i + 700] for i in range(0, len(df.obj), 700)]
+        acc = RegionAccumulator(columns)
+        for chunk in chunks[:4]:
+            acc.update(chunk)
+        other = RegionAccumulator(columns)
+        for chunk in chunks[4:]:
+            other.update(chunk)
+        acc.merge(other)
+        self.assertEqual(len(acc), len(df.obj))
+        self.assertEqual(list(acc.aggregates()[0]), list(expected))
+        # Groups have fewer rows than the region sketches hold, so their aggregates are exact.
+        out = acc.statistics()
+        for stat in out:
+            pd.testing.assert_frame_equal(out[stat], expected[stat][columns], obj=stat)
+        ranges = {fname: (expected_edges[fname][0], expected_edges[fname][-1]) for fname in columns}
+        hist, bin_edges = acc.histograms(ranges=ranges)
+        for key in hist:
+            pd.testing.assert_frame_equal(hist[key], expected[key][columns], obj=key)
+        for fname in columns:
+            np.testing.assert_allclose(bin_edges[fname], expected_edges[fname])
+
+    def test_accumulator_memory(self):
+        rng = np.random.default_rng(0)
+        acc = RegionAccumulator(["normal", "exponential"], sketch_size=256, region_sketch_size=32)
+        sizes = {}
+        expected_counts = np.zeros(10)
+        for i in range(1, 201):
+            chunk = pd.DataFrame({
+                "normal": rng.normal(size=2000),
+                "exponential": rng.exponential(size=2000),
+                "atlas_idx": rng.integers(0, 20, 2000),
+            })
+            acc.update(chunk)
+            expected_counts += np.histogram(chunk["normal"], bins=10, range=(-2, 2))[0]
+            sizes[i] = acc.nbytes
+        # Ten times more rows, while the state only grows with the number of sketch levels.
+        self.assertLess(sizes[200], 2 * sizes[20])
+        self.assertLess(sizes[200], 200 * 2000 * 2 * 8 / 50)
+        self.assertEqual(acc.statistics()["count"].to_numpy().sum(), 200 * 2000 * 2)
+        medians = acc.statistics()["median"]["normal"]
+        self.assertLess(np.abs(medians).max(), 0.1)
+        # The weighted values kept for a column stand for all its values, in bounded memory.
+        values, weights = acc.weighted_values("normal")
+        self.assertEqual(weights.sum(), 200 * 2000)
+        self.assertLess(values.nbytes + weights.nbytes, sizes[200])
+        counts, _ = np.histogram(values, bins=10, range=(-2, 2), weights=weights)
+        # With 32 values per region and level, single bins are only roughly approximated.
+        np.testing.assert_allclose(counts.sum(), expected_counts.sum(), rtol=0.01)
+        np.testing.assert_allclose(counts, expected_counts, rtol=0.25)
+
+    def test_compute_range_matches_reference(self):
+        rng = np.random.default_rng(0)
+        columns = {
+            "normal": rng.normal(size=1001) * 1e3,
+            "float32": rng.exponential(size=777).astype(np.float32),
+            "int": rng.integers(-5, 5, 500),
+            "inf": np.r_[rng.normal(size=100), [np.inf, -np.inf, np.nan] * 10],
+            "constant": np.ones(10),
+            "two_values": np.r_[np.zeros(50), np.ones(2)],
+            "empty": np.array([np.nan, np.inf]),
+        }
+        for name, values in columns.items():
+            self.assertEqual(compute_range(values), reference_range(values), name)
+            self.assertEqual(compute_range(pd.Series(values)), reference_range(values), name)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = RangeCache(Path(tmpdir) / "cache/ranges.json")
+            ranges = compute_ranges(columns, cache=cache)
+            self.assertEqual(ranges, {name: reference_range(values) for name, values in columns.items()})
+            cache.save()
+            cache = RangeCache(cache.path)
+            self.assertEqual(len(cache.ranges), len(columns))
+            self.assertEqual(compute_ranges(columns, cache=cache), ranges)
+            self.assertEqual(len(cache.ranges), len(columns))
+
+    def test_quantile_sketch(self):
+        rng = np.random.default_rng(0)
+        values = rng.lognormal(size=200_000)
+        values[rng.random(len(values)) < 0.01] = np.nan
+        sketches = [QuantileSketch(k=256) for _ in range(3)]
+        for i, chunk in enumerate(np.array_split(values, 40)):
+            sketches[i % 3].update(chunk)
+        sketch = sketches[0].merge(sketches[1]).merge(sketches[2])
+
+        finite = np.sort(values[np.isfinite(values)])
+        self.assertEqual(sketch.n, len(finite))
+        self.assertLess(sketch.rank_error(), 0.05)
+        self.assertLess(sum(len(level) for level in sketch.levels), 256 * len(sketch.levels))
+        qs = [0.02, 0.25, 0.5, 0.98]
+        for q, value in zip(qs, sketch.quantile(qs)):
+            rank = np.searchsorted(finite, value) / (len(finite) - 1)
+            self.assertLessEqual(abs(rank - q), sketch.rank_error() + 1e-3)
+
+        vmin, vmax = sketch.range()
+        self.assertLess(vmin, vmax)
+        self.assertEqual(QuantileSketch().update(np.ones(10)).range(), (1.0, 1.0 + 1e-12))
+        self.assertEqual(QuantileSketch().range(), (0.0, 1.0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+from tools.atlas_index import atlas_ids_to_index, build_atlas_index_table, load_atlas_index_table
+
+
+class Regions:
+    # Minimal stand-in of iblatlas BrainRegions: ids of both hemispheres, with a duplicate.
+    def __init__(self):
+        self.id = np.array([0, 997, 8, 567, -8, -567, 614454277, -614454277, 8])
+
+    def id2index(self, ids):
+        return ids, [np.flatnonzero(self.id == i) for i in ids]
+
+
+class TestAtlasIndex(unittest.TestCase):
+    def test_lookup_matches_id2index(self):
+        br = Regions()
+        table = build_atlas_index_table(br)
+        atlas_ids = np.array([8, -8, 567, -614454277, 0, 8, -567], dtype=np.int32)
+        expected = [_[0] for _ in br.id2index(atlas_ids)[1]]
+        idx = atlas_ids_to_index(table, atlas_ids)
+        self.assertEqual(idx.dtype, np.int32)
+        self.assertEqual(idx.tolist(), expected)
+        with self.assertRaises(ValueError):
+            atlas_ids_to_index(table, [8, 12345])
+        with self.assertRaises(ValueError):
+            atlas_ids_to_index(table, [10 ** 10])
+
+    def test_cache(self):
+        loads = []
+
+        def make_brain_regions():
+            loads.append(1)
+            return Regions()
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "cache/atlas_index.npz"
+            ids, idx = load_atlas_index_table(path, "1.0", make_brain_regions)
+            self.assertTrue(path.exists())
+            cached_ids, cached_idx = load_atlas_index_table(path, "1.0", make_brain_regions)
+            self.assertEqual(len(loads), 1)
+            np.testing.assert_array_equal(cached_ids, ids)
+            np.testing.assert_array_equal(cached_idx, idx)
+            # A new iblatlas version rebuilds the table.
+            load_atlas_index_table(path, "2.0", make_brain_regions)
+            self.assertEqual(len(loads), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+import importlib.util
+import tempfile
+import unittest
+from pathlib import Path
+
+import pandas as pd
+
+
+@unittest.skipIf(importlib.util.find_spec("pyarrow") is None, "pyarrow is not installed")
+class TestClusterDataset(unittest.TestCase):
+    def test_partition_schemas(self):
+        from tools.cluster_dataset import (
+            iter_cluster_dataset,
+            list_cluster_partitions,
+            read_cluster_dataset,
+            write_cluster_partition,
+        )
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dataset_dir = Path(tmpdir) / "clusters_dataset"
+            # The first partition lacks a column, and stores another one as int instead of float.
+            write_cluster_partition(dataset_dir, "a", pd.DataFrame({"atlas_id": [1, 2], "amp": [3, 4]}))
+            write_cluster_partition(
+                dataset_dir, "b", pd.DataFrame({"atlas_id": [5], "amp": [6.5], "firing_rate": [7.5]})
+            )
+            write_cluster_partition(dataset_dir, "c", pd.DataFrame({"atlas_id": [8], "amp": [9.5]}))
+            self.assertEqual(list_cluster_partitions(dataset_dir), {"a", "b", "c"})
+
+            columns = ["pid", "atlas_id", "amp", "firing_rate", "unknown"]
+            df = read_cluster_dataset(dataset_dir, ["a", "b"], columns=columns)
+            df = df.sort_values("atlas_id").reset_index(drop=True)
+            self.assertEqual(list(df.columns), ["pid", "atlas_id", "amp", "firing_rate"])
+            self.assertEqual(df["pid"].tolist(), ["a", "a", "b"])
+            self.assertEqual(df["amp"].tolist(), [3.0, 4.0, 6.5])
+            self.assertTrue(df["firing_rate"][:2].isna().all())
+            self.assertEqual(df["firing_rate"][2], 7.5)
+
+            batches = list(iter_cluster_dataset(dataset_dir, ["b", "c"], columns=columns))
+            self.assertEqual(sorted(pd.concat(batches)["amp"]), [6.5, 9.5])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,39 @@
+import gzip
+import json
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from tools import feature_files
+from tools.feature_files import get_compressed_sibling_path, save_features, write_compressed_siblings
+
+
+class TestFeatureFiles(unittest.TestCase):
+    def test_compressed_siblings(self):
+        data = {"feature_data": {"mappings": {"allen": {"data": {str(i): {"mean": i} for i in range(5000)}}}}}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "fet.json"
+            with mock.patch.object(feature_files.gzip, "GzipFile", wraps=gzip.GzipFile) as gzip_file:
+                save_features(path, data)
+                self.assertEqual(gzip_file.call_args.kwargs["compresslevel"], feature_files.FAST_GZIP_LEVEL)
+                fast = get_compressed_sibling_path(path, ".gz").read_bytes()
+                write_compressed_siblings(path, best=True)
+                self.assertEqual(gzip_file.call_args.kwargs["compresslevel"], feature_files.BEST_GZIP_LEVEL)
+            best = get_compressed_sibling_path(path, ".gz").read_bytes()
+            self.assertEqual(gzip.decompress(fast), path.read_bytes())
+            self.assertEqual(gzip.decompress(best), path.read_bytes())
+            self.assertEqual(json.loads(path.read_bytes()), data)
+            self.assertEqual(sorted(p.name for p in Path(tmpdir).iterdir()), ["fet.json", "fet.json.gz"])
+
+    @unittest.skipIf(feature_files.brotli is None, "brotli is not installed")
+    def test_brotli_sibling(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "fet.json"
+            save_features(path, {"a": list(range(1000))})
+            br = get_compressed_sibling_path(path, ".br").read_bytes()
+            self.assertEqual(feature_files.brotli.decompress(br), path.read_bytes())
+
+
+if __name__ == "__main__":
+    unittest.main()
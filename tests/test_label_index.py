@@ -0,0 +1,72 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+from tools.label_index import build_label_index, load_label_index
+
+
+class TestLabelIndex(unittest.TestCase):
+    def test_mask(self):
+        rng = np.random.default_rng(0)
+        label = rng.choice([0, 3, 7, 12], size=(6, 5, 4))
+        index = build_label_index(label)
+        self.assertEqual(index.labels.tolist(), [0, 3, 7, 12])
+        self.assertEqual(len(index), 4)
+        for value in (0, 3, 7, 12):
+            np.testing.assert_array_equal(index.mask(value), label == value)
+        self.assertFalse(index.mask(5).any())
+        self.assertFalse(index.mask(13).any())
+
+    def test_reduce(self):
+        # Per-label statistics and histograms, as computed by the iblbrainviewer
+        # histogrammer from the mask of every label.
+        rng = np.random.default_rng(1)
+        label = rng.choice([0, 3, 7, 12], size=(6, 5, 4))
+        volume = rng.normal(size=label.shape).astype(np.float32)
+        volume[label == 0] = np.nan
+        volume[0, 0, :2] = np.nan
+        bin_edges = np.linspace(-1.5, 1.5, 11)
+        index = build_label_index(label)
+        reduced = index.reduce(volume, bin_edges)
+        self.assertEqual(reduced["histograms"].shape, (10, 4))
+        for i, value in enumerate(index.labels):
+            values = volume[label == value]
+            values = values[~np.isnan(values)]
+            self.assertEqual(reduced["count"][i], values.size)
+            if not values.size:
+                self.assertEqual(reduced["sum"][i], 0)
+                self.assertFalse(reduced["histograms"][:, i].any())
+                continue
+            mean = reduced["sum"][i] / reduced["count"][i]
+            std = np.sqrt(reduced["sumsq"][i] / reduced["count"][i] - mean ** 2)
+            self.assertAlmostEqual(mean, values.mean(dtype=np.float64))
+            self.assertAlmostEqual(std, values.std(dtype=np.float64))
+            counts, _ = np.histogram(values, bins=bin_edges)
+            np.testing.assert_array_equal(reduced["histograms"][:, i], counts)
+        with self.assertRaises(ValueError):
+            index.reduce(volume[:-1], bin_edges)
+
+    def test_cache(self):
+        loads = []
+        label = np.arange(24).reshape(2, 3, 4) % 5
+
+        def make_label_volume():
+            loads.append(1)
+            return label
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "cache/label_index_25um.npz"
+            index = load_label_index(path, "1.0", make_label_volume)
+            cached = load_label_index(path, "1.0", make_label_volume)
+            self.assertEqual(len(loads), 1)
+            self.assertEqual(cached.shape, index.shape)
+            np.testing.assert_array_equal(cached.order, index.order)
+            np.testing.assert_array_equal(cached.mask(3), label == 3)
+            load_label_index(path, "2.0", make_label_volume)
+            self.assertEqual(len(loads), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+from tools.npz import get_npz_member_shape, open_npz_member, write_feature_major
+
+
+class TestNpz(unittest.TestCase):
+    def test_open_npz_member(self):
+        rng = np.random.default_rng(0)
+        arrays = {
+            "vol": rng.normal(size=(4, 5, 6, 3)).astype(np.float32),
+            "fortran": np.asfortranarray(rng.integers(0, 100, (7, 8))),
+            "names": np.array(["a", "bb", "ccc"]),
+        }
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for save in (np.savez, np.savez_compressed):
+                path = Path(tmpdir) / f"{save.__name__}.npz"
+                save(path, **arrays)
+                for name, expected in arrays.items():
+                    self.assertEqual(get_npz_member_shape(path, name), expected.shape)
+                    array = open_npz_member(path, name, tmp_dir=tmpdir)
+                    self.assertIsInstance(array, np.memmap)
+                    self.assertEqual(array.dtype, expected.dtype)
+                    np.testing.assert_array_equal(array, expected)
+                    with self.assertRaises(ValueError):
+                        array[0] = array[0]
+            # Extracted members do not leave files behind.
+            self.assertEqual(sorted(p.name for p in Path(tmpdir).iterdir()), ["savez.npz", "savez_compressed.npz"])
+
+    def test_write_feature_major(self):
+        rng = np.random.default_rng(1)
+        vol4d = rng.normal(size=(9, 4, 5, 3))
+        scale = np.array([1, 2, 3], dtype=np.float32)
+
+        def transform(block, index):
+            block *= scale[:, None, None, None]
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "features.npy"
+            for axis_perm in [(0, 1, 2), (2, 0, 1), (1, 2, 0)]:
+                # Small blocks, so that the rows are written in several passes.
+                out = write_feature_major(vol4d, path, axis_perm, transform=transform, block_bytes=200)
+                self.assertEqual(out.shape, (3,) + tuple(vol4d.shape[axis] for axis in axis_perm))
+                for f in range(3):
+                    self.assertTrue(out[f].flags.c_contiguous)
+                    expected = np.transpose(vol4d[..., f].astype(np.float32), axis_perm) * scale[f]
+                    np.testing.assert_array_equal(out[f], expected)
+            out = write_feature_major(vol4d, path, features=[2, 0])
+            np.testing.assert_array_equal(out, np.moveaxis(vol4d[..., [2, 0]], 3, 0).astype(np.float32))
+            self.assertEqual([p.name for p in Path(tmpdir).iterdir()], ["features.npy"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+import json
+import multiprocessing
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+from tools.profiling import GenerationProfiler
+
+
+class TestGenerationProfiler(unittest.TestCase):
+    def test_report(self):
+        profiler = GenerationProfiler()
+        with profiler.stage("aggregates"):
+            sum(range(10000))
+        worker = GenerationProfiler()
+        for fname in ("a", "b"):
+            with worker.stage("remap", fname):
+                sum(range(10000 if fname == "a" else 100000))
+            with worker.stage("serialize", fname):
+                pass
+        profiler.extend(worker.records)
+        with self.assertRaises(ValueError):
+            with profiler.stage("histograms"):
+                raise ValueError
+
+        report = profiler.report()
+        self.assertEqual(list(report["stages"]), ["aggregates", "remap", "serialize", "histograms"])
+        self.assertEqual(report["stages"]["remap"]["count"], 2)
+        self.assertEqual(list(report["features"]["b"]["stages"]), ["remap", "serialize"])
+        self.assertGreater(report["total"]["peak_rss_mb"], 0)
+        self.assertEqual(profiler.slowest_features(1), ["b"])
+        self.assertIn("Slowest features:", profiler.summary())
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "_profile.json"
+            profiler.save(path)
+            self.assertEqual(set(json.loads(path.read_text())), {"total", "stages", "features"})
+
+    def test_peak_rss_per_stage(self):
+        profiler = GenerationProfiler()
+        with profiler.stage("large"):
+            data = bytearray(b"x") * (200 * 2 ** 20)
+            del data
+        with profiler.stage("small"):
+            data = bytearray(b"x") * (10 * 2 ** 20)
+            del data
+        large, small = (r["peak_rss_mb"] for r in profiler.records)
+        # The second stage does not report the peak of the first one.
+        self.assertGreater(large, small + 100)
+        self.assertGreaterEqual(profiler.report()["total"]["peak_rss_mb"], round(large, 1))
+
+    def test_worker_cpu_time(self):
+        profiler = GenerationProfiler()
+        with profiler.stage("workers"):
+            worker = multiprocessing.get_context("fork").Process(target=_burn_cpu, args=(0.5,))
+            worker.start()
+            worker.join()
+        # The CPU time of the worker process is counted, although the parent only waited.
+        self.assertGreater(profiler.records[0]["cpu_s"], 0.4)
+        self.assertGreater(profiler.report()["total"]["cpu_s"], 0.4)
+
+
+def _burn_cpu(seconds):
+    end = time.process_time() + seconds
+    while time.process_time() < end:
+        pass
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+import base64
+import gzip
+import io
+import json
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+from tools.volumes import (
+    SLICES_HEADER_SIZE,
+    downsample_encoded_volume,
+    externalize_volumes,
+    get_volumes_dir,
+    read_npy_gz,
+)
+
+
+def encode(volume, bounds):
+    # Same layout as the volumes of iblbrainviewer payloads: uint8 NPY, float32 bounds.
+    encoded = np.nan_to_num((volume - bounds[0]) / (bounds[1] - bounds[0]) * 255).astype(np.uint8)
+    with io.BytesIO() as f:
+        np.save(f, encoded)
+        f.write(np.array(bounds, dtype=np.float32).tobytes())
+        return base64.b64encode(gzip.compress(f.getvalue())).decode()
+
+
+class TestVolumes(unittest.TestCase):
+    def test_downsample(self):
+        encoded = np.arange(27, dtype=np.uint8).reshape(3, 3, 3)
+        valid = np.ones(encoded.shape, dtype=bool)
+        valid[0, 0, 0] = valid[2, 2, 2] = False
+        out, out_valid = downsample_encoded_volume(encoded, valid)
+        self.assertEqual(out.shape, (2, 2, 2))
+        self.assertEqual(out.dtype, np.uint8)
+        # The NaN voxel is left out of its block, and a block of NaN voxels keeps their value.
+        self.assertEqual(out[0, 0, 0], np.rint(np.mean([1, 3, 4, 9, 10, 12, 13])))
+        self.assertEqual(out[1, 1, 1], 26)
+        self.assertFalse(out_valid[1, 1, 1])
+        self.assertTrue(out_valid[:, :, 0].all())
+
+    def test_mip_levels(self):
+        rng = np.random.default_rng(0)
+        volume = rng.normal(size=(8, 6, 4)).astype(np.float32)
+        volume[:4] = np.nan
+        payload = {"feature_data": {"volumes": {"mean": {"volume": encode(volume, (-3, 3))}}}}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            externalize_volumes(payload, tmpdir, "fet", {"mean": volume}, mip_levels=2)
+            ref = payload["feature_data"]["volumes"]["mean"]["volume"]
+            self.assertEqual(ref, {
+                "href": "mean.npy",
+                "levels": [
+                    {"href": "mean.npy?level=1", "shape": [4, 3, 2]},
+                    {"href": "mean.npy?level=2", "shape": [2, 2, 1]},
+                ],
+            })
+            volumes_dir = get_volumes_dir(tmpdir, "fet")
+            native, bounds = read_npy_gz((volumes_dir / "mean.npy.gz").read_bytes())
+            level1, level1_bounds = read_npy_gz((volumes_dir / "mean.mip1.npy.gz").read_bytes())
+            self.assertEqual(level1_bounds, bounds)
+            expected = native[4:].reshape(2, 2, 3, 2, 2, 2).mean(axis=(1, 3, 5))
+            np.testing.assert_array_equal(level1[2:], np.rint(expected))
+            np.testing.assert_array_equal(level1[:2], 0)
+
+    def test_slices(self):
+        rng = np.random.default_rng(1)
+        volume = rng.normal(size=(5, 4, 3)).astype(np.float32)
+        payload = {"feature_data": {"volumes": {"mean": {"volume": encode(volume, (-3, 3))}}}}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            externalize_volumes(payload, tmpdir, "fet", slices=True)
+            reference = payload["feature_data"]["volumes"]["mean"]["volume"]
+            self.assertEqual(reference["slices"], "mean/slices")
+            self.assertEqual(reference["shape"], [5, 4, 3])
+            volumes_dir = get_volumes_dir(tmpdir, "fet")
+            native, bounds = read_npy_gz((volumes_dir / "mean.npy.gz").read_bytes())
+            data = (volumes_dir / "mean.slices").read_bytes()
+            header_size = int.from_bytes(data[:SLICES_HEADER_SIZE], "little")
+            header = json.loads(data[SLICES_HEADER_SIZE:SLICES_HEADER_SIZE + header_size])
+            self.assertEqual(header["shape"], [5, 4, 3])
+            body = data[SLICES_HEADER_SIZE + header_size:]
+            for axis in range(3):
+                offsets = header["offsets"][axis]
+                self.assertEqual(len(offsets), native.shape[axis] + 1)
+                for i in range(native.shape[axis]):
+                    plane, plane_bounds = read_npy_gz(body[offsets[i]:offsets[i + 1]])
+                    np.testing.assert_array_equal(plane, np.take(native, i, axis=axis))
+                    self.assertEqual(plane_bounds, bounds)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,721 @@
+"""Per-region aggregates of feature dataframes, used by make_ephys.py.
+
+`get_aggregates()` takes a dataframe grouped by region and returns one dataframe per
+statistic (`mean`, `median`, `std`, `min`, `max`, `count`, `uncertainty`) and per
+histogram bin (`h_000` ... `h_049`), indexed by group and with one column per feature.
+
+`RegionAccumulator` computes the same dataframes from a stream of row chunks, for tables
+that are not loaded in memory at once, with a state that does not grow with the rows.
+
+The histogram range of a feature spans its `RANGE_QUANTILE` and `1 - RANGE_QUANTILE`
+quantiles. `compute_ranges()` computes the ranges of all features at once, exactly or
+from `QuantileSketch` summaries of streamed values, and can reuse them across runs
+through a `RangeCache`.
+"""
+
+import hashlib
+import json
+
+import numpy as np
+import pandas as pd
+
+
+N_BINS = 50
+RANGE_QUANTILE = 0.02
+QUANTILES = (0.05, 0.5, 0.95)  # used for the median and the uncertainty
+SKETCH_SIZE = 4096  # values per level of a QuantileSketch
+REGION_SKETCH_SIZE = 128  # values per group and level of a GroupedSketch
+RANGE_CACHE_MAX_ENTRIES = 4096
+
+
+def finite_values(values):
+    if isinstance(values, (pd.Series, pd.Index)):
+        values = values.to_numpy(dtype=np.float64, na_value=np.nan)
+    values = np.asarray(values, dtype=np.float64)
+    return values[np.isfinite(values)]
+
+
+def _valid_range(vmin, vmax, fallback):
+    # Fall back to the full extent of the values when the quantiles coincide, and to a
+    # tiny range when all values are equal.
+    if not np.isfinite(vmin) or not np.isfinite(vmax) or vmin >= vmax:
+        vmin, vmax = fallback()
+    if not np.isfinite(vmin) or not np.isfinite(vmax) or vmin >= vmax:
+        vmax = vmin + 1e-12
+    return vmin, vmax
+
+
+def compute_range(values, q=RANGE_QUANTILE):
+    """Return the (q, 1 - q) quantiles of the finite values, as `pd.Series.quantile()`."""
+    values = finite_values(values)
+    if not values.size:
+        return 0.0, 1.0
+    vmin, vmax = (float(v) for v in np.quantile(values, [q, 1 - q]))
+    return _valid_range(vmin, vmax, lambda: (float(values.min()), float(values.max())))
+
+
+class QuantileSketch:
+    """Mergeable approximate quantiles of a stream of values, in bounded memory.
+
+    The finite values are kept in levels, a value of level h standing for 2**h input
+    values. A level holding more than `k` values is sorted and every other value is
+    promoted to the next level. Such a compaction moves the rank of any value by at most
+    2**h, so the ranks of the returned quantiles are off by at most `rank_error()` times
+    the number of values, about log2(n / k) / k. Memory is O(k log(n / k)).
+    """
+
+    def __init__(self, k=SKETCH_SIZE):
+        self.k = k
+        self.n = 0
+        self.error = 0  # bound on the rank error, in number of values
+        self.vmin, self.vmax = np.inf, -np.inf
+        self.levels = [np.empty(0)]
+        self._offset = 0
+
+    def update(self, values):
+        values = finite_values(values)
+        if values.size:
+            self.n += values.size
+            self.vmin = min(self.vmin, float(values.min()))
+            self.vmax = max(self.vmax, float(values.max()))
+            self.levels[0] = np.concatenate([self.levels[0], values])
+            self._compact()
+        return self
+
+    def merge(self, other):
+        self.n += other.n
+        self.error += other.error
+        self.vmin, self.vmax = min(self.vmin, other.vmin), max(self.vmax, other.vmax)
+        for h, level in enumerate(other.levels):
+            if h == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[h] = np.concatenate([self.levels[h], level])
+        self._compact()
+        return self
+
+    def _compact(self):
+        h = 0
+        while h < len(self.levels):
+            level = self.levels[h]
+            if len(level) > self.k:
+                level = np.sort(level)
+                # Alternate the kept half between compactions, so that errors do not pile up
+                # on the same side.
+                even = len(level) - len(level) % 2
+                promoted = level[self._offset:even:2]
+                self._offset ^= 1
+                if h + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                self.levels[h + 1] = np.concatenate([self.levels[h + 1], promoted])
+                self.levels[h] = level[even:]
+                self.error += 2 ** h
+            h += 1
+
+    def rank_error(self):
+        """Return the bound on the rank error of quantiles, as a fraction of the values."""
+        return self.error / self.n if self.n else 0.0
+
+    def quantile(self, qs):
+        """Return the values at the ranks q * (n - 1) of the stream, up to rank_error()."""
+        if not self.n:
+            return np.full(len(qs), np.nan)
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(level), 2 ** h) for h, level in enumerate(self.levels)])
+        order = np.argsort(values, kind="stable")
+        cumulative = np.cumsum(weights[order])
+        ranks = np.asarray(qs, dtype=np.float64) * (cumulative[-1] - 1)
+        return values[order][np.minimum(np.searchsorted(cumulative, ranks, side="right"), len(values) - 1)]
+
+    def range(self, q=RANGE_QUANTILE):
+        """Return the approximate (q, 1 - q) quantiles, with the fallbacks of compute_range()."""
+        if not self.n:
+            return 0.0, 1.0
+        vmin, vmax = (float(v) for v in self.quantile([q, 1 - q]))
+        return _valid_range(vmin, vmax, lambda: (self.vmin, self.vmax))
+
+
+class RangeCache:
+    """Persistent {key: (vmin, vmax)} cache of exact ranges, keyed by the values and q.
+
+    Computing a key hashes the values, which is several times faster than the quantiles.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.ranges = {}
+        if path is not None and path.exists():
+            try:
+                self.ranges = json.loads(path.read_text())
+            except (OSError, json.JSONDecodeError):
+                pass
+
+    @staticmethod
+    def get_key(values, q):
+        h = hashlib.sha1(np.asarray(q, dtype=np.float64).tobytes())
+        h.update(np.ascontiguousarray(values).tobytes())
+        return h.hexdigest()
+
+    def get_range(self, values, q=RANGE_QUANTILE):
+        values = finite_values(values)
+        key = self.get_key(values, q)
+        # Keep the most recently used entries last, see save().
+        value_range = self.ranges.pop(key, None)
+        if value_range is None:
+            value_range = compute_range(values, q)
+        self.ranges[key] = tuple(value_range)
+        return self.ranges[key]
+
+    def save(self):
+        ranges = dict(list(self.ranges.items())[-RANGE_CACHE_MAX_ENTRIES:])
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(f".{self.path.name}.tmp")
+        tmp_path.write_text(json.dumps(ranges))
+        tmp_path.replace(self.path)
+
+
+def compute_ranges(columns, q=RANGE_QUANTILE, cache=None):
+    """Return the {name: (vmin, vmax)} histogram ranges of a {name: values} dict.
+
+    Values can be arrays, series or QuantileSketch summaries. The exact quantiles of
+    each column come from a single partition of its finite values, and are taken from
+    the cache when one is given.
+    """
+    ranges = {}
+    for name, values in columns.items():
+        if isinstance(values, QuantileSketch):
+            ranges[name] = values.range(q)
+        elif cache is not None:
+            ranges[name] = cache.get_range(values, q)
+        else:
+            ranges[name] = compute_range(values, q)
+    return ranges
+
+
+def bin_values(values, bin_edges):
+    """Return the histogram bin of each value, or -1 for values outside the edges.
+
+    Bins are half-open except the last one, which includes the right edge, as in
+    `np.histogram()`. NaN values are out of range.
+    """
+    n_bins = len(bin_edges) - 1
+    first, last = bin_edges[0], bin_edges[-1]
+    widths = np.diff(bin_edges)
+    if not (widths > 0).all() or not np.allclose(widths, widths[0]):
+        bins = np.searchsorted(bin_edges, values, side="right") - 1
+        bins[values == last] = n_bins - 1
+        bins[~((values >= first) & (values <= last))] = -1
+        return bins
+
+    # Uniform bins: compute the bin arithmetically, then correct off-by-one rounding
+    # against the actual edges, as np.histogram() does.
+    in_range = (values >= first) & (values <= last)
+    v = values[in_range]
+    idx = ((v - first) * (n_bins / (last - first))).astype(np.intp)
+    np.clip(idx, 0, n_bins - 1, out=idx)
+    idx[v < bin_edges[idx]] -= 1
+    idx[(v >= bin_edges[idx + 1]) & (idx != n_bins - 1)] += 1
+    bins = np.full(len(values), -1, dtype=np.intp)
+    bins[in_range] = idx
+    return bins
+
+
+def get_bin_edges(values, n_bins=N_BINS, value_range=None):
+    values = pd.Series(values).dropna()
+    if values.empty:
+        return np.linspace(0, 1, n_bins + 1)
+    vmin, vmax = compute_range(values) if value_range is None else value_range
+    return np.histogram_bin_edges(values, range=(vmin, vmax), bins=n_bins)
+
+
+def count_bins(values, codes, n_groups, bin_edges):
+    """Return the (bin, group) histogram counts of values, given the group code of each value.
+
+    All (group, bin) pairs are counted in a single bincount over group * n_bins + bin.
+    """
+    n_bins = len(bin_edges) - 1
+    bins = bin_values(values, bin_edges)
+    keep = (bins >= 0) & (codes >= 0)
+    flat = codes[keep] * n_bins + bins[keep]
+    return np.bincount(flat, minlength=n_groups * n_bins).reshape(n_groups, n_bins).T
+
+
+def get_histogram_groupby(df, n_bins=N_BINS, ranges=None):
+    """Return the per-group histograms of the numeric columns, and their bin edges.
+
+    ranges optionally holds precomputed (vmin, vmax) ranges of some columns, see
+    `compute_ranges()`.
+    """
+    ranges = ranges or {}
+    feature_names = df.obj.select_dtypes(include=[np.number]).columns
+    bin_edges = {fname: get_bin_edges(df.obj[fname], n_bins, ranges.get(fname)) for fname in feature_names}
+
+    group_names = pd.Index(list(df.size().index))
+    n_groups = len(group_names)
+    codes = df.ngroup().to_numpy()
+    counts = np.zeros((n_bins, n_groups, len(feature_names)), dtype=np.int32)
+    for col_idx, col in enumerate(feature_names):
+        counts[:, :, col_idx] = count_bins(
+            df.obj[col].to_numpy(dtype=float), codes, n_groups, bin_edges[col])
+
+    out = {
+        f"h_{bin_idx:03}": pd.DataFrame(counts[bin_idx], index=group_names, columns=feature_names)
+        for bin_idx in range(n_bins)
+    }
+    return out, bin_edges
+
+
+def segment_statistics(x, sizes):
+    """Compute the statistics of the group segments of a (column, row) matrix sorted by group.
+
+    Moments, minima and maxima are reduced over the segments of all columns at once with
+    `ufunc.reduceat()`, and quantiles are interpolated between the closest ranks of each
+    sorted segment, as `DataFrameGroupBy.quantile()`. NaN values are ignored, as in pandas.
+    Return a dict of (column, group) arrays.
+    """
+    n_columns, n_groups = len(x), len(sizes)
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    valid = ~np.isnan(x)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        counts = np.add.reduceat(valid, starts, axis=1)
+        dev = np.where(valid, x, 0)
+        mean = np.add.reduceat(dev, starts, axis=1) / counts
+        dev -= np.repeat(mean, sizes, axis=1)
+        dev[~valid] = 0
+        dev *= dev
+        std = np.sqrt(np.add.reduceat(dev, starts, axis=1) / counts)
+        del dev
+        vmin = np.fmin.reduceat(x, starts, axis=1)
+        vmax = np.fmax.reduceat(x, starts, axis=1)
+
+        # NaN values sort last, so the valid values of a segment come first.
+        quantiles = np.empty((len(QUANTILES), n_columns, n_groups))
+        col_idx = np.arange(n_columns)[:, np.newaxis]
+        q = np.asarray(QUANTILES)[np.newaxis, :]
+        for group_idx, (start, size) in enumerate(zip(starts, sizes)):
+            segment = np.sort(x[:, start:start + size], axis=1)
+            pos = (counts[:, group_idx, np.newaxis] - 1) * q
+            lo = np.floor(pos).astype(np.intp)
+            hi = np.minimum(lo + 1, np.maximum(counts[:, group_idx, np.newaxis] - 1, 0))
+            lo_values = segment[col_idx, np.maximum(lo, 0)]
+            hi_values = segment[col_idx, hi]
+            frac = pos - lo
+            # Exact ranks are taken as is, so that infinite values do not turn into NaN.
+            interpolated = np.where(frac == 0, lo_values, lo_values + (hi_values - lo_values) * frac)
+            quantiles[:, :, group_idx] = interpolated.T
+        quantiles[:, counts == 0] = np.nan
+        q5, median, q95 = quantiles
+
+        uncertainty = (median - mean) / (q95 - q5)
+        uncertainty[np.isnan(uncertainty)] = 0
+
+    return {
+        "mean": mean,
+        "median": median,
+        "std": std,
+        "min": vmin,
+        "max": vmax,
+        "count": counts.astype(np.int32),
+        "uncertainty": uncertainty,
+    }
+
+
+def statistics_frames(stats, group_names, columns, dtypes):
+    """Wrap the arrays of segment_statistics() into one dataframe per statistic."""
+    def frame(values, dtypes=None):
+        out = pd.DataFrame(values.T, index=group_names, columns=columns)
+        return out.astype(dtypes) if dtypes else out
+
+    # Minima and maxima keep the column dtypes, as DataFrameGroupBy.min() and max().
+    dtypes = {
+        col: dtype for i, (col, dtype) in enumerate(dtypes.items())
+        if dtype.kind == "f" or (stats["count"][i] > 0).all()
+    }
+    return {
+        stat: frame(values, dtypes if stat in ("min", "max") else None)
+        for stat, values in stats.items()
+    }
+
+
+def get_statistics(df):
+    """Compute the per-group statistics of the numeric columns of a grouped dataframe.
+
+    The rows are sorted by group once into a (column, row) matrix, see
+    `segment_statistics()`.
+    """
+    keys = df.keys if isinstance(df.keys, list) else [df.keys]
+    columns = [col for col in df.obj.select_dtypes(include=[np.number]).columns if col not in keys]
+    group_names = df.size().index
+
+    codes = df.ngroup().to_numpy()
+    rows = np.flatnonzero(codes >= 0)
+    order = rows[np.argsort(codes[rows], kind="stable")]
+    sizes = np.bincount(codes[order], minlength=len(group_names))
+    x = np.ascontiguousarray(df.obj[columns].to_numpy(dtype=np.float64)[order].T)
+
+    return statistics_frames(segment_statistics(x, sizes), group_names, columns, df.obj[columns].dtypes)
+
+
+def get_aggregates(df):
+    """Compute all per-group statistics and histograms of a grouped dataframe."""
+    out = get_statistics(df)
+    hist, bin_edges = get_histogram_groupby(df, n_bins=N_BINS)
+    out.update(hist)
+    return out, bin_edges
+
+
+class GroupedSketch:
+    """Mergeable approximate per-group quantiles of a stream of (group code, value) pairs.
+
+    The levels of a `QuantileSketch` are shared by all the groups, as arrays of group codes
+    and values, and only the groups holding more than `k` values in a level are compacted.
+    A group that never holds more than `k` values keeps all its values, so its quantiles
+    and histograms are exact. Memory is O(n_groups * k * log(n / k)). NaN values are
+    ignored, infinite values are kept as in `segment_statistics()`.
+    """
+
+    def __init__(self, k=REGION_SKETCH_SIZE):
+        self.k = k
+        self.levels = []  # (codes, values) of each level
+        self._offset = 0
+
+    @property
+    def nbytes(self):
+        return sum(codes.nbytes + values.nbytes for codes, values in self.levels)
+
+    def update(self, codes, values):
+        values = np.asarray(values, dtype=np.float64)
+        valid = ~np.isnan(values)
+        self._append(0, np.asarray(codes, dtype=np.int32)[valid], values[valid])
+        self._compact()
+        return self
+
+    def merge(self, other, mapping=None):
+        """Add the values of another sketch, whose group codes are mapping[code] in this one."""
+        for h, (codes, values) in enumerate(other.levels):
+            self._append(h, codes if mapping is None else mapping[codes], values)
+        self._compact()
+        return self
+
+    def _append(self, h, codes, values):
+        if h == len(self.levels):
+            self.levels.append((np.empty(0, dtype=np.int32), np.empty(0)))
+        level_codes, level_values = self.levels[h]
+        self.levels[h] = (np.concatenate([level_codes, codes]), np.concatenate([level_values, values]))
+
+    def _compact(self):
+        h = 0
+        while h < len(self.levels):
+            codes, values = self.levels[h]
+            full = np.bincount(codes) > self.k
+            if not full.any():
+                h += 1
+                continue
+            full = full[codes]
+            keep_codes, keep_values = codes[~full], values[~full]
+            codes, values = codes[full], values[full]
+            order = _group_order(codes, values)
+            codes, values = codes[order], values[order]
+            starts, sizes = _segments(codes)
+            rank = np.arange(len(codes)) - np.repeat(starts, sizes)
+            size = np.repeat(sizes, sizes)
+            # Groups promote every other value of their even part to the next level, and
+            # keep the odd one out, as in QuantileSketch.
+            compacted = rank < size - size % 2
+            promoted = compacted & (rank % 2 == self._offset)
+            self._offset ^= 1
+            self.levels[h] = (
+                np.concatenate([keep_codes, codes[~compacted]]),
+                np.concatenate([keep_values, values[~compacted]]),
+            )
+            self._append(h + 1, codes[promoted], values[promoted])
+            h += 1
+
+    def weighted(self):
+        """Return the (codes, values, weights) of the kept values, each standing for weight values."""
+        if not self.levels:
+            return np.empty(0, dtype=np.int32), np.empty(0), np.empty(0, dtype=np.int64)
+        codes = np.concatenate([codes for codes, _ in self.levels])
+        values = np.concatenate([values for _, values in self.levels])
+        weights = np.concatenate([np.full(len(codes), 2 ** h) for h, (codes, _) in enumerate(self.levels)])
+        return codes, values, weights
+
+    def quantiles(self, qs, n_groups):
+        """Return the (quantile, group) quantiles of groups, NaN for groups without values.
+
+        Quantiles are interpolated between the closest ranks, as `DataFrameGroupBy.quantile()`,
+        and are exact for the groups that were never compacted.
+        """
+        out = np.full((len(qs), n_groups), np.nan)
+        if not self.levels:
+            return out
+        codes, values, weights = self.weighted()
+        order = _group_order(codes, values)
+        codes, values, weights = codes[order], values[order], weights[order]
+        starts, _ = _segments(codes)
+        if not len(starts):
+            return out
+        ends = np.r_[starts[1:], len(codes)] - 1
+        cumulative = np.cumsum(weights)
+        before = cumulative[starts] - weights[starts]
+        totals = cumulative[ends] - before
+
+        def value_at(rank):
+            # Value of each group at an integer rank, each value standing for weight ranks.
+            idx = np.searchsorted(cumulative, before + rank, side="right")
+            return values[np.clip(idx, starts, ends)]
+
+        for i, q in enumerate(qs):
+            pos = (totals - 1) * q
+            lo = np.floor(pos)
+            frac = pos - lo
+            lo_values = value_at(lo)
+            hi_values = value_at(np.minimum(lo + 1, totals - 1))
+            with np.errstate(invalid="ignore"):
+                # Exact ranks are taken as is, so that infinite values do not turn into NaN.
+                interpolated = lo_values + (hi_values - lo_values) * frac
+                out[i, codes[starts]] = np.where(frac == 0, lo_values, interpolated)
+        return out
+
+    def histograms(self, bin_edges, n_groups):
+        """Return the (bin, group) histogram counts of groups, exact for groups never compacted."""
+        n_bins = len(bin_edges) - 1
+        if not self.levels:
+            return np.zeros((n_bins, n_groups), dtype=np.int64)
+        codes, values, weights = self.weighted()
+        bins = bin_values(values, bin_edges)
+        keep = bins >= 0
+        flat = codes[keep] * n_bins + bins[keep]
+        counts = np.bincount(flat, weights=weights[keep], minlength=n_groups * n_bins)
+        return counts.reshape(n_groups, n_bins).T.astype(np.int64)
+
+
+def _group_order(codes, values):
+    """Return the order sorting (code, value) pairs by code, then by value.
+
+    Same as `np.lexsort((values, codes))`, several times faster: the stable sort by code
+    after the sort by value is a radix sort when the codes fit in 16 bits.
+    """
+    order = np.argsort(values)
+    codes = codes[order]
+    if len(codes) and codes.max() < 2 ** 16:
+        codes = codes.astype(np.uint16)
+    return order[np.argsort(codes, kind="stable")]
+
+
+def _segments(sorted_codes):
+    """Return the start and the size of each run of equal codes."""
+    starts = np.flatnonzero(np.diff(sorted_codes, prepend=-1))
+    return starts, np.diff(np.r_[starts, len(sorted_codes)])
+
+
+class RegionAccumulator:
+    """Per-region aggregates of a table fed as a stream of row chunks, in bounded memory.
+
+    `update()` adds a chunk of rows and `merge()` adds the rows of another accumulator,
+    so chunks can be accumulated independently, e.g. per worker, and merged afterwards.
+    `aggregates()` returns the dataframes of `get_aggregates()` on the concatenated rows
+    grouped by `by`.
+
+    The state does not grow with the number of rows: for each column and group, the
+    count, sum, sum of squared deviations, min and max, which are merged exactly, and a
+    `GroupedSketch` of `region_sketch_size` values per level for the medians, quantiles
+    and histograms. These are exact for the groups of at most `region_sketch_size` rows.
+    The histogram ranges come from a `QuantileSketch` of each column.
+    """
+
+    def __init__(self, columns, by="atlas_idx", sketch_size=SKETCH_SIZE, region_sketch_size=REGION_SKETCH_SIZE):
+        self.columns = list(columns)
+        self.by = by
+        self.sketch_size = sketch_size
+        self.region_sketch_size = region_sketch_size
+        self.n_rows = 0
+        self.dtypes = {}
+        # Group keys in order of appearance, the group code of a row being the index of its key.
+        self._groups = pd.Index([])
+        # (column, group) moments.
+        shape = (len(self.columns), 0)
+        self._count = np.zeros(shape, dtype=np.int64)
+        self._sum, self._m2 = np.zeros(shape), np.zeros(shape)
+        self._min, self._max = np.zeros(shape), np.zeros(shape)
+        self.sketches = {col: QuantileSketch(sketch_size) for col in self.columns}
+        self.region_sketches = {col: GroupedSketch(region_sketch_size) for col in self.columns}
+        self._hashes = {col: hashlib.sha1() for col in self.columns}
+
+    def __len__(self):
+        return self.n_rows
+
+    @property
+    def n_groups(self):
+        return len(self._groups)
+
+    @property
+    def nbytes(self):
+        """Return the size of the accumulated arrays."""
+        return (
+            sum(a.nbytes for a in (self._count, self._sum, self._m2, self._min, self._max))
+            + sum(sum(level.nbytes for level in sketch.levels) for sketch in self.sketches.values())
+            + sum(sketch.nbytes for sketch in self.region_sketches.values())
+        )
+
+    def _get_codes(self, keys):
+        """Return the group codes of keys, adding the groups seen for the first time."""
+        codes = self._groups.get_indexer(keys)
+        new = codes < 0
+        if new.any():
+            new_keys = pd.unique(np.asarray(keys)[new])
+            self._groups = self._groups.append(pd.Index(new_keys)) if len(self._groups) else pd.Index(new_keys)
+            shape = (len(self.columns), len(new_keys))
+            self._count = np.concatenate([self._count, np.zeros(shape, dtype=np.int64)], axis=1)
+            self._sum = np.concatenate([self._sum, np.zeros(shape)], axis=1)
+            self._m2 = np.concatenate([self._m2, np.zeros(shape)], axis=1)
+            self._min = np.concatenate([self._min, np.full(shape, np.nan)], axis=1)
+            self._max = np.concatenate([self._max, np.full(shape, np.nan)], axis=1)
+            codes[new] = self._groups.get_indexer(np.asarray(keys)[new])
+        return codes
+
+    def _add_moments(self, idx, count, total, m2, vmin, vmax):
+        # Chan et al. update of the sum of squared deviations of two sets of values.
+        n_a, n_b = self._count[:, idx], count
+        n = n_a + n_b
+        with np.errstate(invalid="ignore", divide="ignore"):
+            delta = total / n_b - self._sum[:, idx] / n_a
+            correction = delta * delta * n_a * n_b / n
+        correction[(n_a == 0) | (n_b == 0)] = 0
+        self._m2[:, idx] += m2 + correction
+        self._count[:, idx] = n
+        self._sum[:, idx] += total
+        self._min[:, idx] = np.fmin(self._min[:, idx], vmin)
+        self._max[:, idx] = np.fmax(self._max[:, idx], vmax)
+
+    def update(self, df):
+        codes = self._get_codes(df[self.by].to_numpy())
+        for col in self.columns:
+            self.dtypes.setdefault(col, df[col].dtype)
+
+        # Moments of the chunk, for all the (column, group) pairs at once.
+        n_columns, n_groups = len(self.columns), self.n_groups
+        x = np.stack([df[col].to_numpy(dtype=np.float64, na_value=np.nan) for col in self.columns])
+        valid = ~np.isnan(x)
+        flat = (np.arange(n_columns)[:, np.newaxis] * n_groups + codes)[valid]
+        values = x[valid]
+        size = n_columns * n_groups
+        count = np.bincount(flat, minlength=size)
+        total = np.bincount(flat, weights=values, minlength=size)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            dev = values - (total / count)[flat]
+        m2 = np.bincount(flat, weights=dev * dev, minlength=size)
+        vmin, vmax = np.full(size, np.nan), np.full(size, np.nan)
+        np.fmin.at(vmin, flat, values)
+        np.fmax.at(vmax, flat, values)
+        shape = (n_columns, n_groups)
+        self._add_moments(
+            slice(None), count.reshape(shape), total.reshape(shape), m2.reshape(shape),
+            vmin.reshape(shape), vmax.reshape(shape),
+        )
+
+        for i, col in enumerate(self.columns):
+            self.sketches[col].update(x[i])
+            self.region_sketches[col].update(codes, x[i])
+            hashes = pd.util.hash_pandas_object(df[[col, self.by]], index=False)
+            self._hashes[col].update(hashes.to_numpy().tobytes())
+        self.n_rows += len(df)
+        return self
+
+    def merge(self, other):
+        mapping = self._get_codes(other._groups.to_numpy()).astype(np.int32)
+        for col, dtype in other.dtypes.items():
+            self.dtypes.setdefault(col, dtype)
+        self._add_moments(mapping, other._count, other._sum, other._m2, other._min, other._max)
+        for col in self.columns:
+            self.sketches[col].merge(other.sketches[col])
+            self.region_sketches[col].merge(other.region_sketches[col], mapping)
+            h = hashlib.sha1(self._hashes[col].digest())
+            h.update(other._hashes[col].digest())
+            self._hashes[col] = h
+        self.n_rows += other.n_rows
+        return self
+
+    def fingerprint(self, columns):
+        """Return a hash of the values of columns and of their groups, in row order."""
+        h = hashlib.sha1()
+        for col in columns:
+            h.update(self._hashes[col].digest())
+        return h.hexdigest()
+
+    def weighted_values(self, col):
+        """Return the values kept for a column and their weights, see `GroupedSketch.weighted()`.
+
+        Their weighted histograms and moments stand for those of the non-NaN values of the
+        column, in memory bounded by the state rather than by the rows.
+        """
+        _, values, weights = self.region_sketches[col].weighted()
+        return values, weights
+
+    def _sorted_groups(self):
+        # Groups are returned sorted by key, as by groupby().
+        order = np.argsort(self._groups.to_numpy(), kind="stable")
+        return self._groups[order], order
+
+    def statistics(self, columns=None):
+        """Return the per-group statistics dataframes of columns, as `get_statistics()`."""
+        columns = self.columns if columns is None else list(columns)
+        group_keys, order = self._sorted_groups()
+        rows = [self.columns.index(col) for col in columns]
+        count = self._count[rows][:, order]
+        quantiles = np.stack(
+            [self.region_sketches[col].quantiles(QUANTILES, self.n_groups)[:, order] for col in columns], axis=1
+        )
+        q5, median, q95 = quantiles
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = self._sum[rows][:, order] / count
+            std = np.sqrt(self._m2[rows][:, order] / count)
+            uncertainty = (median - mean) / (q95 - q5)
+        uncertainty[np.isnan(uncertainty)] = 0
+
+        stats = {
+            "mean": mean,
+            "median": median,
+            "std": std,
+            "min": self._min[rows][:, order],
+            "max": self._max[rows][:, order],
+            "count": count.astype(np.int32),
+            "uncertainty": uncertainty,
+        }
+        dtypes = {col: self.dtypes[col] for col in columns}
+        return statistics_frames(stats, pd.Index(group_keys, name=self.by), columns, dtypes)
+
+    def ranges(self, columns=None, q=RANGE_QUANTILE, cache=None):
+        """Return the approximate histogram ranges of columns, from their sketches."""
+        columns = self.columns if columns is None else list(columns)
+        return compute_ranges({col: self.sketches[col] for col in columns}, q, cache)
+
+    def histograms(self, columns=None, n_bins=N_BINS, ranges=None):
+        """Return the per-group histogram dataframes and bin edges of columns, as `get_histogram_groupby()`."""
+        columns = self.columns if columns is None else list(columns)
+        ranges = ranges or {}
+        group_keys, order = self._sorted_groups()
+        bin_edges = {}
+        counts = np.zeros((n_bins, self.n_groups, len(columns)), dtype=np.int32)
+        for col_idx, col in enumerate(columns):
+            if not self.sketches[col].n:
+                bin_edges[col] = np.linspace(0, 1, n_bins + 1)
+            else:
+                vmin, vmax = ranges[col] if col in ranges else self.sketches[col].range()
+                bin_edges[col] = np.linspace(vmin, vmax, n_bins + 1)
+            group_counts = self.region_sketches[col].histograms(bin_edges[col], self.n_groups)
+            counts[:, :, col_idx] = group_counts[:, order]
+
+        group_names = pd.Index(group_keys.tolist())
+        out = {
+            f"h_{bin_idx:03}": pd.DataFrame(counts[bin_idx], index=group_names, columns=columns)
+            for bin_idx in range(n_bins)
+        }
+        return out, bin_edges
+
+    def aggregates(self, columns=None, n_bins=N_BINS):
+        """Return the per-group statistics and histograms of columns, as `get_aggregates()`."""
+        out = self.statistics(columns)
+        hist, bin_edges = self.histograms(columns, n_bins=n_bins, ranges=self.ranges(columns))
+        out.update(hist)
+        return out, bin_edges
@@ -0,0 +1,45 @@
+"""Vectorized atlas_id -> atlas_idx conversion.
+
+`BrainRegions.id2index()` returns, for each atlas id, the indices of that id in `br.id`,
+and the generators keep the first one. The lookup table built here holds that first index
+for every atlas id of the atlas, including the negative ids of lateralized regions, as
+two arrays sorted by id, so that whole columns are converted with one binary search.
+The table is cached on disk per iblatlas version.
+"""
+
+import numpy as np
+
+
+def build_atlas_index_table(br):
+    """Return the (sorted atlas ids, first atlas index of each id) table of a BrainRegions."""
+    ids = np.unique(np.asarray(br.id))
+    _, indices = br.id2index(ids)
+    return ids.astype(np.int64), np.array([index[0] for index in indices], dtype=np.int32)
+
+
+def load_atlas_index_table(path, version, make_brain_regions):
+    """Load the table cached at path for this iblatlas version, or build and cache it."""
+    if path.exists():
+        try:
+            with np.load(path) as cached:
+                if str(cached["version"]) == version:
+                    return cached["ids"], cached["idx"]
+        except (OSError, KeyError, ValueError):
+            pass
+    ids, idx = build_atlas_index_table(make_brain_regions())
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.tmp.npz")
+    np.savez(tmp_path, version=np.array(version), ids=ids, idx=idx)
+    tmp_path.replace(path)
+    return ids, idx
+
+
+def atlas_ids_to_index(table, atlas_ids):
+    """Map an array of atlas ids to atlas indices, raising ValueError on unknown ids."""
+    ids, idx = table
+    atlas_ids = np.asarray(atlas_ids, dtype=np.int64)
+    pos = np.minimum(np.searchsorted(ids, atlas_ids), len(ids) - 1)
+    unknown = ids[pos] != atlas_ids
+    if unknown.any():
+        raise ValueError(f"Unknown atlas ids: {np.unique(atlas_ids[unknown])[:10].tolist()}")
+    return idx[pos]
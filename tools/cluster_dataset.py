@@ -0,0 +1,69 @@
+"""Partitioned parquet dataset of the clusters of all insertions, used by make_ephys.py.
+
+The clusters of each pid are stored in `<dataset_dir>/pid=<pid>/part-0.parquet`, so that
+pids can be added one at a time and all of them read back in a single scan. Partitions
+are written by different spike sorting runs, so their columns and dtypes may differ:
+scans use the union of the partition schemas, with missing columns read as nulls and
+integer columns promoted to float where other partitions store floats.
+"""
+
+import os
+
+import pyarrow
+import pyarrow.dataset
+
+
+PID_SCHEMA = pyarrow.schema([("pid", pyarrow.string())])
+
+
+def get_cluster_partition_path(dataset_dir, pid):
+    return dataset_dir / f"pid={pid}" / "part-0.parquet"
+
+
+def list_cluster_partitions(dataset_dir):
+    if not dataset_dir.exists():
+        return set()
+    with os.scandir(dataset_dir) as it:
+        return {
+            entry.name[len("pid="):]
+            for entry in it
+            if entry.name.startswith("pid=") and os.path.exists(os.path.join(entry.path, "part-0.parquet"))
+        }
+
+
+def write_cluster_partition(dataset_dir, pid, df):
+    # The pid is encoded in the partition directory name, and the partition is written through
+    # a temporary file so that an interrupted run never leaves a truncated partition.
+    path = get_cluster_partition_path(dataset_dir, pid)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    df.drop(columns="pid", errors="ignore").to_parquet(tmp_path, index=False)
+    tmp_path.replace(path)
+
+
+def scan_cluster_dataset(dataset_dir, pids, columns=None):
+    partitioning = pyarrow.dataset.partitioning(PID_SCHEMA, flavor="hive")
+    pid_filter = pyarrow.dataset.field("pid").isin(list(pids))
+    dataset = pyarrow.dataset.dataset(dataset_dir, format="parquet", partitioning=partitioning)
+    # The dataset schema is otherwise inferred from the first partition only, which drops the
+    # columns it lacks and fails on partitions storing a column with another type.
+    schemas = [fragment.physical_schema for fragment in dataset.get_fragments(filter=pid_filter)]
+    if schemas:
+        schema = pyarrow.unify_schemas(schemas + [PID_SCHEMA], promote_options="permissive")
+        dataset = pyarrow.dataset.dataset(
+            dataset_dir, format="parquet", partitioning=partitioning, schema=schema.remove_metadata()
+        )
+    if columns is not None:
+        columns = [col for col in columns if col in dataset.schema.names]
+    return dataset.scanner(columns=columns, filter=pid_filter)
+
+
+def read_cluster_dataset(dataset_dir, pids, columns=None):
+    """Read the clusters of the given pids from the partitioned dataset in a single scan."""
+    return scan_cluster_dataset(dataset_dir, pids, columns=columns).to_table().to_pandas()
+
+
+def iter_cluster_dataset(dataset_dir, pids, columns=None):
+    """Yield the clusters of the given pids one parquet record batch at a time."""
+    for batch in scan_cluster_dataset(dataset_dir, pids, columns=columns).to_batches():
+        yield batch.to_pandas()
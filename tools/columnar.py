@@ -0,0 +1,59 @@
+"""Columnar layout of the per-region data of feature payloads.
+
+By default `mappings[m].data` is a dict keyed by region id, each value being a dict
+`{mean, median, std, min, max, count, uncertainty, h_000, ...}`. `columnarize_payload()`
+replaces it by `mappings[m].columns`:
+
+    {
+        "ids": [region_id, ...],
+        "values": {"mean": [...], "std": [...], ...},
+        "histogram_keys": ["h_000", ...],
+        "histogram": [[...], ...],  # one row per region, 0 for missing bins
+    }
+
+The frontend expands this layout back into `data` right after loading the payload
+(see `expandColumnarMappings()` in js/feature-payload.js).
+"""
+
+HISTOGRAM_PREFIX = "h_"
+
+
+def _histogram_key_order(key):
+    suffix = key[len(HISTOGRAM_PREFIX):]
+    return (0, int(suffix), key) if suffix.isdigit() else (1, 0, key)
+
+
+def _region_id(region_id):
+    if isinstance(region_id, str) and region_id.lstrip("-").isdigit():
+        return int(region_id)
+    return region_id
+
+
+def to_columnar(data):
+    """Convert a `{region_id: {stat: value}}` dict into the columnar layout."""
+    rows = list(data.values())
+    stat_names, histogram_keys = [], []
+    for row in rows:
+        for key in row:
+            names = histogram_keys if key.startswith(HISTOGRAM_PREFIX) else stat_names
+            if key not in names:
+                names.append(key)
+    histogram_keys.sort(key=_histogram_key_order)
+    return {
+        "ids": [_region_id(region_id) for region_id in data],
+        "values": {stat: [row.get(stat) for row in rows] for stat in stat_names},
+        "histogram_keys": histogram_keys,
+        "histogram": [[row.get(key, 0) for key in histogram_keys] for row in rows],
+    }
+
+
+def columnarize_payload(payload):
+    """Switch the region data of all mappings of a payload to the columnar layout."""
+    feature_data = payload.get("feature_data", payload)
+    for mapping_payload in (feature_data.get("mappings") or {}).values():
+        data = mapping_payload.get("data")
+        if not isinstance(data, dict) or not all(isinstance(row, dict) for row in data.values()):
+            continue
+        mapping_payload["columns"] = to_columnar(data)
+        del mapping_payload["data"]
+    return payload
@@ -0,0 +1,148 @@
+"""On-disk format of feature files, shared by server.py and the generation scripts.
+
+Feature files are stored as minified JSON, the same bytes the server sends over the wire,
+next to precompressed `<fname>.json.br` and `<fname>.json.gz` siblings that are served
+as is to clients accepting these encodings. Files are written to a temporary file and
+renamed, so that readers never see a partially written file.
+"""
+
+import gzip
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+FEATURES_JSON_SEPARATORS = (',', ':')
+# Precompressed siblings of feature files, in order of preference: <fname>.json.br, .json.gz
+COMPRESSED_SUFFIXES = (('br', '.br'), ('gzip', '.gz'))
+# Compression levels of the siblings: fast ones when a feature file is uploaded to the server,
+# the highest ones when it is written by the offline generators.
+FAST_GZIP_LEVEL, FAST_BROTLI_QUALITY = 6, 5
+BEST_GZIP_LEVEL, BEST_BROTLI_QUALITY = 9, 11
+COMPRESSION_CHUNK_SIZE = 1024 * 1024
+
+
+def write_json_atomic(path, data, compact=False):
+    # Write to a temporary file in the same directory and rename it, so that readers
+    # never see a partially written file.
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            if compact:
+                json.dump(data, f, separators=FEATURES_JSON_SEPARATORS)
+            else:
+                json.dump(data, f, indent=1)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def save_features(path, json_data, best=False):
+    assert path
+    assert json_data
+    write_json_atomic(Path(path), json_data, compact=True)
+    write_compressed_siblings(path, best=best)
+
+
+def is_compact_features_file(path):
+    # Indented files written by older versions start with '{\n', compact ones with '{"'.
+    with open(path, 'rb') as f:
+        head = f.read(2)
+    return len(head) < 2 or not head[1:].isspace()
+
+
+def has_fresh_siblings(path):
+    """Return whether all the compressed siblings of a feature file are newer than it."""
+    path = Path(path)
+    mtime = path.stat().st_mtime_ns
+    for encoding, suffix in COMPRESSED_SUFFIXES:
+        sibling_path = get_compressed_sibling_path(path, suffix)
+        if encoding == 'br' and brotli is None:
+            # A stale sibling would be served, write_compressed_siblings() removes it.
+            if sibling_path.exists():
+                return False
+            continue
+        if not sibling_path.exists() or sibling_path.stat().st_mtime_ns < mtime:
+            return False
+    return True
+
+
+def compact_features_file(path):
+    """Rewrite a feature file in the compact on-disk format, return whether it changed.
+
+    Compact files are left alone, and only get their siblings rewritten when they are
+    missing or older than the file.
+    """
+    path = Path(path)
+    if is_compact_features_file(path):
+        if not has_fresh_siblings(path):
+            write_compressed_siblings(path, best=True)
+        return False
+    with open(path, 'r') as f:
+        json_data = json.load(f)
+    save_features(path, json_data, best=True)
+    return True
+
+
+def get_compressed_sibling_path(path, suffix):
+    path = Path(path)
+    return path.with_name(path.name + suffix)
+
+
+def _gzip_file(src, dst, level):
+    # No file name nor mtime in the header, so that the output only depends on the input.
+    with gzip.GzipFile(filename='', mode='wb', fileobj=dst, compresslevel=level, mtime=0) as f:
+        shutil.copyfileobj(src, f, COMPRESSION_CHUNK_SIZE)
+
+
+def _brotli_file(src, dst, quality):
+    compressor = brotli.Compressor(quality=quality)
+    while chunk := src.read(COMPRESSION_CHUNK_SIZE):
+        dst.write(compressor.process(chunk))
+    dst.write(compressor.finish())
+
+
+def write_compressed_siblings(path, best=False):
+    """Write the .gz (and .br if brotli is installed) siblings of a feature file.
+
+    They are served as is to clients accepting these encodings. The file is compressed
+    chunk by chunk, at fast levels by default and at the highest ones with `best=True`,
+    which is what the offline generators use.
+    """
+    path = Path(path)
+    compressors = {
+        'gzip': lambda src, dst: _gzip_file(src, dst, BEST_GZIP_LEVEL if best else FAST_GZIP_LEVEL),
+    }
+    if brotli is not None:
+        compressors['br'] = lambda src, dst: _brotli_file(
+            src, dst, BEST_BROTLI_QUALITY if best else FAST_BROTLI_QUALITY)
+    for encoding, suffix in COMPRESSED_SUFFIXES:
+        sibling_path = get_compressed_sibling_path(path, suffix)
+        if encoding not in compressors:
+            # Do not leave a sibling of a previous version of the file behind.
+            if sibling_path.exists():
+                sibling_path.unlink()
+            continue
+        tmp_path = sibling_path.with_name(f'.{sibling_path.name}.tmp')
+        try:
+            with open(path, 'rb') as src, open(tmp_path, 'wb') as dst:
+                compressors[encoding](src, dst)
+            os.replace(tmp_path, sibling_path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+
+
+def remove_compressed_siblings(path):
+    for _, suffix in COMPRESSED_SUFFIXES:
+        sibling_path = get_compressed_sibling_path(path, suffix)
+        if sibling_path.exists():
+            sibling_path.unlink()
@@ -0,0 +1,103 @@
+"""Voxel index of an atlas label volume, for per-region reductions of volumes.
+
+`build_label_index()` sorts the voxels of a label volume (`AllenAtlas(res_um).label`)
+by label once, and keeps the sort permutation with the size of every label segment.
+The voxels of a label, such as the outside-brain mask (label 0), are then one slice of
+the permutation, and the per-label moments and histograms of any volume of the same
+shape are one gather followed by `np.add.reduceat()` and `np.bincount()` passes, see
+`LabelIndex.reduce()`. The index is cached on disk per atlas resolution and iblatlas
+version, and shared by all the features of all the buckets.
+"""
+
+import numpy as np
+
+from tools.aggregates import count_bins
+
+
+class LabelIndex:
+    def __init__(self, shape, labels, sizes, order):
+        self.shape = tuple(int(n) for n in shape)
+        self.labels = labels  # the distinct labels, sorted
+        self.sizes = sizes  # the number of voxels of each label
+        self.order = order  # the flat voxel indices, sorted by label
+        self.starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+        self._codes = None
+
+    def __len__(self):
+        return len(self.labels)
+
+    @property
+    def codes(self):
+        """The label code (position in labels) of each voxel, in label order."""
+        if self._codes is None:
+            self._codes = np.repeat(np.arange(len(self.labels), dtype=np.int32), self.sizes)
+        return self._codes
+
+    def voxels(self, label):
+        """Return the flat indices of the voxels of a label."""
+        i = np.searchsorted(self.labels, label)
+        if i == len(self.labels) or self.labels[i] != label:
+            return self.order[:0]
+        return self.order[self.starts[i]:self.starts[i] + self.sizes[i]]
+
+    def mask(self, label):
+        """Return the boolean volume of the voxels of a label."""
+        out = np.zeros(self.shape, dtype=bool)
+        out.reshape(-1)[self.voxels(label)] = True
+        return out
+
+    def gather(self, volume):
+        """Return the values of a volume sorted by label."""
+        if tuple(volume.shape) != self.shape:
+            raise ValueError(f"Volume shape {volume.shape} does not match the label volume {self.shape}")
+        return np.asarray(volume).reshape(-1)[self.order]
+
+    def reduce(self, volume, bin_edges):
+        """Return the per-label reductions of a volume, ignoring NaN voxels.
+
+        The voxels are gathered in label order once: the count, sum and sum of squares of
+        every label are then one `np.add.reduceat()` over the label segments, and the
+        (bin, label) histogram counts one `np.bincount()`, see `count_bins()`.
+        """
+        values = self.gather(volume)
+        valid = ~np.isnan(values)
+        x = np.where(valid, values, 0).astype(np.float64)
+        return {
+            "count": np.add.reduceat(valid, self.starts, dtype=np.int64),
+            "sum": np.add.reduceat(x, self.starts),
+            "sumsq": np.add.reduceat(x * x, self.starts),
+            "histograms": count_bins(values, self.codes, len(self.labels), bin_edges),
+        }
+
+
+def build_label_index(label):
+    label = np.asarray(label)
+    order = np.argsort(label, axis=None, kind="stable")
+    order = order.astype(np.int32 if label.size < 2 ** 31 else np.int64)
+    labels, sizes = np.unique(label.reshape(-1)[order], return_counts=True)
+    return LabelIndex(label.shape, labels, sizes, order)
+
+
+def load_label_index(path, version, make_label_volume):
+    """Load the index cached at path for this version, or build it from make_label_volume()
+    and cache it."""
+    if path.exists():
+        try:
+            with np.load(path) as cached:
+                if str(cached["version"]) == version:
+                    return LabelIndex(cached["shape"], cached["labels"], cached["sizes"], cached["order"])
+        except (OSError, KeyError, ValueError):
+            pass
+    index = build_label_index(make_label_volume())
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.tmp.npz")
+    np.savez(
+        tmp_path,
+        version=np.array(version),
+        shape=np.array(index.shape),
+        labels=index.labels,
+        sizes=index.sizes,
+        order=index.order,
+    )
+    tmp_path.replace(path)
+    return index
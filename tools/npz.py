@@ -0,0 +1,115 @@
+"""Memory-mapped access to the arrays of NPZ files.
+
+`np.load(path, mmap_mode="r")` ignores `mmap_mode` for NPZ files and reads members
+fully into memory. `open_npz_member()` maps a member in place when it is stored
+uncompressed (`np.savez()`), and otherwise extracts it once to a temporary NPY file
+that is mapped instead (`np.savez_compressed()`). Pages of a mapped member are shared
+by all the processes reading it.
+
+`write_feature_major()` rewrites a `[X, Y, Z, F]` volume as an NPY file of shape
+`[F, ...]`, in which every feature is a contiguous C-ordered volume, optionally with its
+spatial axes permuted. The source is read once, in blocks of contiguous rows.
+"""
+
+import shutil
+import struct
+import tempfile
+import zipfile
+from pathlib import Path
+
+import numpy as np
+
+
+ZIP_LOCAL_HEADER_SIZE = 30
+ZIP_LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+
+
+def _member_data_offset(f, info):
+    # The local file header repeats the name and has its own extra field, whose length
+    # can differ from the one in the central directory.
+    f.seek(info.header_offset)
+    header = f.read(ZIP_LOCAL_HEADER_SIZE)
+    if header[:4] != ZIP_LOCAL_HEADER_SIGNATURE:
+        raise ValueError(f"Bad zip local header for {info.filename}")
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    return info.header_offset + ZIP_LOCAL_HEADER_SIZE + name_length + extra_length
+
+
+def _read_array_header(f):
+    if np.lib.format.read_magic(f) == (1, 0):
+        return np.lib.format.read_array_header_1_0(f)
+    return np.lib.format.read_array_header_2_0(f)
+
+
+def get_npz_member_shape(npz_path, name):
+    """Return the shape of the array `name` of an NPZ file, without reading its data."""
+    with zipfile.ZipFile(npz_path) as zf, zf.open(f"{name}.npy") as f:
+        return _read_array_header(f)[0]
+
+
+def open_npz_member(npz_path, name, tmp_dir=None):
+    """Return a read-only memory map of the array `name` of an NPZ file.
+
+    Compressed members are extracted to a temporary file under tmp_dir. The file is
+    unlinked right away, and its space is freed once the returned array is garbage
+    collected.
+    """
+    npz_path = Path(npz_path)
+    with zipfile.ZipFile(npz_path) as zf:
+        info = zf.getinfo(f"{name}.npy")
+        if info.compress_type == zipfile.ZIP_STORED:
+            with open(npz_path, "rb") as f:
+                offset = _member_data_offset(f, info)
+                f.seek(offset)
+                shape, fortran_order, dtype = _read_array_header(f)
+                offset = f.tell()
+            return np.memmap(
+                npz_path, dtype=dtype, mode="r", shape=shape, order="F" if fortran_order else "C", offset=offset
+            )
+
+        tmp_path = Path(tempfile.mkdtemp(dir=tmp_dir)) / f"{name}.npy"
+        with zf.open(info) as src, open(tmp_path, "wb") as dst:
+            shutil.copyfileobj(src, dst, length=16 * 2 ** 20)
+    array = np.load(tmp_path, mmap_mode="r")
+    # The mapping stays valid after the file is unlinked, on POSIX systems.
+    shutil.rmtree(tmp_path.parent, ignore_errors=True)
+    return array
+
+
+def write_feature_major(
+    vol4d, path, axis_perm=(0, 1, 2), features=None, dtype=np.float32, transform=None, block_bytes=2 ** 28
+):
+    """Write the [X, Y, Z, F] array vol4d to an NPY file of shape [F, *spatial shape],
+    with the spatial axes transposed by axis_perm, and return it memory-mapped read-only.
+
+    features, if given, is the list of the feature indices to write, in order.
+
+    transform(block, index), if given, is called on every written block, a writable view
+    of the output at `output[(slice(None),) + index]`, and may modify it in place.
+    """
+    path = Path(path)
+    axis_perm = tuple(int(axis) for axis in axis_perm)
+    shape = tuple(vol4d.shape[axis] for axis in axis_perm)
+    n_features = vol4d.shape[3] if features is None else len(features)
+    row_bytes = vol4d[0].size * max(vol4d.dtype.itemsize, np.dtype(dtype).itemsize)
+    rows = max(1, block_bytes // max(row_bytes, 1))
+    # The output axis that receives the rows of axis 0 of the source.
+    block_axis = axis_perm.index(0)
+
+    tmp_path = path.with_name(f".{path.name}.tmp.npy")
+    out = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=dtype, shape=(n_features,) + shape)
+    for start in range(0, vol4d.shape[0], rows):
+        stop = min(start + rows, vol4d.shape[0])
+        block = np.asarray(vol4d[start:stop])
+        if features is not None:
+            block = block[..., features]
+        block = np.moveaxis(block, 3, 0)
+        index = tuple(slice(start, stop) if axis == block_axis else slice(None) for axis in range(3))
+        view = out[(slice(None),) + index]
+        np.copyto(view, block.transpose((0,) + tuple(axis + 1 for axis in axis_perm)), casting="unsafe")
+        if transform is not None:
+            transform(view, index)
+    out.flush()
+    del out
+    tmp_path.replace(path)
+    return np.load(path, mmap_mode="r")
@@ -15,29 +15,51 @@ Expected NPZ fields
 
 Notes
 -----
-- The current ``iblbrainviewer.api.make_volume_payload()`` path uses a default
-  50 um histogrammer. For 25 um volumes we temporarily swap in a histogrammer
-  with the requested resolution so per-region histograms are generated against
-  the correct Allen label volume.
+- The per-region statistics and histograms of every feature are reduced in one pass
+  over the voxels sorted by label (``LabelIndex.reduce()``), then folded into the
+  regions of the atlas, both hemispheres together as in ``make_ephys.py``. This
+  replaces the ``iblbrainviewer`` histogrammer, which sorted the label volume again
+  for every feature.
 - Voxels outside the Allen brain mask are set to NaN before payload generation.
+- The volume is memory-mapped and rewritten once, in blocks, as a feature-major NPY
+  file in the Allen label orientation, already denormalized and masked. Every feature
+  is then exported from a contiguous read-only view of that file. ``--feature-major``
+  keeps the file for later runs on the same NPZ.
+- The Allen label shape and the outside-brain mask come from a label index (voxels
+  sorted by label) cached under ``data/cache/`` per resolution, see
+  ``tools/label_index.py``, so the label volume is only loaded once per resolution.
+- With ``--jobs N``, features are exported by N forked worker processes, which share
+  the feature-major volume and the label index of the parent instead of loading
+  their own.
 """
 
 from __future__ import annotations
 
 import argparse
+import importlib.metadata
 import json
+import multiprocessing
 import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from itertools import permutations
 from pathlib import Path
 
 import numpy as np
 from iblatlas.atlas import AllenAtlas
+from iblatlas.regions import BrainRegions
 from iblbrainviewer import api
+from tools.aggregates import N_BINS, compute_range
 from tools.ephys_units import get_ephys_feature_unit
+from tools.feature_files import compact_features_file
+from tools.label_index import load_label_index
+from tools.npz import get_npz_member_shape, open_npz_member, write_feature_major
+from tools.volumes import MIP_LEVELS, encode_volume, externalize_volumes
 
 
 ROOT_DIR = Path(__file__).resolve().parents[1]
 DEFAULT_OUTPUT_ROOT = ROOT_DIR / "data" / "features"
+CACHE_DIR = ROOT_DIR / "data" / "cache"
 
 
 def parse_args() -> argparse.Namespace:
@@ -80,11 +102,59 @@ def parse_args() -> argparse.Namespace:
         type=int,
         help="Only export the first N selected features (useful for testing)",
     )
+    parser.add_argument(
+        "--binary-volumes",
+        action="store_true",
+        help=(
+            "Write each volume as a sidecar <feature>.volumes/<name>.npy.gz file "
+            "referenced from the feature JSON instead of inline base64"
+        ),
+    )
+    parser.add_argument(
+        "--mip-levels",
+        type=int,
+        default=MIP_LEVELS,
+        help=(
+            "With --binary-volumes, number of downsampled levels written next to each "
+            f"volume, each halving the resolution (default: {MIP_LEVELS})"
+        ),
+    )
+    parser.add_argument(
+        "--slices",
+        action="store_true",
+        help=(
+            "With --binary-volumes, also store each volume slice by slice along every axis, "
+            "so that the volume view fetches the native slices it shows instead of the "
+            "whole volume (with --mip-levels > 0)"
+        ),
+    )
     parser.add_argument(
         "--overwrite",
         action="store_true",
         help="Delete an existing output bucket directory first",
     )
+    parser.add_argument(
+        "--feature-major",
+        type=Path,
+        help=(
+            "Keep the feature-major copy of the volume at this .npy path and reuse it "
+            "in later runs on the same NPZ (default: temporary file under --tmp-dir)"
+        ),
+    )
+    parser.add_argument(
+        "--tmp-dir",
+        type=Path,
+        help=(
+            "Directory of the temporary feature-major volume, which is about as large as "
+            "the uncompressed input volume (default: the system temporary directory)"
+        ),
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of worker processes exporting features in parallel (default: 1)",
+    )
     return parser.parse_args()
 
 
@@ -114,7 +184,118 @@ def make_bucket_metadata(bucket: str, feature_names: list[str], short_desc: str)
     }
 
 
+def get_feature_major_key(
+    npz_path: Path, axis_perm: tuple[int, int, int], res_um: int, denormalize: bool
+) -> dict:
+    stat = npz_path.stat()
+    return {
+        "npz_path": str(npz_path),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "axis_perm": list(axis_perm),
+        "res_um": res_um,
+        "denormalize": denormalize,
+    }
+
+
+def load_feature_major(path: Path, key: dict) -> np.ndarray | None:
+    """Return the feature-major volume kept at path, if it was made with the same key."""
+    key_path = path.with_suffix(".json")
+    try:
+        if json.loads(key_path.read_text()) == key:
+            return np.load(path, mmap_mode="r")
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def make_feature_major(
+    vol4d: np.ndarray,
+    path: Path,
+    axis_perm: tuple[int, int, int],
+    features: list[int],
+    mask_outside_brain: np.ndarray,
+    mean_per_feature: np.ndarray | None = None,
+    std_per_feature: np.ndarray | None = None,
+) -> np.ndarray:
+    """Write the selected features as a [F, *label shape] float32 NPY file, denormalized
+    and with NaN outside the brain, and return it memory-mapped."""
+    def transform(block, index):
+        if std_per_feature is not None:
+            block *= std_per_feature[features][:, None, None, None]
+            block += mean_per_feature[features][:, None, None, None]
+        np.copyto(block, np.float32(np.nan), where=mask_outside_brain[index])
+
+    return write_feature_major(vol4d, path, axis_perm, features=features, transform=transform)
+
+
+# State shared with the forked export workers, see main().
+_export_context: dict | None = None
+
+
+def make_volume_feature_payload(feature_name: str, volume: np.ndarray, short_desc: str) -> dict:
+    """Return the payload of a feature volume, with its per-region statistics and histograms.
+
+    The per-label reductions of the label index are summed into the regions given by
+    the region code of every label, and regions without any voxel are left out.
+    """
+    ctx = _export_context
+    region_codes, region_ids = ctx["region_codes"], ctx["region_ids"]
+    vmin, vmax = compute_range(volume)
+    reduced = ctx["label_index"].reduce(volume, np.linspace(vmin, vmax, N_BINS + 1))
+
+    def fold(values):
+        return np.bincount(region_codes, weights=values, minlength=len(region_ids))
+
+    count = fold(reduced["count"])
+    keep = count > 0
+    count = count[keep]
+    mean = fold(reduced["sum"])[keep] / count
+    std = np.sqrt(np.maximum(fold(reduced["sumsq"])[keep] / count - mean * mean, 0))
+    histograms = np.stack([fold(counts)[keep] for counts in reduced["histograms"]])
+
+    def remap(values, agg="mean"):
+        return api.make_features(region_ids[keep], values, hemisphere="left", agg=agg)
+
+    extra_values = {"std": remap(std), "count": remap(count, agg="sum")}
+    for i, counts in enumerate(histograms):
+        extra_values[f"h_{i:03d}"] = remap(counts, agg="sum")
+    payload = api.make_features_payload(
+        feature_name, remap(mean), short_desc=short_desc, key="mean", extra_values=extra_values
+    )
+    payload["feature_data"]["histogram"] = {
+        "vmin": vmin,
+        "vmax": vmax,
+        "counts": histograms.sum(axis=1).astype(np.int64).tolist(),
+        "total_count": int(count.sum()),
+    }
+    payload["feature_data"]["volumes"] = {"mean": {"volume": encode_volume(volume)}}
+    return payload
+
+
+def export_feature(feature_name: str) -> str:
+    ctx = _export_context
+    output_dir = ctx["output_dir"]
+    # Contiguous read-only view of the feature in the feature-major volume.
+    volume = ctx["volumes"][ctx["feature_index"][feature_name]]
+
+    payload = make_volume_feature_payload(
+        feature_name,
+        volume,
+        ctx["short_desc_template"].format(feature_name=feature_name),
+    )
+    payload["unit"] = get_ephys_feature_unit(feature_name)
+    if ctx["binary_volumes"]:
+        externalize_volumes(
+            payload, output_dir, feature_name, {"mean": volume}, ctx["mip_levels"], ctx["slices"]
+        )
+    api.save_payload(output_dir, feature_name, payload)
+    compact_features_file(output_dir / f"{feature_name}.json")
+    return feature_name
+
+
 def main() -> None:
+    global _export_context
     args = parse_args()
 
     npz_path = args.npz_path.resolve()
@@ -143,7 +324,6 @@ def main() -> None:
         if missing:
             raise KeyError(f"Missing NPZ fields: {missing}")
 
-        vol4d = z["ephys_atlas_vol"]
         feature_names = [str(x) for x in z["feature_names"].tolist()]
         mean_per_feature = np.asarray(z["mean_per_feature"], dtype=np.float32)
         std_per_feature = np.asarray(z["std_per_feature"], dtype=np.float32)
@@ -151,20 +331,25 @@ def main() -> None:
         res_arr = np.asarray(z["res_um"])
         res_um = int(res_arr.reshape(-1)[0])
 
-        if vol4d.ndim != 4:
-            raise ValueError(f"Expected ephys_atlas_vol to be 4D, got shape {vol4d.shape}")
-        if tuple(vol4d.shape[:3]) != grid_shape:
+        vol4d_shape = get_npz_member_shape(npz_path, "ephys_atlas_vol")
+        if len(vol4d_shape) != 4:
+            raise ValueError(f"Expected ephys_atlas_vol to be 4D, got shape {vol4d_shape}")
+        if tuple(vol4d_shape[:3]) != grid_shape:
             raise ValueError(
-                f"grid_shape {grid_shape} does not match ephys_atlas_vol[:3] {vol4d.shape[:3]}"
+                f"grid_shape {grid_shape} does not match ephys_atlas_vol[:3] {vol4d_shape[:3]}"
             )
-        if vol4d.shape[3] != len(feature_names):
+        if vol4d_shape[3] != len(feature_names):
             raise ValueError(
-                f"Feature count mismatch: volume has {vol4d.shape[3]} features, "
+                f"Feature count mismatch: volume has {vol4d_shape[3]} features, "
                 f"feature_names has {len(feature_names)}"
             )
 
-        atlas = AllenAtlas(res_um=res_um)
-        label_shape = tuple(int(x) for x in atlas.label.shape)
+        label_index = load_label_index(
+            CACHE_DIR / f"label_index_{res_um}um.npz",
+            importlib.metadata.version("iblatlas"),
+            lambda: AllenAtlas(res_um=res_um).label,
+        )
+        label_shape = label_index.shape
         axis_perm = infer_exact_axis_permutation(grid_shape, label_shape)
         print(f"Input grid shape: {grid_shape}")
         print(f"Allen label shape ({res_um} um): {label_shape}")
@@ -186,37 +371,83 @@ def main() -> None:
         with open(output_dir / "_bucket.json", "w") as f:
             json.dump(bucket_metadata, f, indent=1, sort_keys=False)
 
-        mask_outside_brain = atlas.label == 0
-        feature_index = {name: i for i, name in enumerate(feature_names)}
+    # A kept feature-major volume holds all the features, a temporary one only the
+    # selected ones.
+    feature_index = {name: i for i, name in enumerate(feature_names)}
+    features = list(range(len(feature_names)))
+    feature_major_dir = None
+    if args.feature_major:
+        feature_major_path = args.feature_major.resolve()
+        key = get_feature_major_key(npz_path, axis_perm, res_um, args.denormalize)
+        volumes = load_feature_major(feature_major_path, key)
+        if volumes is not None:
+            print(f"Reusing feature-major volume {feature_major_path}")
+    else:
+        feature_major_dir = Path(tempfile.mkdtemp(prefix="feature_major_", dir=args.tmp_dir))
+        feature_major_path = feature_major_dir / "feature_major.npy"
+        features = [feature_index[name] for name in selected]
+        feature_index = {name: i for i, name in enumerate(selected)}
+        volumes = None
+    try:
+        if volumes is None:
+            print(f"Writing feature-major volume {feature_major_path} ({len(features)} features)")
+            feature_major_path.parent.mkdir(parents=True, exist_ok=True)
+            vol4d = open_npz_member(npz_path, "ephys_atlas_vol", tmp_dir=feature_major_path.parent)
+            volumes = make_feature_major(
+                vol4d,
+                feature_major_path,
+                axis_perm,
+                features,
+                label_index.mask(0),
+                mean_per_feature if args.denormalize else None,
+                std_per_feature if args.denormalize else None,
+            )
+            del vol4d
+            if args.feature_major:
+                feature_major_path.with_suffix(".json").write_text(json.dumps(key, indent=1))
+        if volumes.shape != (len(features),) + label_shape:
+            raise ValueError(f"Feature-major volume has shape {volumes.shape}, expected {(len(features),) + label_shape}")
+    finally:
+        if feature_major_dir is not None:
+            # The mapping stays valid after the file is unlinked, on POSIX systems.
+            shutil.rmtree(feature_major_dir, ignore_errors=True)
+
+    # Region of every label, both hemispheres together. The voxel codes of the label
+    # index are computed before the workers are forked, so that they share them.
+    atlas_ids = -np.abs(BrainRegions().id[label_index.labels])
+    region_ids, region_codes = np.unique(atlas_ids, return_inverse=True)
+    label_index.codes
+    _export_context = {
+        "label_index": label_index,
+        "region_ids": region_ids,
+        "region_codes": region_codes,
+        "volumes": volumes,
+        "feature_index": feature_index,
+        "short_desc_template": args.feature_short_desc_template,
+        "binary_volumes": args.binary_volumes,
+        "mip_levels": args.mip_levels,
+        "slices": args.slices,
+        "output_dir": output_dir,
+    }
+    n_jobs = min(max(args.jobs, 1), max(len(selected), 1))
+    if n_jobs > 1 and "fork" not in multiprocessing.get_all_start_methods():
+        print(f"Process forking is not available, ignoring --jobs {args.jobs}")
+        n_jobs = 1
 
-        old_histogrammer = api._default_histogrammer
-        api._default_histogrammer = api.VolumeRegionHistogrammer(
-            res_um=res_um, n_bins=api.N_BINS
-        )
-        try:
+    try:
+        if n_jobs == 1:
             for rank, feature_name in enumerate(selected, start=1):
-                idx = feature_index[feature_name]
                 print(f"[{rank:02d}/{len(selected):02d}] Exporting {feature_name}")
-
-                volume = np.asarray(vol4d[..., idx], dtype=np.float32)
-                if args.denormalize:
-                    volume = volume * std_per_feature[idx] + mean_per_feature[idx]
-
-                volume = np.transpose(volume, axis_perm)
-                volume[mask_outside_brain] = np.nan
-
-                with np.errstate(invalid="ignore"):
-                    payload = api.make_volume_payload(
-                        feature_name,
-                        {"mean": volume},
-                        short_desc=args.feature_short_desc_template.format(
-                            feature_name=feature_name
-                        ),
-                    )
-                payload["unit"] = get_ephys_feature_unit(feature_name)
-                api.save_payload(output_dir, feature_name, payload)
-        finally:
-            api._default_histogrammer = old_histogrammer
+                export_feature(feature_name)
+        else:
+            print(f"Exporting {len(selected)} features with {n_jobs} worker processes")
+            mp_context = multiprocessing.get_context("fork")
+            with ProcessPoolExecutor(max_workers=n_jobs, mp_context=mp_context) as pool:
+                futures = [pool.submit(export_feature, feature_name) for feature_name in selected]
+                for rank, future in enumerate(as_completed(futures), start=1):
+                    print(f"[{rank:02d}/{len(selected):02d}] Exported {future.result()}")
+    finally:
+        _export_context = None
 
     print(f"Done. Wrote local bucket to {output_dir}")
 
@@ -72,7 +72,7 @@ def get_day(file):
 
 def save_json(d, filename):
     with open(filename, "w") as f:
-        json.dump(d, f, indent=1, sort_keys=True)
+        json.dump(d, f, separators=(",", ":"), sort_keys=True)
 
 
 def base64_encode(input_string):
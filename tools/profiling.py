@@ -0,0 +1,155 @@
+"""Stage timings of bucket generation runs, used by make_ephys.py.
+
+`GenerationProfiler.stage()` records the wall time, CPU time and peak RSS of a block of
+code, optionally attributed to a feature. Records made in worker processes are returned
+to the parent and added with `extend()`. `report()` sums them per stage and per feature:
+
+    {
+        "total": {"wall_s": ..., "cpu_s": ..., "peak_rss_mb": ...},
+        "stages": {"aggregates": {"count": 1, "wall_s": ..., "cpu_s": ..., "peak_rss_mb": ...}, ...},
+        "features": {"fname": {"wall_s": ..., ..., "stages": {"remap": {...}, ...}}, ...},
+    }
+
+The peak RSS of a stage is the peak resident memory of the process during that stage. On
+Linux the high-water mark of the process is reset when a stage starts; elsewhere it cannot
+be, and the increase of the high-water mark during the stage is recorded instead. The total
+is the wall and CPU time of the process that created the profiler, and the highest peak RSS.
+CPU times include the worker processes that exited during the stage or the run, e.g. those
+of a process pool shut down within it.
+"""
+
+import json
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+
+def reset_peak_rss():
+    """Reset the peak RSS of the process to its current RSS, return whether it is supported."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def get_peak_rss_mb():
+    # VmHWM is the high-water mark reset by reset_peak_rss(), ru_maxrss the fallback elsewhere.
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 2 ** 10
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux.
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def get_cpu_time():
+    # CPU time of the process and of its terminated children, which the processes of a pool
+    # are once it is shut down.
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+def _summarize(records):
+    return {
+        "count": len(records),
+        "wall_s": round(sum(r["wall_s"] for r in records), 6),
+        "cpu_s": round(sum(r["cpu_s"] for r in records), 6),
+        "peak_rss_mb": round(max(r["peak_rss_mb"] for r in records), 1),
+    }
+
+
+def _group(records, key):
+    groups = {}
+    for record in records:
+        groups.setdefault(record[key], []).append(record)
+    return groups
+
+
+class GenerationProfiler:
+    def __init__(self):
+        self.records = []
+        self.started = time.perf_counter()
+        self.started_cpu = get_cpu_time()
+        # Peak RSS of the stages running in this process, innermost last, as a nested stage
+        # resets the high-water mark of the enclosing ones.
+        self._peaks = []
+
+    @contextmanager
+    def stage(self, name, feature=None):
+        if self._peaks:
+            self._peaks[-1] = max(self._peaks[-1], get_peak_rss_mb())
+        resettable = reset_peak_rss()
+        start_peak = 0 if resettable else get_peak_rss_mb()
+        self._peaks.append(0)
+        wall, cpu = time.perf_counter(), get_cpu_time()
+        try:
+            yield
+        finally:
+            peak = max(self._peaks.pop(), get_peak_rss_mb())
+            if self._peaks:
+                self._peaks[-1] = max(self._peaks[-1], peak)
+            self.records.append({
+                "stage": name,
+                "feature": feature,
+                "wall_s": time.perf_counter() - wall,
+                "cpu_s": get_cpu_time() - cpu,
+                "peak_rss_mb": peak - start_peak,
+            })
+
+    def extend(self, records):
+        self.records.extend(records)
+
+    def report(self):
+        """Return the timings summed per stage and per feature."""
+        features = {}
+        for fname, records in _group([r for r in self.records if r["feature"]], "feature").items():
+            features[fname] = _summarize(records)
+            del features[fname]["count"]
+            features[fname]["stages"] = {
+                name: _summarize(stage_records) for name, stage_records in _group(records, "stage").items()
+            }
+        return {
+            "total": {
+                "wall_s": round(time.perf_counter() - self.started, 6),
+                "cpu_s": round(get_cpu_time() - self.started_cpu, 6),
+                "peak_rss_mb": round(max([get_peak_rss_mb()] + [r["peak_rss_mb"] for r in self.records]), 1),
+            },
+            "stages": {name: _summarize(records) for name, records in _group(self.records, "stage").items()},
+            "features": features,
+        }
+
+    def slowest_features(self, n=5):
+        features = self.report()["features"]
+        return sorted(features, key=lambda fname: features[fname]["wall_s"], reverse=True)[:n]
+
+    def summary(self, n_features=5):
+        """Return a text table of the stage timings and of the slowest features."""
+        report = self.report()
+        lines = [f"{'stage':<24}{'count':>8}{'wall (s)':>12}{'cpu (s)':>12}{'peak RSS (MB)':>16}"]
+        for name, stage in report["stages"].items():
+            lines.append(
+                f"{name:<24}{stage['count']:>8}{stage['wall_s']:>12.2f}{stage['cpu_s']:>12.2f}"
+                f"{stage['peak_rss_mb']:>16.1f}"
+            )
+        total = report["total"]
+        lines.append(f"{'total':<24}{'':>8}{total['wall_s']:>12.2f}{total['cpu_s']:>12.2f}{total['peak_rss_mb']:>16.1f}")
+        slowest = self.slowest_features(n_features)
+        if slowest:
+            lines.append("Slowest features:")
+            for fname in slowest:
+                feature = report["features"][fname]
+                stages = ", ".join(f"{name} {stage['wall_s']:.2f}s" for name, stage in feature["stages"].items())
+                lines.append(f"  {fname}: {feature['wall_s']:.2f}s ({stages})")
+        return "\n".join(lines)
+
+    def save(self, path):
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        tmp_path.write_text(json.dumps(self.report(), indent=1))
+        tmp_path.replace(path)
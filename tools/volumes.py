@@ -0,0 +1,177 @@
+"""Sidecar binary storage for volume feature payloads.
+
+Volume payloads embed each volume as a base64 string of a gzip-compressed NPY file,
+see `encode_volume()`. `externalize_volumes()`
+moves those blobs to `<fname>.volumes/<name>.npy.gz` next to the feature JSON
+and replaces them with `{"href": "<name>.npy"}` references. The server exposes
+them as `GET /api/buckets/<uuid>/<fname>/volumes/<name>.npy` with
+`Content-Encoding: gzip`, so the browser inflates them natively.
+
+With `mip_levels`, every sidecar volume also gets a pyramid of downsampled levels,
+`<name>.mip<level>.npy.gz`, each half the size of the previous one along every axis
+(25 -> 50 -> 100 um for a 25 um volume). They are listed, finest first, in the
+`levels` of the reference, `{"href": "<name>.npy", "levels": [{"href":
+"<name>.npy?level=1", "shape": [...]}, ...]}`, so that the browser can draw the
+coarsest level first and refine it.
+
+With `slices`, every sidecar volume is also stored slice by slice, `<name>.slices`,
+so that a single slice along any axis can be served without the whole volume. The file
+holds an 8-byte little-endian header size, a JSON header `{"shape": [...], "offsets":
+[[...], [...], [...]]}` and the slices, each an independently gzip-compressed NPY file
+in the encoding of the volume. `offsets[axis][i]:offsets[axis][i + 1]` is the byte range
+of slice i along axis, after the header. The server sends the slices as is from
+`GET /api/buckets/<uuid>/<fname>/volumes/<name>/slices/<axis>/<index>.npy`. The
+reference then also holds `"slices": "<name>/slices"` and the `shape` of the volume.
+When the volume also has mip levels, the volume view draws the coarsest level and
+fetches the native slices it displays, instead of the whole native volume.
+"""
+
+import base64
+import gzip
+import io
+import json
+from pathlib import Path
+
+import numpy as np
+
+
+VOLUMES_DIR_SUFFIX = ".volumes"
+MIP_LEVELS = 2  # 25 -> 50 -> 100 um
+MIP_FACTOR = 2
+SLICES_SUFFIX = ".slices"
+SLICES_HEADER_SIZE = 8
+
+
+def get_volumes_dir(output_dir, fname):
+    return Path(output_dir) / f"{fname}{VOLUMES_DIR_SUFFIX}"
+
+
+def get_mip_name(name, level):
+    return f"{name}.mip{level}"
+
+
+def pool_volume(volume, mask, factor=MIP_FACTOR):
+    """Return the mean of the masked voxels of a 3D volume over blocks of factor**3 voxels,
+    and the number of masked voxels of every block. Blocks at the upper edges may be partial."""
+    pad = [(0, -n % factor) for n in volume.shape]
+    shape = [m for n in volume.shape for m in ((n + factor - 1) // factor, factor)]
+    axes = (1, 3, 5)
+    count = np.pad(mask, pad).reshape(shape).sum(axis=axes, dtype=np.int32)
+    total = np.pad(np.where(mask, volume, 0), pad).reshape(shape).sum(axis=axes, dtype=np.float64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return total / count, count
+
+
+def downsample_encoded_volume(encoded, valid, factor=MIP_FACTOR):
+    """Downsample an encoded (uint8) volume by NaN-aware mean pooling.
+
+    valid is the mask of the non-NaN voxels of the original volume. A block takes the mean
+    of its valid voxels, or, without any, the mean of its voxels, which keeps the encoding
+    of NaN voxels of the native level. Return the downsampled volume and its valid mask.
+    """
+    mean, count = pool_volume(encoded, valid, factor)
+    fallback, _ = pool_volume(encoded, np.ones(encoded.shape, dtype=bool), factor)
+    out = np.where(count > 0, mean, fallback)
+    return np.rint(out).astype(encoded.dtype), count > 0
+
+
+def read_npy_gz(data):
+    """Split gzip-compressed NPY bytes into the array and the trailing bytes."""
+    with io.BytesIO(gzip.decompress(data)) as f:
+        array = np.load(f)
+        return array, f.read()
+
+
+def to_npy_gz_bytes(array, extra=b""):
+    with io.BytesIO() as f:
+        np.save(f, array)
+        f.write(extra)
+        return gzip.compress(f.getvalue(), mtime=0)
+
+
+def encode_volume(volume):
+    """Return the base64 string of a volume as embedded in volume payloads.
+
+    As in `iblbrainviewer.api.make_volume_payload()`, the volume is scaled to uint8
+    between its minimum and maximum (127 for a constant volume), and the two bounds
+    follow the NPY as float32. NaN voxels are encoded as 0.
+    """
+    with np.errstate(invalid="ignore"):
+        vmin, vmax = float(np.nanmin(volume)), float(np.nanmax(volume))
+        if vmin == vmax:
+            encoded = np.full(np.shape(volume), 127, dtype=np.uint8)
+        else:
+            encoded = np.nan_to_num((np.asarray(volume) - vmin) / (vmax - vmin) * 255).astype(np.uint8)
+    data = to_npy_gz_bytes(encoded, np.array([vmin, vmax], dtype=np.float32).tobytes())
+    return base64.b64encode(data).decode()
+
+
+def write_npy_gz(path, array, extra=b""):
+    path.write_bytes(to_npy_gz_bytes(array, extra))
+
+
+def write_volume_slices(path, encoded, extra=b""):
+    """Write every slice of an encoded volume along each axis, see the module docstring."""
+    slices = [
+        [to_npy_gz_bytes(np.ascontiguousarray(np.take(encoded, i, axis=axis)), extra) for i in range(n)]
+        for axis, n in enumerate(encoded.shape)
+    ]
+    offsets = np.cumsum([0] + [len(data) for axis_slices in slices for data in axis_slices]).tolist()
+    starts = np.cumsum([0] + list(encoded.shape)).tolist()
+    header = json.dumps({
+        "shape": list(encoded.shape),
+        "offsets": [offsets[starts[axis]:starts[axis + 1] + 1] for axis in range(encoded.ndim)],
+    }, separators=(",", ":")).encode()
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(len(header).to_bytes(SLICES_HEADER_SIZE, "little"))
+        f.write(header)
+        for axis_slices in slices:
+            f.writelines(axis_slices)
+    tmp_path.replace(path)
+
+
+def write_mip_levels(volumes_dir, name, data, volume, mip_levels=MIP_LEVELS):
+    """Write the downsampled levels of an encoded sidecar volume, and return their references.
+
+    data is the gzip-compressed NPY bytes of the native level, and volume the original
+    volume it encodes, used for its NaN mask. The levels keep the bounds of the native level.
+    """
+    encoded, extra = read_npy_gz(data)
+    if encoded.shape != np.shape(volume):
+        raise ValueError(f"Volume {name} has shape {np.shape(volume)}, its encoding {encoded.shape}")
+    valid = ~np.isnan(volume)
+    levels = []
+    for level in range(1, mip_levels + 1):
+        encoded, valid = downsample_encoded_volume(encoded, valid)
+        write_npy_gz(volumes_dir / f"{get_mip_name(name, level)}.npy.gz", encoded, extra)
+        levels.append({"href": f"{name}.npy?level={level}", "shape": list(encoded.shape)})
+    return levels
+
+
+def externalize_volumes(payload, output_dir, fname, volumes=None, mip_levels=0, slices=False):
+    """Write the inline volumes of a payload as sidecar files and replace them by references.
+
+    With mip_levels, also write that many downsampled levels of every volume, computed from
+    the original volumes given in the volumes dict. With slices, also write the slice file of
+    every volume.
+    """
+    feature_data = payload.get("feature_data", payload)
+    entries = feature_data.get("volumes") or {}
+    volumes_dir = get_volumes_dir(output_dir, fname)
+    for name, entry in entries.items():
+        blob = entry.get("volume") if isinstance(entry, dict) else None
+        if not isinstance(blob, str):
+            continue
+        volumes_dir.mkdir(parents=True, exist_ok=True)
+        data = base64.b64decode(blob)
+        (volumes_dir / f"{name}.npy.gz").write_bytes(data)
+        entry["volume"] = {"href": f"{name}.npy"}
+        if mip_levels and volumes and name in volumes:
+            entry["volume"]["levels"] = write_mip_levels(volumes_dir, name, data, volumes[name], mip_levels)
+        if slices:
+            encoded, extra = read_npy_gz(data)
+            write_volume_slices(volumes_dir / f"{name}{SLICES_SUFFIX}", encoded, extra)
+            entry["volume"]["slices"] = f"{name}/slices"
+            entry["volume"]["shape"] = list(encoded.shape)
+    return payload